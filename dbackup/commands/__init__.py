@@ -1,4 +1,14 @@
 from .checkJob import CheckJob
 from .backup import Backup
 from .report import Report
-from .clean import Clean
\ No newline at end of file
+from .clean import Clean, CleanPipeline
+from .verify import Verify
+from .changes import Changes
+from .dedupe import Dedupe
+from .catalog import Catalog, Find
+from .restore import Restore
+from .tuneSsh import TuneSsh
+from .export import Export
+from .diff import Diff
+from .migrate import Migrate
+from .reconcile import Reconcile
@@ -3,6 +3,13 @@ import logging
 import os
 import shutil
 import subprocess
+import tempfile
+import threading
+import collections
+import contextlib
+import shlex
+import statistics
+import time
 
 from typing import List
 
@@ -10,9 +17,18 @@ import dbackup.helpers
 import dbackup.incomplete
 from ..location import Location
 from ..helpers import getDynamicHost
-from ..helpers import SshError, ArgumentError
+from ..helpers import SshError, ArgumentError, ScriptError
 from ..helpers import StateTracker
+from ..helpers import ChangeLog
+from ..helpers import RSyncStats
+from ..helpers import SshAgent
+from ..helpers import callStats
+from ..helpers import Throttle
+from .clean import Clean
+from .catalog import Catalog
 from .. import SshArgs
+from ..tools import chunks as chunksTool
+from ..tools import manifest as manifestTool
 
 import dbackup.resultcodes
 
@@ -22,8 +38,33 @@ class Backup:
 
     rsyncOpts = ['--delete', '-avhF', '--numeric-ids']
 
+    # Required free space relative to the estimated transfer size
+    spaceMargin = 1.1
+
+    # Partially transferred files are kept here, relative to each directory
+    # of the incomplete snapshot, so that a retry resumes them
+    partialDir = '.rsync-partial'
+
+    # With chunk storage, rsync updates the mirror in place, so that only the
+    # changed blocks are written and the unchanged files keep their inodes
+    chunkMirrorOpts = ['--inplace', '--no-whole-file']
+
+    # rsync exit codes that don't fail the backup
+    acceptedExitCodes = { 24: 'some source files vanished before they could be transferred' }
+
+    # The agent is published in SSH_AUTH_SOCK of this process, so jobs that
+    # run in parallel can only forward one at a time
+    _agentLock = threading.Lock()
+
+    # Returned by runRSync() when rsync was killed by the watchdog
+    stalledExitCode = -1
+
+    # rsync exit codes that may succeed if tried again, e.g. connection errors and timeouts
+    retryExitCodes = [ 10, 12, 30, 35, 255, stalledExitCode ]
+
     def __init__(self, publisher, stateTracker = None, simulate = False):
         self.today = dbackup.helpers.today
+        self.timeOfDay = dbackup.helpers.timeOfDay
 
         self.simulate = simulate
 
@@ -33,11 +74,13 @@ class Backup:
             logging.debug('MQTT status reporting for backup job is enabled')
             self.publishState = self._publishState
             self.publishLastGood = self._publishLastGood
+            self.publishPaused = self._publishPaused
         else:
             # MQTT publishing disabled
             logging.debug('MQTT status reporting for backup job is disabled')
             self.publishState = lambda a, b : None
             self.publishLastGood = lambda a, b : None
+            self.publishPaused = lambda a, b : None
 
         self._stateTracker = stateTracker
 
@@ -45,40 +88,75 @@ class Backup:
         self.publisher.publishState(job, state)
 
     def _publishLastGood(self, job : dbackup.Job, date):
-        self.publisher.publishLastGood(job, self.today)
+        self.publisher.publishLastGood(job, date)
 
-    def getLinkTargetOpts(self, location : Location):
-        """ Get rsync options for link target
-
-        Scans the destination for suitable link-targets
+    def _publishPaused(self, job : dbackup.Job, seconds):
+        self.publisher.publishPaused(job, seconds)
 
-        Agruments:
-            location (str) : The destination location of backups
+    def snapshotName(self, job : dbackup.Job) -> str:
+        """ The name of the snapshot that this run makes of job
 
-        Returns a list of RSYNC aruments needed to use the detected link target
+        Jobs with timestamps get the time of the run as well, so that each
+        run makes a new snapshot instead of replacing the one of today.
+        """
+        return dbackup.helpers.snapshotName(self.today, self.timeOfDay if job.timestamps else None)
+
+    def buildThrottle(self, job : dbackup.Job):
+        """ The throttle that pauses rsync while the hosts of the job are loaded, or None """
+        if job.maxLoad is None and job.maxIoPressure is None:
+            return None
+        remotes = {}
+        for location in (job.source, job.dest):
+            if location.isRemote:
+                remotes.setdefault(location.hostKey, location)
+        return Throttle(list(remotes.values()), maxLoad=job.maxLoad, maxIoPressure=job.maxIoPressure,
+            interval=job.throttleInterval, maxPause=job.maxPause,
+            onPause=lambda: self.publishState(job, 'paused'),
+            onResume=lambda: self.publishState(job, 'running'))
+
+    def getLinkTarget(self, location : Location):
+        """ Get the name of the latest complete backup in a location
+
+        Returns None if there are no backups
         """
         # Get list of backups exculding incomplete
         try:
             backups = location.getBackups(False)
         except SshError:
             logging.warning('Could not determine existing backups at %s', location.path)
-            return []
+            return None
 
         if backups is None or not backups or len(backups) == 0:
             logging.warning('No backups found at %s', location.path)
-            return []
+            return None
         
         # There is at least one backup
-        backupsSorted = sorted(backups, reverse=True)
-        
-        linkTargetOpts = ['--link-dest='+location.path+'/'+backupsSorted[0]]
+        return sorted(backups, reverse=True)[0]
+
+    def getLinkTargetOpts(self, location : Location, linkTarget = None):
+        """ Get rsync options for link target
+
+        Scans the destination for suitable link-targets, unless linkTarget is given
+
+        Agruments:
+            location (str) : The destination location of backups
+
+        Returns a list of RSYNC aruments needed to use the detected link target
+        """
+        if linkTarget is None:
+            linkTarget = self.getLinkTarget(location)
+        if linkTarget is None:
+            return []
+
+        linkTargetOpts = ['--link-dest='+location.linkDest(linkTarget)]
         logging.debug("Using link target opts " + str(linkTargetOpts))
 
         return linkTargetOpts
 
-    def finalizeBackup(self, location : Location, name=None):
+    def finalizeBackup(self, location : Location, name=None, manifest=False):
         """ Finalize backup removes incomplete suffix from dest 
         
+        If manifest is set, a content manifest is written to the snapshot.
         """
 
         if name is None:
@@ -90,8 +168,221 @@ class Backup:
         # May raise SshError
         location.renameChild(fromName, toName)
 
-    def invokeRSync(self, rsync):
-        """ Make the rsync call """
+        if manifest:
+            self.writeManifest(location, toName)
+
+    def writeManifest(self, location : Location, name):
+        """ Writes a content manifest for a snapshot
+
+        Failures are logged, but doesn't fail the backup
+        """
+
+        if self.simulate:
+            logging.info('Simulating manifest of %s', name)
+            return False
+
+        try:
+            for stats in location.runTool('manifest', ['build', location.path, name]):
+                logging.info('Wrote manifest of %s with %d files, hashed %d new inodes',
+                    name, stats['files'], stats['hashed'])
+                if stats['unreadable']:
+                    logging.warning('%d files in %s could not be read for the manifest', stats['unreadable'], name)
+            return True
+        except (SshError, ScriptError) as e:
+            logging.warning('Failed to write manifest of %s: %s', name, e.message)
+        return False
+
+    def storeChunks(self, job : dbackup.Job, name) -> bool:
+        """ Stores the mirror of a job with chunk storage as the snapshot name
+
+        Failures fail the backup, as the snapshot would be empty
+        """
+        if self.simulate:
+            logging.info('Simulating storing %s in chunks', name)
+            return True
+
+        try:
+            for stats in job.dest.runTool('chunks', ['commit', job.dest.path, name,
+                    name[:-len(dbackup.incomplete.suffix)], '--chunk-size', str(job.chunkSize)]):
+                logging.info('Stored %d files of %s in %d chunks, chunked %d changed files and wrote %d new bytes',
+                    stats['files'], job, stats['chunks'], stats['chunked'], stats['written'])
+                if stats['unreadable']:
+                    logging.warning('%d files in the mirror of %s could not be read', stats['unreadable'], job)
+            return True
+        except (SshError, ScriptError) as e:
+            logging.error('Failed to store %s in chunks: %s', job, e.message)
+        return False
+
+    def updateCatalog(self, job : dbackup.Job):
+        """ Adds the new snapshot to the catalog of the destination
+
+        Failures are logged, but doesn't fail the backup
+        """
+        try:
+            Catalog(simulate=self.simulate).updateJob(job)
+            return True
+        except (SshError, ScriptError) as e:
+            logging.warning('Failed to update the catalog of %s: %s', job, e.message)
+        return False
+
+    @staticmethod
+    def _processTree(pid) -> list:
+        """ pid and the pids of all its descendants """
+        children = collections.defaultdict(list)
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children[ppid].append(int(entry))
+        tree = [ pid ]
+        for parent in tree:
+            tree += children[parent]
+        return tree
+
+    def _ioCounter(self, pid):
+        """ Number of bytes read and written by a process and its descendants so far, or None if unknown
+
+        rsync forks its receiver and ssh, which do most of the I/O of a pull
+        """
+        total = None
+        for treePid in self._processTree(pid):
+            try:
+                with open(f'/proc/{treePid}/io') as f:
+                    counters = dict(line.split(': ') for line in f.read().splitlines())
+                total = (total or 0) + int(counters['rchar']) + int(counters['wchar'])
+            except (OSError, KeyError, ValueError):
+                continue
+        return total
+
+    @staticmethod
+    def _feed(proc, input : bytes):
+        """ Writes input to the stdin of proc in the background, and closes it """
+        def write():
+            try:
+                proc.stdin.write(input)
+                proc.stdin.close()
+            except (BrokenPipeError, ValueError):
+                pass
+        threading.Thread(target=write, daemon=True).start()
+
+    def runRSync(self, rsync, changeLog : ChangeLog = None, stats : RSyncStats = None, stallTimeout = None,
+            throttle : Throttle = None, input : bytes = None) -> int:
+        """ Runs rsync once
+
+        The output is parsed as it is produced. Itemized changes are fed to
+        changeLog and the summary to stats, if given. stderr is logged as warnings.
+        input is written to the stdin of rsync, e.g. for --exclude-from=-
+
+        If stallTimeout (seconds) is given, rsync is killed when it has neither
+        printed anything nor read or written any bytes for that long, counting
+        the I/O of its child processes. Time that rsync is paused by throttle
+        doesn't count.
+
+        Returns the exit code of rsync, or stalledExitCode if it was killed
+        """
+
+        if throttle is not None:
+            # Before rsync, so that it can share the connections of the throttle
+            throttle.connect()
+        try:
+            proc = subprocess.Popen(callStats.wrap(rsync), stdin=subprocess.DEVNULL if input is None else subprocess.PIPE,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError:
+            if throttle is not None:
+                throttle.detach()
+            raise
+        if input is not None:
+            self._feed(proc, input)
+        lastActivity = time.monotonic()
+
+        # Drain stderr in the background, keep the tail for the error message
+        errorTail = collections.deque(maxlen=10)
+        def readErrors():
+            nonlocal lastActivity
+            for errorLine in proc.stderr:
+                lastActivity = time.monotonic()
+                errorLine = errorLine.decode('utf-8', 'replace').rstrip()
+                errorTail.append(errorLine)
+                logging.warning('rsync: %s', errorLine)
+        errorReader = threading.Thread(target=readErrors, daemon=True)
+        errorReader.start()
+
+        # Kill rsync if it neither prints nor moves any bytes
+        stalled = threading.Event()
+        finished = threading.Event()
+        def watch():
+            nonlocal lastActivity
+            lastCounter = self._ioCounter(proc.pid)
+            while not finished.wait(min(stallTimeout, 10)):
+                counter = self._ioCounter(proc.pid)
+                if throttle is not None and throttle.isPaused:
+                    lastActivity = time.monotonic()
+                elif counter is not None and counter != lastCounter:
+                    lastCounter = counter
+                    lastActivity = time.monotonic()
+                elif time.monotonic() - lastActivity > stallTimeout:
+                    logging.error('rsync has stalled for %d seconds, killing it', stallTimeout)
+                    stalled.set()
+                    proc.terminate()
+                    try:
+                        proc.wait(10)
+                    except subprocess.TimeoutExpired:
+                        proc.kill()
+                    return
+        if stallTimeout:
+            watchdog = threading.Thread(target=watch, daemon=True)
+            watchdog.start()
+
+        if throttle is not None:
+            throttle.attach(proc)
+        try:
+            # Don't format millions of lines that are never shown
+            debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+            for nextLine in proc.stdout:
+                lastActivity = time.monotonic()
+                nextLine = nextLine.decode('utf-8', 'surrogateescape')
+                if changeLog is not None and changeLog.feed(nextLine):
+                    continue
+                if stats is not None and stats.feed(nextLine):
+                    continue
+                if debug:
+                    logging.debug("rsync: "+nextLine.rstrip())
+
+            # Wait until the process really finished
+            exitcode = proc.wait()
+        finally:
+            if throttle is not None:
+                # Never leave rsync stopped
+                throttle.detach()
+        finished.set()
+        errorReader.join()
+        if stallTimeout:
+            watchdog.join()
+
+        if stalled.is_set():
+            return self.stalledExitCode
+        if exitcode != 0 and exitcode not in self.acceptedExitCodes:
+            logging.error("Rsync failed with exit code %d: %s", exitcode, ' / '.join(errorTail))
+        return exitcode
+
+    def invokeRSync(self, rsync, changeLog : ChangeLog = None, stats : RSyncStats = None,
+            retries = 0, retryDelay = 60, stallTimeout = None, throttle : Throttle = None, input : bytes = None):
+        """ Make the rsync call
+
+        Transfers that fail with a retryable exit code, e.g. a dropped
+        connection, or that stall are retried up to retries times. The delay
+        between attempts starts at retryDelay seconds and doubles each time.
+        Exit codes in acceptedExitCodes are logged, but count as success.
+
+        rsync is paused while throttle finds the hosts under load, if given.
+        input is written to the stdin of each attempt.
+
+        Returns True if rsync succeeded
+        """
 
         result = False
         if self.simulate:
@@ -99,27 +390,277 @@ class Backup:
             result = True
         else:
             try:
-                proc = subprocess.Popen(rsync, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-                
-                # Wait for the rsync process to exit
-                while True:
-                    nextLine = proc.stdout.readline().decode("utf-8")
-                    if not nextLine:
-                        break
-                    logging.debug("rsync: "+nextLine.rstrip())
-                
-                # Wait until the process really finished
-                exitcode = proc.wait()
-                
-                if exitcode == 0:
-                    logging.info("rsync finished successfully")
-                    result = True
-                else:
-                    logging.error("Rsync failed")
+                transferred = 0
+                for attempt in range(retries + 1):
+                    if attempt > 0:
+                        delay = retryDelay * 2 ** (attempt - 1)
+                        logging.warning('Retrying rsync in %d seconds (attempt %d of %d)', delay, attempt + 1, retries + 1)
+                        time.sleep(delay)
+
+                    if stats is not None:
+                        stats.transferredSize = None
+                    with callStats.record('rsync', rsync):
+                        exitcode = self.runRSync(rsync, changeLog, stats, stallTimeout, throttle, input)
+                    if stats is not None and stats.transferredSize is not None:
+                        # Count the bytes of all attempts
+                        transferred += stats.transferredSize
+                        stats.transferredSize = transferred
+
+                    if exitcode == 0:
+                        logging.info("rsync finished successfully")
+                        result = True
+                    elif exitcode in self.acceptedExitCodes:
+                        logging.warning("rsync finished, but %s (exit code %d)", self.acceptedExitCodes[exitcode], exitcode)
+                        result = True
+                    elif exitcode not in self.retryExitCodes:
+                        logging.error("rsync exit code %d can't be retried", exitcode)
+                    else:
+                        continue
+                    break
             except:
                 logging.error("Something went wrong with rsync")
         return result
 
+    def writeChangeLog(self, location : Location, changeLog : ChangeLog, linkTarget, name):
+        """ Completes a change log and stores it in the (incomplete) snapshot
+
+        The change log of the link target is used to find deleted files.
+        """
+        previousLog = None
+        try:
+            if linkTarget is not None:
+                fd, previousLog = tempfile.mkstemp(suffix='.gz')
+                os.close(fd)
+                if not location.readFile(os.path.join(linkTarget, ChangeLog.fileName), previousLog):
+                    os.remove(previousLog)
+                    previousLog = None
+            changeLog.finish(previousLog)
+            logging.info('Changes: %s', changeLog.summary())
+            if not location.writeFile(os.path.join(name, ChangeLog.fileName), changeLog.filePath):
+                logging.warning('Failed to store change log in %s', name)
+        except SshError as e:
+            logging.warning('Failed to store change log: %s', e.message)
+        finally:
+            changeLog.close()
+            if previousLog is not None:
+                os.remove(previousLog)
+
+    def rsyncPathOpts(self, job : dbackup.Job) -> list:
+        """ Runs rsync on the remote host with the priority of the job
+
+        Not if the job already selects the remote rsync with rsyncarg
+        """
+        prefix = job.priority.remotePrefix()
+        if not prefix or not (job.source.isRemote or job.dest.isRemote) \
+                or any(arg.startswith('--rsync-path') for arg in job.rsyncArgs):
+            return []
+        return ['--rsync-path=' + prefix + ' rsync']
+
+    def buildRSync(self, job : dbackup.Job, linkTargetOpts, name, cacheDirs = (), sshOpts = ()):
+        """ Assembles the rsync command that copies the source of a job to dest/name
+
+        For remote to remote jobs, this is the command that runs on the relay
+        host, see relayCommand(). cacheDirs are the directories tagged with
+        CACHEDIR.TAG that are excluded, see scanExcludes(). rsync reads them
+        from stdin, so the command must be given job.excludes.excludeList(cacheDirs)
+
+        sshOpts are added to the ssh command of rsync, unless it runs on the
+        relay host, e.g. to share the connection of a Throttle
+        """
+
+        # The excludes follow rsyncarg, so that filter rules of the job match first
+        rsyncArgs = job.rsyncArgs + job.excludes.rsyncOpts(cacheDirs)
+
+        if job.relay == 'dest':
+            # Pull from the source host into a local path on the dest host
+            rsyncSshArgs = ['--rsh=ssh '+' '.join(job.source.relaySshArgs(job.relayKey))]
+            return ['rsync'] + self.rsyncOpts + rsyncArgs + self.rsyncPathOpts(job) + linkTargetOpts + rsyncSshArgs + \
+                [job.source.rsyncPath(''), os.path.join(job.dest.path, name)]
+        elif job.relay == 'source':
+            # Push from a local path on the source host to the dest host
+            rsyncSshArgs = ['--rsh=ssh '+' '.join(job.dest.relaySshArgs(job.relayKey))]
+            return ['rsync'] + self.rsyncOpts + rsyncArgs + self.rsyncPathOpts(job) + linkTargetOpts + rsyncSshArgs + \
+                [os.path.join(job.source.path, ''), job.dest.rsyncPath(name)]
+
+        if not job.source.isRemote and not job.dest.isRemote:
+            # Between local disks, e.g. when a job is migrated, or with an rsync daemon
+            return ['rsync'] + self.rsyncOpts + rsyncArgs + job.source.transferOpts() + job.dest.transferOpts() + \
+                linkTargetOpts + [job.source.rsyncPath(''), job.dest.rsyncPath(name)]
+
+        # Assemble rsync arguments
+        # ssh args are assembled in job class and completed by the remote location.
+        # Remove 'ssh command' from argument list
+        sshArgs = job.source.sshArgs if job.source.isRemote else job.dest.sshArgs
+        rsyncSshArgsList = list(sshArgs) + list(sshOpts)
+        assert sshArgs.user
+        assert '-l' in rsyncSshArgsList
+        assert '-i' in rsyncSshArgsList
+        assert '-p' in rsyncSshArgsList
+
+        assert job.cert is not None, "A certificate is required for remote locations"
+
+        # The ssh arguments are specified as a string where each argument is separated with a space
+        rsyncSshArgs = ["--rsh=ssh "+' '.join(rsyncSshArgsList)+""]
+
+        return ['rsync'] + self.rsyncOpts + rsyncArgs + self.rsyncPathOpts(job) + \
+            linkTargetOpts + rsyncSshArgs + \
+                [job.source.rsyncPath(''), job.dest.rsyncPath(name)]
+
+    def scanExcludes(self, job : dbackup.Job) -> tuple:
+        """ Walks the source of a job to find what its exclude rules leave out
+
+        rsync can't detect directories tagged with CACHEDIR.TAG, and only
+        reports the totals of what it transferred, so the source is walked
+        once more, without reading any files, where it is located.
+
+        Returns (cacheDirs, saved), where saved maps each rule to [files, bytes]
+        """
+        if not job.excludes:
+            return [], {}
+        try:
+            for result in job.source.runTool('excludes', [job.source.path] + job.excludes.toolArgs()):
+                return result['cachedirs'], result['saved']
+        except (SshError, ScriptError) as e:
+            logging.warning('Could not scan the source of %s for excludes: %s', job, e.message)
+        return [], {}
+
+    def reportExcludes(self, job : dbackup.Job, saved, stats : RSyncStats):
+        """ Logs how much each exclude rule saved, relative to the size of the backup """
+        total = (stats.totalSize or 0) + sum(size for files, size in saved.values())
+        for rule, (files, size) in sorted(saved.items(), key=lambda item: -item[1][1]):
+            logging.info('Excluded from %s by %s: %d files, %d bytes (%.1f%%)', job, rule, files, size,
+                100.0 * size / total if total else 0.0)
+
+    def relayCommand(self, job : dbackup.Job, rsync, sshOpts = ()):
+        """ Wraps an rsync command so that it runs on the relay host
+
+        The data then flows directly between source and dest. Without a
+        relay key, the agent is forwarded with -A, see relayAgent(). sshOpts
+        are added to the ssh command to the relay host.
+
+        Returns rsync unchanged if the job isn't remote to remote
+        """
+        if job.relay is None:
+            return rsync
+        extraArgs = (['-A'] if job.relayKey is None else []) + list(sshOpts) or None
+        return job.relayLocation._buildSshCmd(' '.join(map(shlex.quote, rsync)), extraArgs)
+
+    def relayAgent(self, job : dbackup.Job):
+        """ Context that holds the job's cert in an agent, if it needs to be forwarded """
+        if job.relay is None or job.relayKey is not None or self.simulate:
+            return contextlib.ExitStack()
+        logging.info('Forwarding credentials to %s', job.relayLocation.host)
+        return self._forwardAgent(job.cert)
+
+    @contextlib.contextmanager
+    def _forwardAgent(self, keyFile):
+        with self._agentLock, SshAgent(keyFile):
+            yield
+
+    def estimateTransfer(self, job : dbackup.Job, rsync, incremental = False, input : bytes = None) -> int:
+        """ Estimates the number of bytes that a backup adds to the destination
+
+        With 'preflight = dryrun', rsync --dry-run --stats is run with the
+        same arguments as the backup. Otherwise, an incremental backup is
+        estimated by the median of the earlier incremental runs, so that a
+        full transfer in the history doesn't refuse every later backup. A
+        full backup is estimated by the last transfer. input is the stdin of
+        rsync.
+
+        Returns None if no estimate is available
+        """
+        if job.preflight == 'dryrun' and not self.simulate:
+            stats = RSyncStats()
+            dryRun = rsync[:1] + ['--dry-run'] + RSyncStats.rsyncOpts + rsync[1:]
+            logging.debug('Dry run command: "'+'" "'.join(dryRun)+'"')
+            try:
+                command = self.relayCommand(job, dryRun)
+                with callStats.record('dry run', command):
+                    proc = subprocess.Popen(callStats.wrap(command), stdin=subprocess.DEVNULL if input is None else subprocess.PIPE,
+                        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+                    if input is not None:
+                        self._feed(proc, input)
+                    for line in proc.stdout:
+                        stats.feed(line.decode('utf-8', 'replace'))
+                    exitcode = proc.wait()
+                if exitcode == 0 and stats.transferredSize is not None:
+                    return stats.transferredSize
+                logging.warning('rsync dry run failed, using history to estimate transfer size')
+            except OSError:
+                logging.warning('Could not run rsync dry run')
+
+        if self._stateTracker is None:
+            return None
+        if incremental:
+            history = self._stateTracker.getHistory(job, 'Incremental')
+            return int(statistics.median(history)) if history else None
+        history = self._stateTracker.getHistory(job, 'Transferred')
+        return history[-1] if history else None
+
+    def checkSpace(self, job : dbackup.Job, rsync, incremental = False, input : bytes = None) -> bool:
+        """ Checks that the destination has room for the backup
+
+        incremental is set when the backup is linked to an earlier snapshot
+
+        If not, outdated backups are cleaned and the space is checked again.
+
+        Returns False if the backup should be refused
+        """
+        if job.preflight == 'no':
+            return True
+
+        estimate = self.estimateTransfer(job, rsync, incremental, input)
+        if estimate is None:
+            logging.debug('No estimate of transfer size for %s', job)
+            return True
+        required = int(estimate * self.spaceMargin)
+
+        free = job.dest.freeSpace()
+        if free is None:
+            return True
+        logging.info('Estimated transfer is %d bytes, %d bytes free at %s', estimate, free, str(job.dest))
+        if free >= required:
+            return True
+
+        logging.warning('Not enough space for %s, removing outdated backups before transfer', job)
+        Clean(simulate=self.simulate).CleanJob(job, keep=[self.snapshotName(job) + dbackup.incomplete.suffix])
+
+        free = job.dest.freeSpace()
+        if free is not None and free < required:
+            if self.simulate:
+                logging.warning('Simulated backup would be refused, %d bytes free, %d required', free, required)
+                return True
+            logging.error('Not enough space for %s, %d bytes free, %d required', job, free, required)
+            return False
+        return True
+
+    def replicate(self, job : dbackup.Job) -> int:
+        """ Copies the new snapshot of a job to its extra destinations
+
+        Each copy is a backup of the snapshot, linked to the latest snapshot
+        in that destination, so each destination keeps its own chain. The
+        metadata of the snapshot, like its manifest and change log, isn't
+        copied, each copy gets its own.
+
+        Failures are logged and published as the state of the copy,
+        <job>.dest<n>, as they don't affect the snapshot in dest.
+
+        Returns REPLICA_FAILED if any copy failed, else SUCCESS
+        """
+        result = dbackup.resultcodes.SUCCESS
+        name = self.snapshotName(job)
+        for replica in job.replicas(name):
+            replica.rsyncArgs = replica.rsyncArgs + ['--exclude=/' + manifestTool.metaDir]
+            if self.simulate:
+                logging.info('Simulated copy of %s@%s to %s', job, name, replica.dest)
+                continue
+            logging.info('Copying %s@%s to %s', job, name, replica.dest)
+            replicaResult = self.execute(replica)
+            if replicaResult != dbackup.resultcodes.SUCCESS:
+                logging.error('Copy of %s@%s to %s failed with %d', job, name, replica.dest, replicaResult)
+                result = dbackup.resultcodes.REPLICA_FAILED
+        return result
+
     def execute(self, job : dbackup.Job):
         """
         Arguments:
@@ -137,6 +678,8 @@ class Backup:
         assert self.simulate == job.dest.simulate
 
         logging.info('Starting backup job \"%s\"', job)
+        startTime = time.monotonic()
+        name = self.snapshotName(job)
         logging.debug('Source is %s', job.source.path)
         logging.debug('Destination is %s', job.dest.path)
         self.publishState(job, 'running')
@@ -145,7 +688,7 @@ class Backup:
         # This must be done before source or dest is validated, as the pre-jobs may create them!
         if job.execBefore is not None:
             logging.info("Executing " + job.execBefore)
-            os.system(job.execBefore)
+            callStats.system('exec before', job.execBefore)
 
         # Verify connection to source and destination
         try:
@@ -176,33 +719,83 @@ class Backup:
             return dbackup.resultcodes.SSH_ERROR
         
         # Determine last backup for LinkTarget
-        linkTargetOpts = self.getLinkTargetOpts(job.dest)
+        linkTarget = self.getLinkTarget(job.dest)
+        linkTargetOpts = self.getLinkTargetOpts(job.dest, linkTarget) if job.storage == 'snapshots' else []
 
-        # Assemble rsync arguments
-        # ssh args are assembled in job class.
-        # Remove 'ssh command' from argument list
-        rsyncSshArgsList = list(job.sshArgs)
-        assert job.sshArgs.user
-        assert '-l' in rsyncSshArgsList
-        assert '-i' in rsyncSshArgsList
-        assert '-p' in rsyncSshArgsList
+        # Do the work
+        cacheDirs, saved = self.scanExcludes(job)
+        if cacheDirs:
+            logging.debug('Excluding %d directories tagged with CACHEDIR.TAG', len(cacheDirs))
+        excludeList = job.excludes.excludeList(cacheDirs)
+
+        # The load of the hosts is sampled over the connection of rsync
+        throttle = self.buildThrottle(job)
+        connected = job.relayLocation or (job.source if job.source.isRemote else job.dest)
+        sshOpts = throttle.sshOpts(connected) if throttle is not None else []
+        if job.storage == 'chunks':
+            # The snapshot is made from the mirror after the transfer
+            rsync = self.buildRSync(job, [], chunksTool.mirrorName, cacheDirs, sshOpts)
+        else:
+            rsync = self.buildRSync(job, linkTargetOpts, name + dbackup.incomplete.suffix, cacheDirs, sshOpts)
 
-        assert job.cert is not None, "A certificate is required for remote locations"
+        changeLog = None
+        if job.changeLog and not self.simulate:
+            fd, changeLogPath = tempfile.mkstemp(suffix='.gz')
+            os.close(fd)
+            changeLog = ChangeLog(changeLogPath)
 
-        # The ssh arguments are specified as a string where each argument is separated with a space
-        rsyncSshArgs = ["--rsh=ssh "+' '.join(rsyncSshArgsList)+""]
-
-        # Do the work
-        rsync = ['rsync'] + self.rsyncOpts + job.rsyncArgs + \
-            linkTargetOpts + rsyncSshArgs + \
-                [job.source.rsyncPath(''), job.dest.rsyncPath(self.today + dbackup.incomplete.suffix)]
-        
-        logging.debug('Remote command: "'+'" "'.join(rsync)+'"')
-        backupOk = self.invokeRSync(rsync)
+        backupOk = False
+        try:
+            with self.relayAgent(job):
+                if not self.checkSpace(job, rsync, incremental=linkTarget is not None, input=excludeList):
+                    if job.execAfter is not None:
+                        logging.info("Executing "+job.execAfter)
+                        callStats.system('exec after', job.execAfter)
+                    self.publishState(job, 'failed')
+                    return dbackup.resultcodes.INSUFFICIENT_SPACE
+
+                if changeLog is not None:
+                    rsync[1:1] = ChangeLog.rsyncOpts
+                stats = RSyncStats()
+                rsync[1:1] = RSyncStats.rsyncOpts
+                if job.storage == 'chunks':
+                    rsync[1:1] = self.chunkMirrorOpts
+                elif job.partial:
+                    rsync[1:1] = ['--partial-dir=' + self.partialDir]
+
+                stallTimeout = job.stallTimeout
+                if job.relay is not None and stallTimeout:
+                    # Locally there is only ssh, which sees no I/O but the itemized output.
+                    # rsync on the relay host enforces the timeout itself, and exits with 30
+                    rsync[1:1] = [f'--timeout={stallTimeout}']
+                    stallTimeout = None
+                command = self.relayCommand(job, rsync, sshOpts)
+                logging.debug('Remote command: "'+'" "'.join(command)+'"')
+                backupOk = self.invokeRSync(command, changeLog, stats,
+                    retries=job.retries, retryDelay=job.retryDelay, stallTimeout=stallTimeout, throttle=throttle,
+                    input=excludeList)
+                if backupOk and job.storage == 'chunks':
+                    backupOk = self.storeChunks(job, name + dbackup.incomplete.suffix)
+                if throttle is not None and throttle.pauses:
+                    logging.info('rsync of %s was paused %d times for %.0f s in total', job, throttle.pauses, throttle.pausedTime)
+                    self.publishPaused(job, round(throttle.pausedTime))
+        except SshError as e:
+            logging.error(e.message)
+            return dbackup.resultcodes.SSH_ERROR
+        finally:
+            if changeLog is not None and not backupOk:
+                changeLog.close()
+                os.remove(changeLog.filePath)
+
+        if changeLog is not None and backupOk:
+            self.writeChangeLog(job.dest, changeLog, linkTarget, name + dbackup.incomplete.suffix)
+            os.remove(changeLog.filePath)
         if backupOk:
             try:
-                self.finalizeBackup(job.dest)
-                logging.debug('Finalized backup %s@%s', job, self.today)
+                self.finalizeBackup(job.dest, name, manifest=job.manifest)
+                logging.debug('Finalized backup %s@%s', job, name)
+                if job.catalog:
+                    self.updateCatalog(job)
             except Exception as e:
                 # Ignore errors
                 logging.warning(f'Failed to finalize backup {str(job)}')
@@ -212,20 +805,26 @@ class Backup:
         # Always, even if rsync failed
         if job.execAfter is not None:
             logging.info("Executing "+job.execAfter)
-            os.system(job.execAfter)
+            callStats.system('exec after', job.execAfter)
 
         if backupOk :
             # Backup job completed successfully
             self.publishState(job, 'finished')
-            self.publishLastGood(job, self.today)
+            self.publishLastGood(job, name)
             
             logging.debug('Updating local state tracker')
             if self._stateTracker is not None:
-                self._stateTracker.update(job, self.today)
+                self._stateTracker.update(job, name)
+                if not self.simulate:
+                    self._stateTracker.recordRun(job, stats.transferredSize, time.monotonic() - startTime,
+                        incremental=linkTarget is not None)
 
+            if saved:
+                self.reportExcludes(job, saved, stats)
             logging.info('Backup job \"%s\" finished successfully', job)
 
-            return dbackup.resultcodes.SUCCESS
+            # The snapshot in dest is good, a failed copy has its own result code
+            return self.replicate(job)
         else:
             # Backup failed
             logging.info('Backup job \"%s\" failed', job)
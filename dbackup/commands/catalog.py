@@ -0,0 +1,94 @@
+import logging
+import time
+from typing import List
+
+from ..helpers import SshError, ScriptError, ArgumentError
+
+from ..job import Job
+
+import dbackup.resultcodes
+
+class Catalog:
+    """ Builds the catalog of files in the snapshots of jobs
+
+    The catalog is an SQLite database in the metadata directory of the
+    destination, see dbackup/tools/catalog.py. It is built on the host that
+    holds the destination, and only new snapshots are scanned.
+    """
+
+    def __init__(self, simulate = False):
+        self.simulate = simulate
+
+    def updateJob(self, job : Job) -> int:
+        """ Adds new snapshots of a job to its catalog and prunes removed ones """
+        if self.simulate:
+            logging.info('Simulating catalog of %s', job)
+            return dbackup.resultcodes.SUCCESS
+
+        for stats in job.dest.runTool('catalog', ['build', job.dest.path]):
+            if stats['snapshot'] is not None:
+                logging.info('Cataloged %s@%s: %d files, %d new versions',
+                    job, stats['snapshot'], stats['files'], stats['added'])
+            if stats['pruned']:
+                logging.info('Pruned %d removed snapshots from the catalog of %s', stats['pruned'], job)
+        return dbackup.resultcodes.SUCCESS
+
+    def pruneJob(self, job : Job):
+        """ Removes snapshots that no longer exist from the catalog of a job, if it has one """
+        if self.simulate:
+            return
+        for stats in job.dest.runTool('catalog', ['prune', job.dest.path]):
+            logging.debug('Pruned %d snapshots from the catalog of %s', stats['pruned'], job)
+
+    def execute(self, jobs : List[ Job ]) -> int:
+        for job in jobs:
+            if job.storage == 'chunks':
+                raise ArgumentError(f'Job {job} uses chunk storage, its snapshots can\'t be cataloged')
+
+        result = dbackup.resultcodes.SUCCESS
+        for job in jobs:
+            logging.info(f'Cataloging {job}')
+            try:
+                result = max(result, self.updateJob(job))
+            except SshError as e:
+                logging.error(e.message)
+                result = max(result, dbackup.resultcodes.SSH_ERROR)
+            except ScriptError as e:
+                logging.error(e.message)
+                result = max(result, dbackup.resultcodes.CATALOG_FAILED)
+        return result
+
+class Find:
+    """ Finds files in the catalog of a job """
+
+    def __init__(self, limit = None):
+        self.limit = limit
+
+    def execute(self, job : Job, pattern = None) -> int:
+        """ Prints the versions of the files that match a pattern
+
+        Arguments:
+            job (Job) : The job
+            pattern (str) : Glob pattern, or a part of the path
+        """
+        if job is None or pattern is None:
+            raise ArgumentError('Usage: find <job> <pattern>')
+        if job.storage == 'chunks':
+            raise ArgumentError(f'Job {job} uses chunk storage, which has no catalog')
+
+        args = ['find', job.dest.path, pattern]
+        if self.limit:
+            args += ['--limit', str(self.limit)]
+        try:
+            versions = job.dest.runTool('catalog', args)
+        except ScriptError as e:
+            logging.error(e.message)
+            return dbackup.resultcodes.CATALOG_FAILED
+
+        for version in versions:
+            mtime = time.strftime('%Y-%m-%d %H:%M', time.localtime(version['mtime']))
+            print(f'{version["size"]:>14} {mtime} {version["path"]}')
+            print('    ' + ' '.join(version['snapshots']))
+        if not versions:
+            logging.info('No files matching %s found in the catalog of %s', pattern, job)
+        return dbackup.resultcodes.SUCCESS
@@ -0,0 +1,64 @@
+import logging
+import os
+import tempfile
+
+from ..helpers import ChangeLog
+from ..helpers import SshError, ArgumentError
+
+from ..job import Job
+
+import dbackup.resultcodes
+
+class Changes:
+    """ Shows the change log of a snapshot """
+
+    labels = {
+        ChangeLog.added: 'added',
+        ChangeLog.modified: 'modified',
+        ChangeLog.deleted: 'deleted',
+    }
+
+    def __init__(self, showUnchanged = False):
+        self.showUnchanged = showUnchanged
+
+    def execute(self, job : Job, date = None) -> int:
+        """ Prints what changed in a snapshot
+
+        Arguments:
+            job (Job) : The job
+            date (str) : Snapshot name, or None for the latest snapshot
+        """
+        if job is None:
+            raise ArgumentError('changes requires a job')
+
+        backups = job.dest.getBackups(False)
+        if not backups:
+            logging.error('No backups found for job %s', job)
+            return dbackup.resultcodes.INVALID_ARGUMENT
+        if date is None:
+            date = sorted(backups)[-1]
+        elif date not in backups:
+            raise ArgumentError(f'No backup {date} found for job {job}')
+
+        fd, localPath = tempfile.mkstemp(suffix='.gz')
+        os.close(fd)
+        try:
+            if not job.dest.readFile(os.path.join(date, ChangeLog.fileName), localPath):
+                logging.error('No change log found for %s@%s', job, date)
+                return dbackup.resultcodes.INVALID_ARGUMENT
+
+            counts = { kind: 0 for kind in self.labels }
+            sizes = { kind: 0 for kind in self.labels }
+            for kind, size, path in ChangeLog.read(localPath):
+                if kind in self.labels:
+                    counts[kind] += 1
+                    sizes[kind] += size
+                    print(f'{self.labels[kind]:9} {size:>14} {path}')
+                elif self.showUnchanged:
+                    print(f'{"unchanged":9} {size:>14} {path}')
+
+            print(f'{job}@{date}: ' + ', '.join(f'{counts[k]} {label} ({sizes[k]} bytes)' for k, label in self.labels.items()))
+        finally:
+            os.remove(localPath)
+
+        return dbackup.resultcodes.SUCCESS
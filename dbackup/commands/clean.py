@@ -2,14 +2,20 @@ from typing import List
 
 from ..helpers import getDynamicHost
 from ..location import Location
-from ..helpers import ArgumentError
+from ..helpers import ArgumentError, SshError, ScriptError
+from ..helpers import callStats
+from ..helpers.time import snapshotPattern
 import shutil
 import subprocess
 import os
 import logging
 import re
+import threading
+import collections
+import concurrent.futures
 
 from ..job import Job
+from .catalog import Catalog
 
 import dbackup.resultcodes
 
@@ -18,17 +24,64 @@ class Clean:
     def __init__(self, simulate = True):
         self.simulate = simulate
 
-    def CleanJob(self, job : Job):
+    @staticmethod
+    def latestPerPeriod(backups, prefixLength : int) -> list:
+        """ The latest backup of each period, newest first
+
+        Arguments:
+            backups (list(str)) : Backup names, newest first
+            prefixLength (int) : Length of the name prefix that identifies the
+                period, 13 for the hour (YYYY-MM-DDTHH) and 10 for the day
+        """
+        periods = collections.OrderedDict()
+        for backup in backups:
+            periods.setdefault(backup[:prefixLength], backup)
+        return list(periods.values())
+
+    def selectBackupsToRemove(self, job : Job, backups, keep = None) -> set:
+        """ Figures out which backups of a job are outdated
+
+        Arguments:
+            job (Job) : The job that the backups belong to
+            backups (list(str)) : All backup names, including incomplete ones
+            keep (list(str)) : Names that must not be removed, e.g. an ongoing backup
+
+        Returns the set of names to remove
+        """
+
+        logging.debug('Job %s is set to keep %d hours, %d days and %d months', str(job), job.hoursToKeep, job.daysToKeep, job.monthsToKeep)
+
+        # Convert folder names to dates
+        allBackups = sorted(backups, reverse=True)
+        logging.debug('Backups: ' + ', '.join(allBackups))
+        goodBackups = list(filter(re.compile('^' + snapshotPattern + '$').match, allBackups))
+        #badBackups  = list(filter(re.compile(r'^\d{4}-\d{2}-\d{2}.+$').match, allBackups))
+        # The latest backup of each of the last hours and days, and the first backup on the first of each month
+        hourlyBackups = self.latestPerPeriod(goodBackups, 13)[0:job.hoursToKeep]
+        dailyBackups = self.latestPerPeriod(goodBackups, 10)[0:job.daysToKeep]
+        # Older backups of a month come later and overwrite newer ones, leaving the first
+        monthlyBackups = list({ d[:7]: d for d in goodBackups if d[8:10] == '01' }.values())[0:job.monthsToKeep]
+        logging.debug('Hourly backups: ' + ', '.join(hourlyBackups))
+        logging.debug('Monthly backups: ' + ', '.join(monthlyBackups))
+        logging.debug('Daily backups: ' + ', '.join(dailyBackups))
+
+        # Figure out which backups to keep and which to remove
+        backupsToKeep = set(hourlyBackups).union(set(dailyBackups)).union(set(monthlyBackups)).union(set(keep or []))
+        logging.debug('Keeping: ' + ', '.join(list(backupsToKeep)))
+        return set(allBackups) - backupsToKeep
+
+    def CleanJob(self, job : Job, keep = None):
         """ Cleans old backups from a job
 
         Arguments:
             job, str : The config section that describes the backup job to clean
+            keep (list(str)) : Names that must not be removed, e.g. an ongoing backup
 
         """
 
         assert isinstance(job, Job)
         job.dest.simulate = self.simulate
-        assert job.dest.isRemote != job.dest.isLocal
+        assert [job.dest.isRemote, job.dest.isLocal, job.dest.isDaemon].count(True) == 1
 
         logging.debug('Destination location path is ' + job.dest.path)
         logging.debug('Destination is local:'+str(job.dest.isLocal))
@@ -36,46 +89,163 @@ class Clean:
         # List all files in dest folder
         backups = job.dest.getBackups(True)
         
-        # Get config parameters
-        logging.debug('Job %s is set to keep %d days and %d months', str(job), job.daysToKeep, job.monthsToKeep)
-                    
         if backups is None:
             logging.warning('No backups found for job %s', job)
             return True
-            
-        # Convert folder names to dates
-        allBackups = sorted(backups, reverse=True)
-        logging.debug('Backups: ' + ', '.join(allBackups))
-        goodBackups = list(filter(re.compile(r'^\d{4}-\d{2}-\d{2}$').match, allBackups))
-        #badBackups  = list(filter(re.compile(r'^\d{4}-\d{2}-\d{2}.+$').match, allBackups))
-        monthlyBackups = [ d for d in goodBackups if d[8:10] == '01'][0:job.monthsToKeep]
-        dailyBackups = goodBackups[0:job.daysToKeep]
-        logging.debug('Monthly backups: ' + ', '.join(monthlyBackups))
-        logging.debug('Daily backups: ' + ', '.join(dailyBackups))
-        
-        # Figure out which backups to keep and which to remove
-        backupsToKeep = set(dailyBackups).union(set(monthlyBackups))
-        logging.debug('Keeping: ' + ', '.join(list(backupsToKeep)))
-        backupsToRemove = set(allBackups) - backupsToKeep
+
+        backupsToRemove = self.selectBackupsToRemove(job, backups, keep)
         
         if backupsToRemove:
             logging.info("Removing outdated backups " + ', '.join(list(backupsToRemove)))
-            job.dest.deleteChild(list(backupsToRemove))
+            if not job.dest.deleteChild(list(backupsToRemove)):
+                logging.error('Failed to clean job %s', job)
+                return False
                 
             logging.info('Cleaned job %s', job)
+            self.pruneCatalog(job)
         else:
             logging.info('No backups to remove for job %s', job)
+        # Also when nothing was removed, to continue an earlier collection
+        self.collectChunks(job)
+        return True
+
+    def pruneCatalog(self, job : Job):
+        """ Removes the deleted snapshots from the catalog of a job """
+        if not job.catalog:
+            return
+        try:
+            Catalog(simulate=self.simulate).pruneJob(job)
+        except (SshError, ScriptError) as e:
+            logging.warning('Failed to prune the catalog of %s: %s', job, e.message)
+
+    def collectChunks(self, job : Job):
+        """ Removes the chunks that only deleted snapshots referred to
+
+        The collection stops after the gc time of the job and continues in
+        the next clean
+        """
+        if job.storage != 'chunks' or self.simulate:
+            return
+        args = ['gc', job.dest.path] + (['--max-seconds', str(job.gcTime)] if job.gcTime else [])
+        try:
+            for stats in job.dest.runTool('chunks', args):
+                logging.info('Released %d snapshots of %s, removed %d chunks with %d bytes, %d chunks with %d bytes are stored',
+                    stats['released'], job, stats['removed'], stats['freed'], stats['chunks'], stats['size'])
+                if stats['pending'] or stats['garbage']:
+                    logging.info('Garbage collection of %s continues in the next clean', job)
+        except (SshError, ScriptError) as e:
+            logging.warning('Failed to collect the chunks of %s: %s', job, e.message)
+
+    def cleanHost(self, jobs : List[ Job ]) -> int:
+        """ Cleans jobs whose destinations are on the same host
+
+        All destinations are listed in one call to the host, retention is
+        worked out locally and all deletions are sent in one call.
+        """
+
+        locationType = type(jobs[0].dest)
+        for job in jobs:
+            job.dest.simulate = self.simulate
+
+        listings = locationType.listDirs([ job.dest for job in jobs ])
+
+        requests = []
+        requestJobs = []
+        for job, listing in zip(jobs, listings):
+            backups = Location.filterBackups(listing, True)
+            if not backups:
+                logging.warning('No backups found for job %s', job)
+                continue
+            backupsToRemove = self.selectBackupsToRemove(job, backups)
+            if backupsToRemove:
+                logging.info('Removing outdated backups of %s: %s', job, ', '.join(sorted(backupsToRemove)))
+                requests.append((job.dest, sorted(backupsToRemove)))
+                requestJobs.append(job)
+            else:
+                logging.info('No backups to remove for job %s', job)
+
+        result = dbackup.resultcodes.SUCCESS
+        if requests:
+            for job, success in zip(requestJobs, locationType.deleteChildren(requests)):
+                if success:
+                    logging.info('Cleaned job %s', job)
+                    self.pruneCatalog(job)
+                else:
+                    logging.error('Failed to clean job %s', job)
+                    result = dbackup.resultcodes.CLEAN_FAILED
+        for job in jobs:
+            self.collectChunks(job)
+        return result
 
-            
     def execute(self, jobs : List[ Job ] ) -> int:
         """ Cleans a job, i.e. removes outdated backups
+
+        Jobs are grouped by the host of their destination, so that each
+        host is only contacted twice no matter how many jobs it holds.
+
         Arguments
         ---------
             jobs is a list of jobs to clean
         """
+        hosts = collections.OrderedDict()
+        # Each destination of a job keeps its own chain
+        for job in [ destJob for job in jobs for destJob in job.destJobs() ]:
+            hosts.setdefault(job.dest.hostKey, []).append(job)
+
         result = dbackup.resultcodes.SUCCESS
-        for job in jobs:
-            logging.info(f'Cleaning {job}')
-            if not self.CleanJob(job):
-                result = dbackup.resultcodes.CLEAN_FAILED
+        for host, hostJobs in hosts.items():
+            logging.info('Cleaning ' + ', '.join(map(str, hostJobs)) + ' on ' + host)
+            try:
+                # Jobs on the same host share the deletion call, it runs with the priority of the first
+                name = ', '.join(map(str, hostJobs))
+                with callStats.job(name, priority=hostJobs[0].priority):
+                    result = max(result, self.cleanHost(hostJobs))
+                cpu, io = callStats.jobUsage(name)
+                logging.info('Cleaning %s used %.1f s of CPU and %d bytes of disk I/O', name, cpu, io)
+            except SshError as e:
+                logging.error(e.message)
+                result = max(result, dbackup.resultcodes.CLEAN_FAILED)
+        return result
+
+class CleanPipeline:
+    """ Cleans jobs in the background while the next job is backed up
+
+    Jobs are submitted as their backups finish. Deletions run in a pool of
+    threads, but at most maxPerFilesystem at a time on each destination
+    filesystem, so that parallel rm -rf don't compete for the same disk.
+    """
+
+    def __init__(self, cleaner : Clean, maxPerFilesystem = 1, workers = 4):
+        self.cleaner = cleaner
+        self.maxPerFilesystem = maxPerFilesystem
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self._limits = collections.defaultdict(lambda: threading.BoundedSemaphore(self.maxPerFilesystem))
+        self._lock = threading.Lock()
+        self._futures = []
+
+    def _clean(self, job : Job) -> int:
+        with self._lock:
+            limit = self._limits[job.dest.filesystemKey]
+        with limit, callStats.job(job):
+            return self.cleaner.execute([job])
+
+    def submit(self, job : Job):
+        """ Starts cleaning a job in the background """
+        logging.debug('Queueing clean of %s', job)
+        self._futures.append(self._executor.submit(self._clean, job))
+
+    def wait(self) -> int:
+        """ Waits for all submitted jobs to be cleaned
+
+        Returns the combined result code
+        """
+        result = dbackup.resultcodes.SUCCESS
+        for future in concurrent.futures.as_completed(self._futures):
+            try:
+                result = max(result, future.result())
+            except Exception as e:
+                logging.error('Clean failed: %s', str(e))
+                result = max(result, dbackup.resultcodes.CLEAN_FAILED)
+        self._futures = []
+        self._executor.shutdown()
         return result
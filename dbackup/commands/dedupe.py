@@ -0,0 +1,76 @@
+import collections
+import logging
+import os
+from typing import List
+
+from ..helpers import SshError, ScriptError, ArgumentError
+
+from ..job import Job
+
+import dbackup.resultcodes
+
+class Dedupe:
+    """ Replaces identical files in different jobs with hard links
+
+    Jobs are grouped by the filesystem of their destination, as far as it is
+    known, since hard links can't cross filesystems. The dedupe tool is run
+    once per group with the snapshots of all jobs in it. The index is stored
+    in the metadata directory of the common parent of the destinations, so
+    the same set of jobs always uses the same index.
+    """
+
+    def __init__(self, simulate = False, workers = None):
+        self.simulate = simulate
+        self.workers = workers
+
+    def dedupeFilesystem(self, jobs : List[ Job ]) -> int:
+        """ Deduplicates the destinations of jobs on the same filesystem """
+
+        snapshots = []
+        for job in jobs:
+            backups = job.dest.getBackups(False)
+            if backups:
+                snapshots += [ os.path.join(job.dest.path, backup) for backup in sorted(backups) ]
+            else:
+                logging.warning('No backups found for job %s', job)
+        if not snapshots:
+            return dbackup.resultcodes.SUCCESS
+
+        root = os.path.commonpath([ job.dest.path for job in jobs ])
+        args = ['--index', os.path.join(root, '.dbackup', 'dedupe.gz')]
+        if self.workers:
+            args += ['--workers', str(self.workers)]
+        if self.simulate:
+            args += ['--dry-run']
+
+        location = jobs[0].dest
+        for stats in location.runTool('dedupe', args + snapshots):
+            logging.info('Deduplicated %s: scanned %d snapshots, %d new inodes, hashed %d files',
+                location.hostKey, stats['snapshots'], stats['newInodes'], stats['hashed'])
+            logging.info('Linked %d files, %d inodes, saving %d bytes%s',
+                stats['linked'], stats['inodes'], stats['saved'], ' (simulated)' if self.simulate else '')
+            for skipped in stats['skipped']:
+                logging.warning('Skipped %s, it is not on the same filesystem', skipped)
+        return dbackup.resultcodes.SUCCESS
+
+    def execute(self, jobs : List[ Job ]) -> int:
+        """ Deduplicates files across the jobs """
+
+        filesystems = collections.OrderedDict()
+        for job in jobs:
+            if job.storage == 'chunks':
+                raise ArgumentError(f'Job {job} uses chunk storage, which is already deduplicated')
+            filesystems.setdefault(job.dest.filesystemKey, []).append(job)
+
+        result = dbackup.resultcodes.SUCCESS
+        for filesystem, filesystemJobs in filesystems.items():
+            logging.info('Deduplicating ' + ', '.join(map(str, filesystemJobs)) + ' on ' + filesystem)
+            try:
+                result = max(result, self.dedupeFilesystem(filesystemJobs))
+            except SshError as e:
+                logging.error(e.message)
+                result = max(result, dbackup.resultcodes.SSH_ERROR)
+            except ScriptError as e:
+                logging.error(e.message)
+                result = max(result, dbackup.resultcodes.DEDUPE_FAILED)
+        return result
@@ -0,0 +1,89 @@
+import logging
+import os
+
+from ..helpers import SshError, ScriptError, ArgumentError
+
+from ..job import Job
+
+import dbackup.resultcodes
+
+class Diff:
+    """ Compares two snapshots without reading the files
+
+    Files are compared by inode on the host that holds the snapshots, see
+    dbackup/tools/diff.py. Without dates, the hardlink efficiency of each
+    pair of consecutive snapshots is shown instead, which shows when
+    link-dest stopped working.
+    """
+
+    def __init__(self, workers = 8):
+        self.workers = workers
+
+    def runDiff(self, job : Job, before, after, summary = False) -> list:
+        return job.dest.runTool('diff', [os.path.join(job.dest.path, before), os.path.join(job.dest.path, after),
+            '--workers', str(self.workers)] + (['--summary'] if summary else []))
+
+    @staticmethod
+    def formatEfficiency(result) -> str:
+        if result['efficiency'] is None:
+            return 'n/a'
+        return f'{100 * result["efficiency"]:.1f}%'
+
+    def execute(self, job : Job, before = None, after = None) -> int:
+        """ Prints the files that differ between two snapshots
+
+        Arguments:
+            job (Job) : The job
+            before (str) : Older snapshot, or None to show all consecutive snapshots
+            after (str) : Newer snapshot or 'latest'
+        """
+        if job is None or (before is None) != (after is None):
+            raise ArgumentError('Usage: diff <job> [<date> <date>]')
+        if job.storage == 'chunks':
+            raise ArgumentError(f'Job {job} uses chunk storage, its snapshots can\'t be compared')
+
+        backups = sorted(job.dest.getBackups(False))
+        if before is None:
+            return self.showEfficiency(job, backups)
+
+        if after == 'latest' and backups:
+            after = backups[-1]
+        for date in (before, after):
+            if date not in backups:
+                raise ArgumentError(f'No backup {date} found for job {job}')
+        if before > after:
+            before, after = after, before
+
+        try:
+            results = self.runDiff(job, before, after)
+        except (SshError, ScriptError) as e:
+            logging.error(e.message)
+            return dbackup.resultcodes.DIFF_FAILED
+
+        summary = results.pop()
+        for result in sorted(results, key=lambda result: result['path']):
+            print(f'{result["kind"]:9} {result["size"]:>14} {result["path"]}')
+
+        totals = summary['totals']
+        print(f'{job} {before}..{after}: ' + ', '.join(f'{totals[kind][0]} {kind} ({totals[kind][1]} bytes)'
+            for kind in ('added', 'removed', 'modified', 'unchanged')))
+        print(f'Hardlink efficiency: {self.formatEfficiency(summary)}')
+        if totals['unlinked'][0]:
+            logging.warning('%d modified files (%d bytes) have the same size and time, but are not hard linked',
+                totals['unlinked'][0], totals['unlinked'][1])
+        return dbackup.resultcodes.SUCCESS
+
+    def showEfficiency(self, job : Job, backups) -> int:
+        """ Prints the hardlink efficiency between each pair of consecutive snapshots """
+        result = dbackup.resultcodes.SUCCESS
+        for before, after in zip(backups, backups[1:]):
+            try:
+                summary = self.runDiff(job, before, after, summary=True)[-1]
+            except (SshError, ScriptError) as e:
+                logging.error(e.message)
+                result = dbackup.resultcodes.DIFF_FAILED
+                continue
+            totals = summary['totals']
+            print(f'{after}: {self.formatEfficiency(summary):>6} linked, {totals["modified"][0]} modified '
+                f'({totals["unlinked"][0]} unlinked), {totals["added"][0]} added, {totals["removed"][0]} removed')
+        return result
@@ -0,0 +1,116 @@
+import json
+import logging
+import os
+import sys
+import time
+
+from ..helpers import SshError, ScriptError, ArgumentError
+from ..tools import export as exportTool
+
+from ..job import Job
+
+import dbackup.resultcodes
+
+class Export:
+    """ Exports a snapshot as a zstd compressed tar archive
+
+    The archive is created on the host that holds the snapshots by
+    dbackup/tools/export.py and compressed there by zstd on all cores, so
+    only compressed data is transferred. It is streamed to the output
+    without temporary files.
+
+    With since, the archive only holds what changed since an earlier
+    snapshot, see dbackup/tools/export.py.
+    """
+
+    compressor = 'zstd -T0 -q -c'
+
+    def __init__(self, output = '-', since = None, simulate = False):
+        """
+        Arguments:
+            output (str) : File to write the archive to, or - for stdout
+            since (str) : Snapshot name to export the changes since, or None
+        """
+        self.output = output
+        self.since = since
+        self.simulate = simulate
+
+    def resolve(self, job : Job, date) -> tuple:
+        """ Returns (date, since) as snapshot names """
+        backups = sorted(job.dest.getBackups(False))
+        if not backups:
+            raise ArgumentError(f'No backups found for job {job}')
+        if date == 'latest':
+            date = backups[-1]
+        elif date not in backups:
+            raise ArgumentError(f'No backup {date} found for job {job}')
+        since = self.since
+        if since == 'previous':
+            older = [ name for name in backups if name < date ]
+            if not older:
+                raise ArgumentError(f'No backup before {date} found for job {job}')
+            since = older[-1]
+        elif since is not None and since not in backups:
+            raise ArgumentError(f'No backup {since} found for job {job}')
+        if since is not None and since >= date:
+            raise ArgumentError(f'Backup {since} is not older than {date}')
+        return date, since
+
+    def execute(self, job : Job, date = None) -> int:
+        """ Writes a snapshot of a job as an archive
+
+        Arguments:
+            job (Job) : The job
+            date (str) : Snapshot name, or 'latest'
+        """
+        if job is None or date is None:
+            raise ArgumentError('Usage: export <job> <date>')
+        if job.storage == 'chunks':
+            raise ArgumentError(f'Job {job} uses chunk storage, restore the snapshot and export that instead')
+
+        date, since = self.resolve(job, date)
+        args = [ os.path.join(job.dest.path, date) ]
+        if since is not None:
+            args += [ '--previous', os.path.join(job.dest.path, since) ]
+        logging.info('Exporting %s@%s%s to %s', job, date, f' since {since}' if since else '',
+            'stdout' if self.output == '-' else self.output)
+        if self.simulate:
+            return dbackup.resultcodes.SUCCESS
+
+        startTime = time.monotonic()
+        try:
+            if self.output == '-':
+                sys.stdout.flush()
+                stderr = job.dest.streamTool('export', args, sys.stdout.buffer, pipe=self.compressor)
+                size = None
+            else:
+                with open(self.output, 'wb') as outFile:
+                    stderr = job.dest.streamTool('export', args, outFile, pipe=self.compressor)
+                size = os.path.getsize(self.output)
+        except (SshError, ScriptError) as e:
+            logging.error(e.message)
+            return dbackup.resultcodes.EXPORT_FAILED
+        except OSError as e:
+            logging.error('Could not write %s: %s', self.output, e)
+            return dbackup.resultcodes.EXPORT_FAILED
+        duration = max(time.monotonic() - startTime, 1e-6)
+
+        stats = None
+        for line in stderr.decode('utf-8', 'replace').splitlines():
+            if line.startswith(exportTool.summaryPrefix):
+                stats = json.loads(line[len(exportTool.summaryPrefix):])
+            elif line.strip():
+                logging.warning(line)
+        if stats is None:
+            logging.error('Export of %s@%s did not complete', job, date)
+            return dbackup.resultcodes.EXPORT_FAILED
+
+        logging.info('Exported %d files and %d directories, %d bytes in %.1f s, %.1f MB/s%s',
+            stats['files'], stats['dirs'], stats['bytes'], duration, stats['bytes'] / duration / 1e6,
+            f', {size} bytes compressed' if size is not None else '')
+        if since is not None:
+            logging.info('Skipped %d unchanged files, %d entries deleted since %s',
+                stats['unchanged'], stats['deleted'], since)
+        if stats['unreadable']:
+            logging.warning('%d files could not be read', stats['unreadable'])
+        return dbackup.resultcodes.SUCCESS
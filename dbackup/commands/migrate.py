@@ -0,0 +1,110 @@
+import copy
+import logging
+import time
+
+from ..helpers import SshError, ScriptError, ArgumentError
+from ..helpers import RSyncStats
+import dbackup.incomplete
+
+from ..job import Job
+from .backup import Backup
+from .catalog import Catalog
+
+import dbackup.resultcodes
+
+class Migrate:
+    """ Copies all snapshots of a job to a new destination
+
+    Copying the whole chain with rsync -H needs memory for every inode and
+    easily runs out. Instead, the snapshots are copied one at a time, oldest
+    first, each linked with --link-dest to the previously copied snapshot.
+    Unchanged files then become hard links in the new destination as well.
+
+    Each snapshot is copied into <date>.incomplete and renamed when done,
+    so an interrupted migration continues with the first snapshot that is
+    missing in the new destination, and partially copied files are resumed.
+    """
+
+    def __init__(self, stateTracker = None, simulate = False):
+        self.stateTracker = stateTracker
+        self.simulate = simulate
+
+    def copySnapshot(self, backup : Backup, job : Job, target, name, previous) -> RSyncStats:
+        """ Copies one snapshot, returns the rsync statistics or None if it failed """
+        copyJob = job.copyJob(name, target, f'{job}.migrate')
+        rsync = backup.buildRSync(copyJob, backup.getLinkTargetOpts(target, previous) if previous else [],
+            name + dbackup.incomplete.suffix)
+        stats = RSyncStats()
+        rsync[1:1] = RSyncStats.rsyncOpts + ['--partial-dir=' + Backup.partialDir]
+        with backup.relayAgent(copyJob):
+            command = backup.relayCommand(copyJob, rsync)
+            logging.debug('Migrate command: "' + '" "'.join(command) + '"')
+            if not backup.invokeRSync(command, stats=stats, retries=job.retries, retryDelay=job.retryDelay,
+                    stallTimeout=job.stallTimeout):
+                return None
+        backup.finalizeBackup(target, name)
+        return stats
+
+    def execute(self, job : Job, newDest = None) -> int:
+        """ Copies the snapshots of a job to newDest, local or user@host:path """
+        if job is None or newDest is None:
+            raise ArgumentError('Usage: migrate <job> <new dest>')
+        if job.storage == 'chunks':
+            raise ArgumentError(f'Job {job} uses chunk storage, copy its destination directory instead')
+
+        target = job.makeLocation(newDest, self.simulate)
+        target.priority = job.priority
+        if target.spec == job.dest.spec:
+            raise ArgumentError(f'{newDest} is already the destination of job {job}')
+
+        try:
+            backups = sorted(job.dest.getBackups(False) or [])
+            if not backups:
+                logging.error('No backups found for job %s', job)
+                return dbackup.resultcodes.INVALID_ARGUMENT
+            if not target.validate() and not self.simulate and not target.create():
+                logging.error('Could not create %s', newDest)
+                return dbackup.resultcodes.FAILED_TO_CREATE_DESTINATION
+            migrated = set(target.getBackups(False) or []) if target.validate() else set()
+        except SshError as e:
+            logging.error(e.message)
+            return dbackup.resultcodes.SSH_ERROR
+
+        backup = Backup(None, simulate=self.simulate)
+        startTime = time.monotonic()
+        transferred = 0
+        previous = None
+        for n, name in enumerate(backups):
+            if name in migrated:
+                logging.debug('%s@%s is already migrated', job, name)
+                previous = name
+                continue
+            logging.info('Migrating %s@%s (%d of %d)%s', job, name, n + 1, len(backups),
+                f', linked to {previous}' if previous else '')
+            try:
+                stats = self.copySnapshot(backup, job, target, name, previous)
+            except SshError as e:
+                logging.error(e.message)
+                stats = None
+            if stats is None:
+                logging.error('Migration of %s stopped at %s, run it again to continue', job, name)
+                return dbackup.resultcodes.MIGRATE_FAILED
+            transferred += stats.transferredSize or 0
+            previous = name
+
+        logging.info('Migrated %d snapshots of %s to %s, %d bytes in %.0f s', len(backups), job, newDest,
+            transferred, time.monotonic() - startTime)
+
+        result = dbackup.resultcodes.SUCCESS
+        if job.catalog:
+            try:
+                migratedJob = copy.copy(job)
+                migratedJob.dest = target
+                Catalog(simulate=self.simulate).updateJob(migratedJob)
+            except (SshError, ScriptError) as e:
+                logging.warning('Failed to build the catalog of %s: %s', newDest, e.message)
+                result = dbackup.resultcodes.CATALOG_FAILED
+        if self.stateTracker is not None and not self.simulate:
+            self.stateTracker.update(job, backups[-1])
+        logging.info('Change dest of job %s to %s to use the new destination', job, newDest)
+        return result
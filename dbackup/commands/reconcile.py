@@ -0,0 +1,133 @@
+import collections
+import concurrent.futures
+import logging
+import threading
+import time
+from typing import List
+
+from ..helpers import StateTracker
+from ..helpers import SshError
+from ..location import Location
+
+from ..job import Job
+
+import dbackup.resultcodes
+
+class Reconcile:
+    """ Rebuilds the state of the jobs from their destinations
+
+    The latest complete snapshot in the destination of each job is recorded
+    as its last good backup, so that check and report are right after the
+    state file was lost, or when the backups were made by another
+    controller.
+
+    Destinations on the same host are listed in one call, and the hosts are
+    listed in parallel. A host that doesn't answer within timeout seconds
+    is skipped, and the state of its jobs is left as it was. That includes
+    local destinations, e.g. on a hung network mount. The timeout counts
+    from when the listing of the host starts, not while it waits for one of
+    the workers.
+    """
+
+    def __init__(self, stateTracker : StateTracker, workers = 16, timeout = 60, simulate = False):
+        self.stateTracker = stateTracker
+        self.workers = workers
+        self.timeout = timeout
+        self.simulate = simulate
+
+    def listHost(self, jobs : List[ Job ]) -> list:
+        """ The complete snapshots in the destination of each job, or None """
+        listings = type(jobs[0].dest).listDirs([ job.dest for job in jobs ], timeout=self.timeout)
+        return [ Location.filterBackups(listing) for listing in listings ]
+
+    def startListing(self, jobs : List[ Job ], slots : threading.Semaphore) -> concurrent.futures.Future:
+        """ Lists the destinations of jobs on the same host in the background
+
+        Runs in a daemon thread rather than an executor, whose threads are
+        joined when the process exits, so a listing that hangs doesn't keep
+        dbackup from exiting. The listing waits for one of slots first.
+
+        The returned future has the time the listing started, or None, in
+        started. Its release() frees the slot of a listing that is given up,
+        so that the next host can start.
+        """
+        future = concurrent.futures.Future()
+        future.started = None
+        released = threading.Lock()
+        def release():
+            # Once, by whichever comes first of the listing and the caller
+            if released.acquire(blocking=False):
+                slots.release()
+        future.release = release
+        def run():
+            slots.acquire()
+            try:
+                if not future.set_running_or_notify_cancel():
+                    return
+                future.started = time.monotonic()
+                try:
+                    future.set_result(self.listHost(jobs))
+                except Exception as e:
+                    future.set_exception(e)
+            finally:
+                release()
+        threading.Thread(target=run, daemon=True).start()
+        return future
+
+    def reconcileJob(self, job : Job, backups) -> bool:
+        """ Records the latest of backups as the last good backup of job
+
+        Returns False if the job has no backups
+        """
+        if not backups:
+            logging.warning('No complete backups found for job %s', job)
+            return False
+        latest = max(backups)
+        previous = self.stateTracker.getLastGood(job)
+        if latest == previous:
+            logging.info('Job %s is up to date, last good backup %s', job, latest)
+            return True
+        logging.info('Job %s: last good backup %s, was %s', job, latest, previous or 'unknown')
+        print(f'{job}: {previous or "-"} -> {latest}')
+        if not self.simulate:
+            self.stateTracker.update(job, latest)
+        return True
+
+    def execute(self, jobs : List[ Job ]) -> int:
+        hosts = collections.OrderedDict()
+        for job in jobs:
+            hosts.setdefault(job.dest.hostKey, []).append(job)
+
+        result = dbackup.resultcodes.SUCCESS
+        slots = threading.Semaphore(max(1, self.workers))
+        futures = [ (host, hostJobs, self.startListing(hostJobs, slots)) for host, hostJobs in hosts.items() ]
+
+        # Wait for all hosts at once, each for timeout seconds after its listing started
+        pending = set(future for host, hostJobs, future in futures)
+        expired = set()
+        while pending:
+            now = time.monotonic()
+            for future in list(pending):
+                if not future.done() and future.started is not None and now - future.started > self.timeout:
+                    pending.discard(future)
+                    expired.add(future)
+                    future.release()
+            deadlines = [ future.started + self.timeout - now for future in pending if future.started is not None ]
+            # Those that haven't started are checked again in a moment
+            pending = concurrent.futures.wait(pending, timeout=max(0, min(deadlines + [ 0.5 ]))).not_done
+
+        for host, hostJobs, future in futures:
+            if future in expired:
+                logging.error('Could not list the backups on %s: no answer within %s s', host, self.timeout)
+                result = max(result, dbackup.resultcodes.SSH_ERROR)
+                continue
+            try:
+                listings = future.result()
+            except SshError as e:
+                logging.error('Could not list the backups on %s: %s', host, e.message)
+                result = max(result, dbackup.resultcodes.SSH_ERROR)
+                continue
+            for job, backups in zip(hostJobs, listings):
+                if not self.reconcileJob(job, backups):
+                    result = max(result, dbackup.resultcodes.BAD_JOBS)
+        return result
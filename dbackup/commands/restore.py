@@ -0,0 +1,157 @@
+import concurrent.futures
+import logging
+import os
+import tempfile
+import time
+
+from ..helpers import SshError, ScriptError, ArgumentError
+from ..helpers import RSyncStats
+from ..helpers import callStats
+
+from ..job import Job
+from ..tools import chunks as chunksTool
+from ..tools import manifest as manifestTool
+from .backup import Backup
+
+import dbackup.resultcodes
+
+class Restore:
+    """ Restores a path from a snapshot
+
+    The restored directory is split into streams of about the same size on
+    the host that holds the snapshots (see dbackup/tools/restore.py), and the
+    streams are transferred by parallel rsync processes. A final rsync of
+    the whole path then restores the directory attributes and picks up
+    anything the streams missed, which is cheap since the files are in place.
+
+    Files in the target that already match the snapshot are skipped, by size
+    and modification time or by checksum. The .dbackup metadata of the
+    snapshot isn't restored when its root is.
+    """
+
+    rsyncOpts = ['-ah', '--numeric-ids']
+
+    def __init__(self, streams = 4, checksum = False, simulate = False):
+        self.streams = max(1, streams)
+        self.checksum = checksum
+        self.simulate = simulate
+
+    def rshOpts(self, job : Job, target) -> list:
+        """ The ssh options for rsync, for the one of dest and target that is remote """
+        remote = [ l for l in (job.dest, target) if l.isRemote ]
+        if len(remote) > 1:
+            raise ArgumentError('Restoring from a remote destination to another remote host is not supported')
+        if remote:
+            return ['--rsh=ssh ' + ' '.join(remote[0].sshArgs)]
+        return []
+
+    def snapshotPath(self, job : Job, date, path) -> str:
+        """ Path relative to the snapshot root
+
+        Absolute paths inside the source of the job are accepted as well
+        """
+        sourceRoot = job.source.path.rstrip('/')
+        if path == sourceRoot or path.startswith(sourceRoot + '/'):
+            path = path[len(sourceRoot):]
+        return os.path.normpath(os.path.join(date, path.lstrip('/')))
+
+    def buildRSync(self, job : Job, target, sourcePath, filesFrom = None, exclude = ()) -> list:
+        rsync = ['rsync'] + self.rsyncOpts + RSyncStats.rsyncOpts + self.rshOpts(job, target) + \
+            job.dest.transferOpts() + target.transferOpts()
+        rsync += [ '--exclude=/' + name for name in exclude ]
+        if self.checksum:
+            rsync += ['--checksum']
+        if self.simulate:
+            rsync += ['--dry-run']
+        if filesFrom is not None:
+            rsync += ['-r', '--from0', '--files-from=' + filesFrom]
+        return rsync + [ job.dest.rsyncPath(sourcePath), target.rsyncPath('') ]
+
+    def removeStaging(self, job : Job, staging):
+        """ Removes the files that were rebuilt from chunks, if any """
+        if staging is not None and not job.dest.deleteChild(staging):
+            logging.warning('Could not remove %s in %s', staging, job.dest)
+
+    def execute(self, job : Job, date = None, path = None, target = None) -> int:
+        """ Restores a path of a snapshot into a target directory
+
+        Arguments:
+            job (Job) : The job
+            date (str) : Snapshot name, or 'latest'
+            path (str) : Path to restore, relative to the source of the job
+            target (str) : Directory to restore into, local or user@host:path
+        """
+        if job is None or date is None or path is None or target is None:
+            raise ArgumentError('Usage: restore <job> <date> <path> <target>')
+
+        backups = job.dest.getBackups(False)
+        if not backups:
+            logging.error('No backups found for job %s', job)
+            return dbackup.resultcodes.INVALID_ARGUMENT
+        if date == 'latest':
+            date = sorted(backups)[-1]
+        elif date not in backups:
+            raise ArgumentError(f'No backup {date} found for job {job}')
+
+        targetLocation = job.makeLocation(target, self.simulate)
+        sourcePath = self.snapshotPath(job, date, path)
+        # Entries of the snapshot root that aren't part of the backup
+        exclude = [ manifestTool.metaDir ] if sourcePath == date else []
+        logging.info('Restoring %s@%s:%s to %s', job, date, sourcePath[len(date):] or '/', target)
+
+        startTime = time.monotonic()
+        staging = None
+        try:
+            if job.storage == 'chunks':
+                # The files are rebuilt from the chunks next to the store, and restored from there
+                staging = os.path.join(chunksTool.storeName, 'restore')
+                job.dest.runTool('chunks', ['extract', job.dest.path, date, os.path.join(staging, date),
+                    '--path', sourcePath[len(date):]])
+                sourcePath = os.path.join(staging, sourcePath)
+            plan = job.dest.runTool('restore', ['plan', os.path.join(job.dest.path, sourcePath),
+                '--streams', str(self.streams)] + [ '--exclude=' + name for name in exclude ])[0]
+            if plan['dir']:
+                sourcePath = os.path.join(sourcePath, '')
+            if not targetLocation.create():
+                logging.error('Could not create %s', target)
+                return dbackup.resultcodes.FAILED_TO_CREATE_DESTINATION
+        except (SshError, ScriptError) as e:
+            logging.error(e.message)
+            self.removeStaging(job, staging)
+            return dbackup.resultcodes.RESTORE_FAILED
+        logging.info('Restoring %d bytes in %d streams', plan['bytes'], len(plan['streams']))
+
+        rsyncRunner = Backup(None)
+        def transfer(rsync):
+            stats = RSyncStats()
+            logging.debug('Restore command: "'+'" "'.join(rsync)+'"')
+            with callStats.record('rsync', rsync):
+                exitcode = rsyncRunner.runRSync(rsync, stats=stats)
+            return exitcode == 0 or exitcode in Backup.acceptedExitCodes, stats
+
+        results = []
+        with tempfile.TemporaryDirectory() as tmp:
+            commands = []
+            if len(plan['streams']) > 1:
+                for n, stream in enumerate(plan['streams']):
+                    filesFrom = os.path.join(tmp, f'stream{n}')
+                    with open(filesFrom, 'wb') as f:
+                        f.write(b'\0'.join(map(os.fsencode, stream['paths'])) + b'\0')
+                    commands.append(self.buildRSync(job, targetLocation, sourcePath, filesFrom, exclude))
+                with concurrent.futures.ThreadPoolExecutor(max_workers=len(commands)) as executor:
+                    results += list(executor.map(transfer, commands))
+
+            # Directory attributes and anything the streams missed
+            results.append(transfer(self.buildRSync(job, targetLocation, sourcePath, exclude=exclude)))
+
+        self.removeStaging(job, staging)
+        duration = time.monotonic() - startTime
+        transferred = sum(stats.transferredSize or 0 for ok, stats in results)
+        sent = sum((stats.bytesSent or 0) + (stats.bytesReceived or 0) for ok, stats in results)
+        print(f'{job}@{date}: restored {transferred} bytes in {duration:.1f} s, '
+            f'{transferred / duration / 1e6:.1f} MB/s ({sent / duration / 1e6:.1f} MB/s on the wire)')
+
+        if not all(ok for ok, stats in results):
+            logging.error('Restore of %s@%s failed', job, date)
+            return dbackup.resultcodes.RESTORE_FAILED
+        return dbackup.resultcodes.SUCCESS
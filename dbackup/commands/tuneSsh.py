@@ -0,0 +1,120 @@
+import collections
+import logging
+import os
+import subprocess
+import time
+from typing import List
+
+from ..helpers import StateTracker
+from ..helpers import callStats
+
+from ..job import Job
+from .. import SshArgs
+
+import dbackup.resultcodes
+
+class TuneSsh:
+    """ Finds the fastest ssh cipher for each remote host
+
+    A short transfer is timed with each candidate cipher against every host
+    that the jobs use. The time it takes to connect is measured separately
+    and subtracted, so only the throughput of the cipher is compared. The
+    winner is stored in the state tracker and used by SshArgs for all ssh
+    and rsync calls to the host.
+    """
+
+    # (cipher, mac) pairs. The MAC is None for AEAD ciphers, which include their own
+    candidates = [
+        ('aes128-gcm@openssh.com', None),
+        ('aes256-gcm@openssh.com', None),
+        ('chacha20-poly1305@openssh.com', None),
+        ('aes128-ctr', 'umac-64-etm@openssh.com'),
+        ('aes128-ctr', 'hmac-sha2-256-etm@openssh.com'),
+    ]
+
+    # Number of bytes that are sent with each candidate
+    payloadSize = 64 * 1024 * 1024
+
+    _chunkSize = 1024 * 1024
+
+    def __init__(self, stateTracker : StateTracker = None, simulate = False):
+        self.stateTracker = stateTracker
+        self.simulate = simulate
+
+    def _timeCommand(self, cmd, payloadSize = 0) -> float:
+        """ Runs a command, feeding it payloadSize bytes, and returns the elapsed time or None if it failed """
+        chunk = os.urandom(self._chunkSize)
+        start = time.monotonic()
+        try:
+            with callStats.record('benchmark', cmd):
+                proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+                try:
+                    for offset in range(0, payloadSize, self._chunkSize):
+                        proc.stdin.write(chunk[:min(self._chunkSize, payloadSize - offset)])
+                    proc.stdin.close()
+                except BrokenPipeError:
+                    pass
+                stderr = proc.stderr.read()
+                exitcode = proc.wait()
+        except OSError:
+            return None
+        if exitcode != 0:
+            logging.debug('%s failed: %s', ' '.join(cmd), stderr.decode('utf-8', 'replace').rstrip())
+            return None
+        return time.monotonic() - start
+
+    def benchmark(self, location) -> list:
+        """ Measures the throughput of each candidate to the host of a location
+
+        Returns a list of (bytes per second, cipher, mac), fastest first
+        """
+        connectTime = self._timeCommand(location._buildSshCmd('true'))
+        if connectTime is None:
+            logging.error('Could not connect to %s', location.host)
+            return []
+
+        results = []
+        for cipher, mac in self.candidates:
+            extraArgs = ['-c', cipher] + (['-m', mac] if mac else [])
+            elapsed = self._timeCommand(location._buildSshCmd('cat > /dev/null', extraArgs), self.payloadSize)
+            if elapsed is None:
+                logging.info('%s does not support %s', location.host, ' '.join(filter(None, (cipher, mac))))
+                continue
+            throughput = self.payloadSize / max(elapsed - connectTime, 1e-3)
+            logging.info('%s: %s %.1f MB/s', location.host, ' '.join(filter(None, (cipher, mac))), throughput / 1e6)
+            results.append((throughput, cipher, mac))
+        return sorted(results, reverse=True)
+
+    def execute(self, jobs : List[ Job ]) -> int:
+        """ Tunes the ciphers of all remote hosts of the jobs """
+        hosts = collections.OrderedDict()
+        for job in jobs:
+            for location in (job.source, job.dest):
+                if location.isRemote:
+                    hosts.setdefault(location.host.lower(), location)
+
+        if not hosts:
+            logging.info('No remote hosts to tune')
+            return dbackup.resultcodes.SUCCESS
+
+        result = dbackup.resultcodes.SUCCESS
+        for host, location in hosts.items():
+            logging.info('Benchmarking ssh ciphers for %s', host)
+            # Benchmark without the currently tuned cipher
+            previous = SshArgs.tunedCiphers.pop(host, None)
+            try:
+                results = self.benchmark(location)
+            finally:
+                if previous is not None:
+                    SshArgs.tunedCiphers[host] = previous
+            if not results:
+                result = dbackup.resultcodes.SSH_ERROR
+                continue
+
+            throughput, cipher, mac = results[0]
+            print(f'{host}: {" ".join(filter(None, (cipher, mac)))} ({throughput / 1e6:.1f} MB/s)')
+            if self.simulate or self.stateTracker is None:
+                continue
+            SshArgs.tunedCiphers[host] = (cipher, mac)
+            self.stateTracker.setSshCipher(host, cipher, mac)
+        return result
@@ -0,0 +1,71 @@
+import logging
+from typing import List
+
+from ..helpers import SshError, ScriptError, ArgumentError
+
+from ..job import Job
+
+import dbackup.resultcodes
+
+class Verify:
+    """ Verifies snapshots against their content manifests
+
+    All snapshots of a job are verified in a single run of the manifest
+    tool on the host that holds the destination. Files that are hard linked
+    between snapshots are only read once.
+    """
+
+    def __init__(self, workers = None):
+        self.workers = workers
+
+    def verifyJob(self, job : Job) -> int:
+        """ Verifies all complete snapshots of a job
+
+        Returns a result code
+        """
+        backups = job.dest.getBackups(False)
+        if not backups:
+            logging.warning('No backups found for job %s', job)
+            return dbackup.resultcodes.SUCCESS
+
+        args = ['verify', job.dest.path] + sorted(backups)
+        if self.workers:
+            args += ['--workers', str(self.workers)]
+
+        result = dbackup.resultcodes.SUCCESS
+        for snapshot in job.dest.runTool('manifest', args):
+            name = snapshot['snapshot']
+            if snapshot['status'] == 'nomanifest':
+                logging.info('%s@%s has no manifest', job, name)
+            elif snapshot['status'] == 'ok':
+                logging.info('%s@%s is OK (%d files, %d hashed)', job, name, snapshot['files'], snapshot['hashed'])
+            else:
+                logging.error('%s@%s does not match its manifest: %d modified, %d missing, %d extra',
+                    job, name, snapshot['modified'], snapshot['missing'], snapshot['extra'])
+                for path in snapshot['paths']:
+                    logging.error('  %s', path)
+                print(f'BAD: {job}@{name}')
+                result = dbackup.resultcodes.VERIFY_FAILED
+        return result
+
+    def execute(self, jobs : List[ Job ]) -> int:
+        """ Verifies the snapshots of all jobs
+
+        Returns VERIFY_FAILED if any snapshot doesn't match its manifest
+        """
+        for job in jobs:
+            if job.storage == 'chunks':
+                raise ArgumentError(f'Job {job} uses chunk storage, its snapshots have no manifest')
+
+        result = dbackup.resultcodes.SUCCESS
+        for job in jobs:
+            logging.info(f'Verifying {job}')
+            try:
+                result = max(result, self.verifyJob(job))
+            except SshError as e:
+                logging.error(e.message)
+                result = max(result, dbackup.resultcodes.SSH_ERROR)
+            except ScriptError as e:
+                logging.error(e.message)
+                result = max(result, dbackup.resultcodes.VERIFY_FAILED)
+        return result
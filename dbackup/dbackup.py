@@ -89,6 +89,7 @@ import ipaddress
 import datetime
 import shutil
 import collections
+import concurrent.futures
 
 import fasteners
 
@@ -102,12 +103,16 @@ from dbackup.helpers import getDynamicHost
 from dbackup.helpers import checkAge
 from dbackup.helpers import Publisher
 from dbackup.helpers import StateTracker
+from dbackup.helpers import Scheduler
+from dbackup.helpers import callStats
+from dbackup.helpers import Leases
 
 defaultStateFileName = '.mirror_state'
 
 import dbackup.commands
 import dbackup.resultcodes
 from dbackup.config import Config, Job
+from dbackup.sshArgs import SshArgs
 
 
 class DBackup:
@@ -115,6 +120,9 @@ class DBackup:
 
     defaultLocalStateFilename = '/var/local/backup.state'
 
+    # Commands that take a single job followed by operands, e.g. changes <job> [date]
+    operandCommands = ['changes', 'find', 'restore', 'export', 'diff', 'migrate']
+
     def __init__(self):
         # Create a map of command handlers
         self.__commands = {
@@ -122,6 +130,17 @@ class DBackup:
             'check': self.commandCheck,
             'report': self.commandReport,
             'backup': self.commandBackup,
+            'verify': self.commandVerify,
+            'changes': self.commandChanges,
+            'dedupe': self.commandDedupe,
+            'catalog': self.commandCatalog,
+            'find': self.commandFind,
+            'restore': self.commandRestore,
+            'export': self.commandExport,
+            'diff': self.commandDiff,
+            'migrate': self.commandMigrate,
+            'tune-ssh': self.commandTuneSsh,
+            'reconcile': self.commandReconcile,
             }
         self.__today = time.strftime( "%Y-%m-%d")
 
@@ -147,13 +166,23 @@ class DBackup:
 
     def parseArguments(self):
         parser = argparse.ArgumentParser(description='Backup tool based on RSYNC')
-        parser.add_argument('command', help='What to do',choices=['backup','check','clean','report'],default='backup')
-        parser.add_argument('job', help='Specify which jobs to run, e.g. kalle pelle olle', default=None, nargs='*')
+        parser.add_argument('command', help='What to do',choices=['backup','check','clean','report','verify','changes','dedupe','catalog','find','restore','export','diff','migrate','tune-ssh','reconcile'],default='backup')
+        parser.add_argument('job', help='Specify which jobs to run, e.g. kalle pelle olle. Commands like changes take one job followed by operands', default=None, nargs='*')
         parser.add_argument('-c', '--configfile', help='Full path of config file', default='/etc/dtools/backup.ini')
         parser.add_argument('--logfile', help='Full path of log file', default=None)
         parser.add_argument('--log', help='Log level (DEBUG,INFO,WARNING,ERROR,CRITICAL)',default='INFO')
         parser.add_argument('-s', '--statefile', help='Full path of local state file', default=self.defaultLocalStateFilename)
         parser.add_argument('--clean', help='Clean after successfull backup', action='store_true')
+        parser.add_argument('--cleanlimit', help='Maximum number of concurrent cleans on each destination filesystem', type=int, default=1)
+        parser.add_argument('--parallel', help='Number of backup jobs to run at the same time', type=int, default=1)
+        parser.add_argument('--streams', help='Number of parallel rsync streams for restore', type=int, default=4)
+        parser.add_argument('--checksum', help='Compare file contents instead of size and modification time when restoring', action='store_true')
+        parser.add_argument('--output', help='File to write an export to, - for stdout', default='-')
+        parser.add_argument('--since', help='Only export the changes since this backup, or previous', default=None)
+        parser.add_argument('--lease-dir', help='Shared directory where several controllers take leases on the jobs, instead of locking this host', default=None)
+        parser.add_argument('--lease-ttl', help='Seconds before the lease of a controller that stopped renewing it is taken over', type=int, default=Leases.defaultTtl)
+        parser.add_argument('--host-timeout', help='Seconds to wait for each host when reconciling', type=int, default=60)
+        parser.add_argument('--callstats', help='Print the number of processes and ssh calls of each job', action='store_true')
         parser.add_argument('--mqtt', help='Publish state to MQTT broker with address', default='')
         parser.add_argument('-p', '--port', help='Port number of MQTT broker', default=1883)
         parser.add_argument('--simulate', help='Don\'t do the actual copy and update states', action='store_true')
@@ -183,30 +212,148 @@ class DBackup:
         cmdReport = dbackup.commands.Report(publisher = self.publisher, stateTracker = self.stateTracker)
         return cmdReport.execute(jobs)
     
+    def commandVerify(self, jobs) -> int:
+        logging.debug('Verify requested')
+        cmdVerify = dbackup.commands.Verify()
+        return cmdVerify.execute(jobs)
+
+    def commandChanges(self, jobs) -> int:
+        logging.debug('Changes requested')
+        if len(jobs) != 1:
+            raise ArgumentError('Usage: changes <job> [date]')
+        cmdChanges = dbackup.commands.Changes()
+        return cmdChanges.execute(jobs[0], *self.operands[:1])
+
+    def commandDedupe(self, jobs) -> int:
+        logging.debug('Dedupe requested')
+        cmdDedupe = dbackup.commands.Dedupe(simulate = self.args.simulate)
+        return cmdDedupe.execute(jobs)
+
+    def commandCatalog(self, jobs) -> int:
+        logging.debug('Catalog requested')
+        cmdCatalog = dbackup.commands.Catalog(simulate = self.args.simulate)
+        return cmdCatalog.execute(jobs)
+
+    def commandFind(self, jobs) -> int:
+        logging.debug('Find requested')
+        if len(jobs) != 1:
+            raise ArgumentError('Usage: find <job> <pattern>')
+        cmdFind = dbackup.commands.Find()
+        return cmdFind.execute(jobs[0], *self.operands[:1])
+
+    def commandRestore(self, jobs) -> int:
+        logging.debug('Restore requested')
+        if len(jobs) != 1 or len(self.operands) != 3:
+            raise ArgumentError('Usage: restore <job> <date> <path> <target>')
+        cmdRestore = dbackup.commands.Restore(
+            streams = self.args.streams,
+            checksum = self.args.checksum,
+            simulate = self.args.simulate)
+        return cmdRestore.execute(jobs[0], *self.operands)
+
+    def commandExport(self, jobs) -> int:
+        logging.debug('Export requested')
+        if len(jobs) != 1 or len(self.operands) != 1:
+            raise ArgumentError('Usage: export <job> <date>')
+        cmdExport = dbackup.commands.Export(
+            output = self.args.output,
+            since = self.args.since,
+            simulate = self.args.simulate)
+        return cmdExport.execute(jobs[0], *self.operands)
+
+    def commandDiff(self, jobs) -> int:
+        logging.debug('Diff requested')
+        if len(jobs) != 1 or len(self.operands) not in (0, 2):
+            raise ArgumentError('Usage: diff <job> [<date> <date>]')
+        cmdDiff = dbackup.commands.Diff()
+        return cmdDiff.execute(jobs[0], *self.operands)
+
+    def commandMigrate(self, jobs) -> int:
+        logging.debug('Migrate requested')
+        if len(jobs) != 1 or len(self.operands) != 1:
+            raise ArgumentError('Usage: migrate <job> <new dest>')
+        cmdMigrate = dbackup.commands.Migrate(stateTracker = self.stateTracker, simulate = self.args.simulate)
+        return cmdMigrate.execute(jobs[0], *self.operands)
+
+    def commandTuneSsh(self, jobs) -> int:
+        logging.debug('SSH tuning requested')
+        cmdTuneSsh = dbackup.commands.TuneSsh(stateTracker = self.stateTracker, simulate = self.args.simulate)
+        return cmdTuneSsh.execute(jobs)
+
+    def commandReconcile(self, jobs) -> int:
+        logging.debug('Reconcile requested')
+        cmdReconcile = dbackup.commands.Reconcile(
+            stateTracker = self.stateTracker,
+            timeout = self.args.host_timeout,
+            simulate = self.args.simulate)
+        return cmdReconcile.execute(jobs)
+
     def commandBackup(self, jobs) -> int:
         result = 0
         logging.debug('Backup requested')
-        # Create lock file for backups
-        logging.debug('Aquiring interprocess lock /tmp/backup.lock')
-        with fasteners.InterProcessLock("/tmp/backup.lock"):
-            logging.debug('Locked /tmp/backup.lock')
+        if self.args.lease_dir is not None:
+            # Several controllers share the jobs, each job is leased by the one that runs it
+            logging.debug('Taking job leases in %s', self.args.lease_dir)
+            leases = Leases(self.args.lease_dir, self.today, ttl=self.args.lease_ttl)
+            lock = leases
+        else:
+            # Create lock file for backups
+            logging.debug('Aquiring interprocess lock /tmp/backup.lock')
+            leases = None
+            lock = fasteners.InterProcessLock("/tmp/backup.lock")
+        with lock:
+            logging.debug('Locked')
             self.initPublisher()
             cmdBackup = dbackup.commands.Backup(
                 publisher = self.publisher,
                 stateTracker = self.stateTracker,
                 simulate = self.args.simulate)
             if self.args.clean:
-                cmdClean = dbackup.commands.Clean(simulate = self.args.simulate)
-
-            for job in jobs:
-                jobResult = cmdBackup.execute(job)
-                logging.debug("Result for job is {jobResult}")
-                result = max(result, jobResult)
+                # Clean in the background while the next job transfers
+                cleanPipeline = dbackup.commands.CleanPipeline(
+                    dbackup.commands.Clean(simulate = self.args.simulate),
+                    maxPerFilesystem = self.args.cleanlimit)
+
+            # Order the jobs to fit the backup window
+            scheduler = Scheduler(self.stateTracker, self.args.parallel)
+            jobs = scheduler.order(jobs)
+            logging.info('Backup order: ' + ', '.join(map(str, jobs)))
+            scheduler.checkWindow(jobs)
+
+            def backupJob(job):
+                # Jobs with timestamps run once an hour, the others once a day
+                if leases is not None and not leases.acquire(job, cmdBackup.snapshotName(job)[:13]):
+                    # Run or running on another controller
+                    return dbackup.resultcodes.SUCCESS
+                jobResult = dbackup.resultcodes.UNEXPECTED_ERROR
+                try:
+                    with callStats.job(job):
+                        jobResult = cmdBackup.execute(job)
+                finally:
+                    if leases is not None:
+                        leases.release(job, jobResult)
+                logging.debug(f"Result for job {job} is {jobResult}")
+                cpu, io = callStats.jobUsage(job)
+                logging.info('Job %s used %.1f s of CPU and %d bytes of disk I/O (priority %s)', job, cpu, io, job.priority)
                 if self.args.clean:
-                    cmdClean.execute([job])
+                    cleanPipeline.submit(job)
+                return jobResult
+
+            if self.args.parallel > 1:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=self.args.parallel) as executor:
+                    for jobResult in executor.map(backupJob, jobs):
+                        result = max(result, jobResult)
+            else:
+                for job in jobs:
+                    result = max(result, backupJob(job))
 
+            if self.args.clean:
+                cleanResult = cleanPipeline.wait()
+                logging.debug(f'Result for clean is {cleanResult}')
+                result = max(result, cleanResult)
 
-        logging.debug('Releasing interprocess lock /tmp/backup.lock')
+
+        logging.debug('Released')
         return result
 
     def executeCommand(self, command, jobs) -> int:
@@ -216,12 +363,26 @@ class DBackup:
         # Wait for publisher to publish any remaining messages
         if self.publisher:
             self.publisher.waitForPublish()
+
+        for line in callStats.report():
+            if self.args.callstats:
+                print(line)
+            else:
+                logging.debug(line)
         
         return result
 
     def getJobs(self) -> List[ Job ]:
-        """ Get a list of the jobs as specified by arguments """
-        if not self.args.job:
+        """ Get a list of the jobs as specified by arguments
+
+        For operand commands, only the first argument is a job. The rest
+        are stored in self.operands
+        """
+        self.operands = []
+        if self.args.command in self.operandCommands:
+            self.operands = self.args.job[1:]
+            return list(map(lambda jobName : self.config[jobName], self.args.job[:1]))
+        elif not self.args.job:
             # No job is specified, use all
             return list(self.config.jobs())
         else:
@@ -244,6 +405,9 @@ class DBackup:
         with StateTracker(self.args.statefile) as stateTracker:
             self.stateTracker = stateTracker
 
+            # Use the ssh ciphers chosen by tune-ssh
+            SshArgs.tunedCiphers.update(stateTracker.getSshCiphers())
+
             # Get the list of jobs
             jobs = self.getJobs()
 
@@ -1,5 +1,14 @@
 from .errors import *
 from .config import *
-from .time import checkAge, today
+from .time import checkAge, today, timeOfDay, snapshotName, parseSnapshot
 from .publisher import Publisher
 from .stateTracker import StateTracker
+from .changeLog import ChangeLog
+from .rsyncStats import RSyncStats
+from .sshAgent import SshAgent
+from .scheduler import Scheduler
+from .priority import Priority
+from .callStats import CallStats, callStats
+from .throttle import Throttle
+from .excludes import Excludes
+from .leases import Leases
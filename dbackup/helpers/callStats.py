@@ -0,0 +1,128 @@
+import collections
+import contextlib
+import logging
+import os
+import resource
+import subprocess
+import threading
+import time
+
+class CallStats:
+    """ Counts the processes that are spawned for each job
+
+    Every ssh call, rsync and hook is recorded with its purpose, duration
+    and resource use, under the job that is current in the calling thread.
+    Calls outside of a job are recorded under None.
+
+    The resource use is the CPU time and block I/O of the children that
+    finished during the call. When jobs run in parallel, children of other
+    jobs that finish at the same time are counted as well.
+
+    Commands are wrapped with the Priority of the current job, see wrap().
+
+    The module level instance callStats is used by the locations and
+    commands, e.g.
+
+        with callStats.job(job):
+            output = callStats.checkOutput('list', cmd, stderr=subprocess.PIPE)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # { job : { purpose : [calls, ssh calls, seconds, CPU seconds, I/O bytes] } }
+            self.totals = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def job(self, job, priority = None):
+        """ Records the calls in this thread under job
+
+        The commands are run with priority, or the priority of job if None
+        """
+        previous = (getattr(self._local, 'job', None), getattr(self._local, 'priority', None))
+        self._local.job = str(job) if job is not None else None
+        self._local.priority = priority if priority is not None else getattr(job, 'priority', None)
+        try:
+            yield
+        finally:
+            self._local.job, self._local.priority = previous
+
+    def wrap(self, cmd):
+        """ Wraps a command with the priority of the current job, if any """
+        priority = getattr(self._local, 'priority', None)
+        return priority.wrap(cmd) if priority else cmd
+
+    @staticmethod
+    def isSsh(cmd) -> bool:
+        """ Checks if a command connects with ssh, directly or from rsync """
+        if isinstance(cmd, str):
+            return cmd.split(' ', 1)[0] == 'ssh'
+        return bool(cmd) and (os.path.basename(cmd[0]) == 'ssh' or any(str(arg).startswith('--rsh=ssh') for arg in cmd))
+
+    @contextlib.contextmanager
+    def record(self, purpose : str, cmd = None):
+        """ Records the time spent in the block as one call """
+        start = time.monotonic()
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - start
+            after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            cpu = after.ru_utime + after.ru_stime - usage.ru_utime - usage.ru_stime
+            # Blocks are 512 bytes
+            io = (after.ru_inblock + after.ru_oublock - usage.ru_inblock - usage.ru_oublock) * 512
+            job = getattr(self._local, 'job', None)
+            with self._lock:
+                calls = self.totals.setdefault(job, collections.OrderedDict()).setdefault(purpose, [0, 0, 0.0, 0.0, 0])
+                calls[0] += 1
+                calls[1] += 1 if cmd is not None and self.isSsh(cmd) else 0
+                calls[2] += duration
+                calls[3] += cpu
+                calls[4] += io
+            logging.debug('%s call took %.3f s', purpose, duration)
+
+    def run(self, purpose : str, cmd, **kwargs):
+        """ subprocess.run() that is recorded """
+        with self.record(purpose, cmd):
+            return subprocess.run(self.wrap(cmd), **kwargs)
+
+    def checkOutput(self, purpose : str, cmd, **kwargs):
+        """ subprocess.check_output() that is recorded """
+        with self.record(purpose, cmd):
+            return subprocess.check_output(self.wrap(cmd), **kwargs)
+
+    def system(self, purpose : str, command : str):
+        """ os.system() that is recorded """
+        with self.record(purpose, command):
+            return os.system(self.wrap(command))
+
+    def _jobSums(self, job) -> tuple:
+        with self._lock:
+            purposes = list(self.totals.get(str(job) if job is not None else None, {}).values())
+        return tuple(map(sum, zip(*purposes))) if purposes else (0, 0, 0.0, 0.0, 0)
+
+    def jobTotals(self, job) -> tuple:
+        """ Returns (calls, ssh calls, seconds) of a job """
+        return self._jobSums(job)[:3]
+
+    def jobUsage(self, job) -> tuple:
+        """ Returns (CPU seconds, I/O bytes) of the processes of a job """
+        return self._jobSums(job)[3:]
+
+    def report(self) -> list:
+        """ Per job totals, one line for each job """
+        lines = []
+        with self._lock:
+            for job, purposes in self.totals.items():
+                calls, sshCalls, seconds, cpu, io = map(sum, zip(*purposes.values()))
+                details = ', '.join(f'{purpose} {c[0]} ({c[2]:.1f} s)' for purpose, c in purposes.items())
+                lines.append(f'{job or "(no job)"}: {calls} processes, {sshCalls} ssh, {seconds:.1f} s, '
+                    f'{cpu:.1f} s CPU, {io} bytes I/O: {details}')
+        return lines
+
+callStats = CallStats()
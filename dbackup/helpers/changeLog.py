@@ -0,0 +1,140 @@
+import gzip
+import logging
+import os
+import re
+
+class ChangeLog:
+    """ Builds a change log of a snapshot from rsync's itemized output
+
+    rsync is run with -ii, so every transferred, linked or unchanged item
+    is itemized. The lines are parsed while rsync is running and written to
+    a gzip'ed file, which is stored in the snapshot as .dbackup/changes.gz
+
+        A <size> <path>     Added
+        M <size> <path>     Modified (contents or attributes)
+        D <size> <path>     Deleted since the previous snapshot
+        = <size> <path>     Unchanged, i.e. linked to the previous snapshot
+
+    Deletions are not itemized by rsync when transferring into a new snapshot
+    with --link-dest. Instead, the log of the previous snapshot is compared
+    with the paths that were seen in this transfer.
+
+    Directories are not logged. If rsync is retried, the same log is fed
+    again, and items that were logged by the earlier attempt are skipped.
+    """
+
+    # rsync options that produce the lines understood by feed()
+    rsyncOpts = ['-ii', '--out-format=%i %l %n']
+
+    # Path of the change log in a snapshot
+    fileName = '.dbackup/changes.gz'
+
+    added = 'A'
+    modified = 'M'
+    deleted = 'D'
+    unchanged = '='
+
+    # Multipliers for numbers output by rsync -h
+    _suffixes = { 'K': 1000, 'M': 1000**2, 'G': 1000**3, 'T': 1000**4, 'P': 1000**5 }
+
+    def __init__(self, filePath):
+        """
+        Arguments:
+            filePath (str) : Local path of the change log to write
+        """
+        self.filePath = filePath
+        self._file = gzip.open(filePath, 'wt', encoding='utf-8', errors='surrogateescape', compresslevel=3)
+        self._seen = set()
+        self.counts = { self.added: 0, self.modified: 0, self.deleted: 0, self.unchanged: 0 }
+        self.bytes = { self.added: 0, self.modified: 0, self.deleted: 0, self.unchanged: 0 }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+    @classmethod
+    def parseSize(cls, text : str) -> int:
+        """ Converts a size as printed by rsync to an int, e.g. 1,234 or 1.23M """
+        text = text.strip()
+        multiplier = cls._suffixes.get(text[-1:].upper(), 1)
+        if multiplier > 1:
+            return int(float(text[:-1].replace(',', '')) * multiplier)
+        return int(re.sub(r'[,.]', '', text) or 0)
+
+    @staticmethod
+    def isItemized(line : str) -> bool:
+        """ Checks if a line of rsync output is an itemized change """
+        return len(line) > 12 and line[11] == ' ' and line[0] in '<>ch.*' and line[1] in 'fdLDS'
+
+    def _write(self, kind, size, path):
+        self.counts[kind] += 1
+        self.bytes[kind] += size
+        self._file.write(f'{kind} {size} {path}\n')
+
+    def feed(self, line : str) -> bool:
+        """ Parses a line of rsync output
+
+        Returns False if the line wasn't an itemized change
+        """
+        if not self.isItemized(line):
+            return False
+
+        flags = line[:11]
+        if flags[1] == 'd' or flags.startswith('*deleting'):
+            # Directories are not logged. Deletions are relative to an
+            # interrupted transfer, the real ones are found in finish()
+            return True
+
+        sizeText, _, path = line[12:].rstrip('\n').partition(' ')
+        if hash(path) in self._seen:
+            # Already logged by an earlier, interrupted attempt
+            return True
+        size = self.parseSize(sizeText)
+        self._seen.add(hash(path))
+
+        attributes = flags[2:]
+        if flags[0] in '<>c' or (flags[0] == 'h' and '+' in attributes):
+            kind = self.added if attributes.strip('+') == '' else self.modified
+        elif attributes.strip(' .'):
+            kind = self.modified
+        else:
+            kind = self.unchanged
+        self._write(kind, size, path)
+        return True
+
+    def finish(self, previousLog = None):
+        """ Adds deletions and closes the log
+
+        Arguments:
+            previousLog (str) : Local path to the change log of the snapshot
+                that was used as link target, or None if it isn't available
+        """
+        if previousLog is not None:
+            for kind, size, path in self.read(previousLog):
+                if kind != self.deleted and hash(path) not in self._seen:
+                    self._write(self.deleted, size, path)
+        else:
+            logging.info('No previous change log, deleted files are not logged')
+        self._seen = set()
+        self.close()
+
+    def summary(self) -> str:
+        return ', '.join(f'{self.counts[k]} {name} ({self.bytes[k]} bytes)' for k, name in
+            [(self.added, 'added'), (self.modified, 'modified'), (self.deleted, 'deleted')])
+
+    @staticmethod
+    def read(filePath):
+        """ Reads a change log
+
+        Yields (kind, size, path) for each entry
+        """
+        with gzip.open(filePath, 'rt', encoding='utf-8', errors='surrogateescape') as f:
+            for line in f:
+                kind, size, path = line.rstrip('\n').split(' ', 2)
+                yield kind, int(size), path
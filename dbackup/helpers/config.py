@@ -14,4 +14,10 @@ def getDynamicHost(jobConfig):
             return dynamichost
         except ValueError:
             logging.error('Dynamichost failed')
-    return None
\ No newline at end of file
+    return None
+
+def getBool(jobConfig, key, default = False) -> bool:
+    """ Reads a boolean option such as yes/no, true/false or 1/0 from a job config """
+    if key not in jobConfig:
+        return default
+    return str(jobConfig[key]).strip().lower() in ('yes', 'true', 'on', '1')
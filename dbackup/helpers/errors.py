@@ -13,3 +13,12 @@ class SshError(Exception):
     """ Raised when SSH subprocess fucked up """
     def __init__(self, message):
         self.message = message
+
+class ScriptError(Exception):
+    """ Raised when a tool script failed on the host that holds the files """
+    def __init__(self, message):
+        self.message = message
+
+class DaemonError(SshError):
+    """ Raised when an rsync daemon can't be reached or refused the request """
+    pass
@@ -0,0 +1,109 @@
+import logging
+import re
+
+class Excludes:
+    """ Rules that keep caches and files that can be regenerated out of the backups
+
+    A job can exclude
+        - directories that are tagged with a CACHEDIR.TAG file, see
+          https://bford.info/cachedir/. rsync can't detect them, so they are
+          found with the excludes tool before rsync runs
+        - named presets of rsync exclude patterns, see presets
+        - files larger than a maximum size, with rsync --max-size
+    """
+
+    # Exclude patterns of each preset, in rsync syntax. A trailing / matches
+    # directories only
+    presets = {
+        'caches': ['.cache/', '.ccache/', '.thumbnails/'],
+        'browser': ['.mozilla/firefox/*/cache2/', '.config/google-chrome/*/Cache/',
+            '.config/chromium/*/Cache/', '.config/*/GPUCache/'],
+        'node': ['node_modules/', '.npm/_cacache/'],
+        'python': ['__pycache__/', '*.pyc', '.tox/', '.mypy_cache/', '.pytest_cache/'],
+        'build': ['build/', 'dist/', 'target/', '.gradle/', 'CMakeFiles/'],
+        'trash': ['.local/share/Trash/', '.Trash-*/'],
+    }
+
+    # Rule names in the savings report for rules that are not patterns
+    cacheDirRule = 'CACHEDIR.TAG'
+    maxSizeRule = 'max file size'
+
+    _units = { '': 1, 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4 }
+
+    def __init__(self, caches = False, presets = None, maxSize = None):
+        """
+        Arguments:
+            caches (bool) : Exclude directories tagged with CACHEDIR.TAG
+            presets (list(str)) : Names of presets to exclude
+            maxSize (int) : Size in bytes of the largest file to backup, or None
+        """
+        presets = presets or []
+        for name in presets:
+            assert name in self.presets, f'Unknown exclude preset {name}, use one of {", ".join(self.presets)}'
+        self.caches = caches
+        self.presetNames = presets
+        self.maxSize = maxSize
+
+    def __bool__(self):
+        return bool(self.caches or self.presetNames or self.maxSize is not None)
+
+    @classmethod
+    def parseSize(cls, text : str) -> int:
+        """ Converts a size like 500M or 2G to bytes, with 1K = 1024 """
+        match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*', text, re.IGNORECASE)
+        assert match, f'Invalid size {text}'
+        return int(float(match.group(1)) * cls._units[match.group(2).upper()])
+
+    @property
+    def patterns(self) -> list:
+        """ The exclude patterns of the presets, in order """
+        return [ pattern for name in self.presetNames for pattern in self.presets[name] ]
+
+    @staticmethod
+    def escape(path : str) -> str:
+        """ Escapes a path for an rsync pattern
+
+        rsync only interprets backslashes in patterns with wildcards
+        """
+        if not any(c in path for c in '*?['):
+            return path
+        return re.sub(r'([\\*?\[])', r'\\\1', path)
+
+    def rsyncOpts(self, cacheDirs = ()) -> list:
+        """ rsync filter options
+
+        The tagged directories can be many, so they are not passed as
+        arguments. rsync reads them from stdin, see excludeList()
+
+        Arguments:
+            cacheDirs (list(str)) : Tagged directories, relative to the source
+        """
+        opts = ['--exclude-from=-'] if cacheDirs else []
+        opts += [ '--exclude=' + pattern for pattern in self.patterns ]
+        if self.maxSize is not None:
+            opts.append(f'--max-size={self.maxSize}')
+        return opts
+
+    def excludeList(self, cacheDirs) -> bytes:
+        """ The anchored exclude patterns of the tagged directories, one per line
+
+        Returns None if there are none
+        """
+        if not cacheDirs:
+            return None
+        lines = []
+        for path in cacheDirs:
+            if '\n' in path:
+                logging.warning('Can not exclude the tagged directory %r, its name has a newline', path)
+                continue
+            lines.append('/' + self.escape(path) + '/\n')
+        return ''.join(lines).encode('utf-8', 'surrogateescape')
+
+    def toolArgs(self) -> list:
+        """ Arguments to the excludes tool that finds what these rules exclude """
+        args = ['--caches'] if self.caches else []
+        for pattern in self.patterns:
+            args.append('--rule=' + pattern)
+        if self.maxSize is not None:
+            args += ['--max-size', str(self.maxSize)]
+        return args
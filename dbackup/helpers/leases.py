@@ -0,0 +1,177 @@
+import contextlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+import fasteners
+
+class Leases:
+    """ Shares the jobs of a backup cycle between several controllers
+
+    The controllers coordinate through lease files in a directory that all
+    of them mount, e.g. over NFS. A controller takes the lease of a job
+    right before it runs it, and marks the lease done when the job has
+    finished. Each job thus runs once per cycle, on the first controller
+    that is free to start it.
+
+    <dir>/<job>.lease
+    {"owner": "host:pid", "cycle": "2020-10-01", "state": "running", "expires": 1601553600.0}
+
+    The leases of the running jobs are renewed every ttl/3 seconds. A lease
+    that hasn't been renewed for ttl seconds belongs to a controller that
+    died, and is taken over by the next controller that tries the job.
+
+    A lease is read and written while holding an fcntl lock on <dir>/<job>.lock,
+    so the shared file system must support locks (NFSv4, or lockd for NFSv3).
+    """
+
+    defaultTtl = 300
+
+    def __init__(self, path : str, cycle : str, ttl = defaultTtl, owner = None):
+        """
+        Arguments:
+            path (str) : The shared lease directory
+            cycle (str) : Identifies the cycle, e.g. the date of the backups
+            ttl (int) : Seconds after which a lease that isn't renewed is stale
+            owner (str) : Name of this controller, host:pid by default
+        """
+        self.path = path
+        self.cycle = cycle
+        self.ttl = ttl
+        self.owner = owner if owner is not None else f'{socket.gethostname()}:{os.getpid()}'
+        self._held = set()
+        self._lock = threading.Lock()
+        self._threadLocks = {}
+        self._thread = None
+        self._stop = threading.Event()
+        os.makedirs(path, exist_ok=True)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _leasePath(self, job) -> str:
+        return os.path.join(self.path, f'{job}.lease')
+
+    @contextlib.contextmanager
+    def _jobLock(self, job):
+        """ Excludes other controllers, and the other threads of this one
+
+        fcntl locks are held by the process, so they don't exclude the renew
+        thread from a release in another thread
+        """
+        with self._lock:
+            threadLock = self._threadLocks.setdefault(str(job), threading.Lock())
+        with threadLock, fasteners.InterProcessLock(os.path.join(self.path, f'{job}.lock')):
+            yield
+
+    def read(self, job) -> dict:
+        """ The lease of job, or None if there is none """
+        try:
+            with open(self._leasePath(job)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            logging.warning('Ignoring the corrupt lease of job %s', job)
+            return None
+
+    def _write(self, job, lease):
+        """ Replaces the lease file, so that it is never read half written """
+        path = self._leasePath(job)
+        tmpPath = f'{path}.{os.getpid()}.{threading.get_ident()}'
+        with open(tmpPath, 'w') as f:
+            json.dump(lease, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpPath, path)
+
+    def acquire(self, job, cycle = None) -> bool:
+        """ Takes the lease of job for this cycle, or for cycle if given
+
+        Returns False if the job was already run in the cycle, or is
+        running on another controller whose lease is still valid
+        """
+        cycle = cycle if cycle is not None else self.cycle
+        with self._jobLock(job):
+            lease = self.read(job)
+            now = time.time()
+            if lease is not None:
+                if lease.get('cycle') == cycle and lease.get('state') == 'done':
+                    logging.info('Job %s was already run by %s', job, lease.get('owner'))
+                    return False
+                if lease.get('state') == 'running' and lease.get('owner') != self.owner:
+                    if lease.get('expires', 0) > now:
+                        logging.info('Job %s is running on %s', job, lease.get('owner'))
+                        return False
+                    logging.warning('Taking over the stale lease of job %s from %s, which expired %.0f s ago',
+                        job, lease.get('owner'), now - lease.get('expires', 0))
+            self._write(job, {
+                'owner': self.owner,
+                'cycle': cycle,
+                'state': 'running',
+                'started': now,
+                'expires': now + self.ttl })
+        with self._lock:
+            self._held.add(str(job))
+        logging.debug('Acquired the lease of job %s', job)
+        return True
+
+    def release(self, job, result : int):
+        """ Marks job as done in this cycle, with its result code """
+        with self._lock:
+            self._held.discard(str(job))
+        with self._jobLock(job):
+            lease = self.read(job)
+            if lease is None or lease.get('owner') != self.owner:
+                logging.error('The lease of job %s was taken over by %s while it ran', job,
+                    lease.get('owner') if lease is not None else 'nobody')
+                return
+            lease.update(state='done', result=result, finished=time.time())
+            self._write(job, lease)
+        logging.debug('Released the lease of job %s', job)
+
+    def renew(self):
+        """ Extends the leases of the running jobs by ttl """
+        with self._lock:
+            jobs = list(self._held)
+        for job in jobs:
+            with self._jobLock(job):
+                with self._lock:
+                    if job not in self._held:
+                        # Released meanwhile
+                        continue
+                lease = self.read(job)
+                if lease is None or lease.get('owner') != self.owner:
+                    logging.error('Lost the lease of job %s to %s', job,
+                        lease.get('owner') if lease is not None else 'nobody')
+                    with self._lock:
+                        self._held.discard(job)
+                    continue
+                lease['expires'] = time.time() + self.ttl
+                self._write(job, lease)
+
+    def _run(self):
+        while not self._stop.wait(self.ttl / 3):
+            try:
+                self.renew()
+            except OSError as e:
+                logging.warning('Could not renew leases: %s', e)
+
+    def start(self):
+        """ Starts renewing the leases in the background """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
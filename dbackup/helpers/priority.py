@@ -0,0 +1,115 @@
+import logging
+import os
+import shlex
+import shutil
+
+class Priority:
+    """ CPU and I/O priority of the processes of a job
+
+    Commands are wrapped in nice and ionice, and optionally run in a
+    transient systemd scope, so that they get their own cgroup with an
+    io.weight and a memory.max limit. Wrappers that aren't installed are
+    skipped with a warning.
+
+    Processes on remote hosts are wrapped in nice and ionice only, as
+    creating a cgroup there needs privileges.
+    """
+
+    ioClasses = { 'realtime': 1, 'best-effort': 2, 'idle': 3 }
+
+    # Wrappers that were not found, only warned about once
+    _missing = set()
+
+    def __init__(self, nice = None, ioClass = None, ioLevel = None, ioWeight = None, memoryMax = None):
+        """
+        Arguments:
+            nice (int) : Niceness, -20 to 19, or None to keep the default
+            ioClass (str) : I/O scheduling class, realtime, best-effort or idle
+            ioLevel (int) : I/O priority in the class, 0 (highest) to 7
+            ioWeight (int) : cgroup v2 io.weight, 1 to 10000
+            memoryMax (str) : cgroup v2 memory.max, e.g. 2G
+        """
+        assert nice is None or -20 <= nice <= 19, 'nice must be between -20 and 19'
+        assert ioClass is None or ioClass in self.ioClasses, 'ionice must be realtime, best-effort or idle'
+        assert ioLevel is None or 0 <= ioLevel <= 7, 'ionice level must be between 0 and 7'
+        assert ioWeight is None or 1 <= ioWeight <= 10000, 'io weight must be between 1 and 10000'
+        self.nice = nice
+        self.ioClass = ioClass
+        self.ioLevel = ioLevel if ioClass != 'idle' else None
+        self.ioWeight = ioWeight
+        self.memoryMax = memoryMax
+
+    @classmethod
+    def parseIoNice(cls, spec : str) -> tuple:
+        """ Parses 'class' or 'class:level' into (class, level) """
+        ioClass, _, level = spec.strip().lower().partition(':')
+        return ioClass, int(level) if level else None
+
+    def __bool__(self):
+        return any(value is not None for value in (self.nice, self.ioClass, self.ioWeight, self.memoryMax))
+
+    def _available(self, tool) -> bool:
+        if shutil.which(tool) is not None:
+            return True
+        if tool not in self._missing:
+            self._missing.add(tool)
+            logging.warning('%s is not installed, processes are not run with it', tool)
+        return False
+
+    def _ioniceArgs(self) -> list:
+        if self.ioClass is None:
+            return []
+        args = ['ionice', '-c', str(self.ioClasses[self.ioClass])]
+        if self.ioLevel is not None:
+            args += ['-n', str(self.ioLevel)]
+        return args
+
+    def _niceArgs(self) -> list:
+        return ['nice', '-n', str(self.nice)] if self.nice is not None else []
+
+    def prefix(self) -> list:
+        """ The command line that a local command is appended to """
+        args = []
+        if (self.ioWeight is not None or self.memoryMax is not None) and self._available('systemd-run'):
+            args += ['systemd-run', '--scope', '--quiet', '--collect']
+            if os.geteuid() != 0:
+                args += ['--user']
+            if self.ioWeight is not None:
+                args += ['-p', f'IOWeight={self.ioWeight}']
+            if self.memoryMax is not None:
+                args += ['-p', f'MemoryMax={self.memoryMax}']
+        if self.ioClass is not None and self._available('ionice'):
+            args += self._ioniceArgs()
+        return args + self._niceArgs()
+
+    def wrap(self, cmd):
+        """ Wraps a local command, a list of arguments or a shell command string """
+        prefix = self.prefix()
+        if not prefix:
+            return cmd
+        if isinstance(cmd, str):
+            return ' '.join(map(shlex.quote, prefix)) + ' sh -c ' + shlex.quote(cmd)
+        return prefix + list(cmd)
+
+    def remotePrefix(self) -> str:
+        """ Shell words that a command on a remote host is prefixed with, or '' """
+        return ' '.join(self._ioniceArgs() + self._niceArgs())
+
+    def wrapRemote(self, command : str) -> str:
+        """ Wraps a shell command that runs on a remote host """
+        prefix = self.remotePrefix()
+        if not prefix:
+            return command
+        return prefix + ' sh -c ' + shlex.quote(command)
+
+    def __str__(self):
+        parts = []
+        if self.nice is not None:
+            parts.append(f'nice {self.nice}')
+        if self.ioClass is not None:
+            parts.append(f'ionice {self.ioClass}' + (f':{self.ioLevel}' if self.ioLevel is not None else ''))
+        if self.ioWeight is not None:
+            parts.append(f'io weight {self.ioWeight}')
+        if self.memoryMax is not None:
+            parts.append(f'memory max {self.memoryMax}')
+        return ', '.join(parts) or 'default'
@@ -42,6 +42,14 @@ class Publisher(HAMqttClient):
         else:
             logging.debug('^SIMULATED^')
 
+    def publishPaused(self, job, seconds):
+        topic = self.formatTopic(f'{job}/paused')
+        logging.debug(f'Publishing paused time {topic}:{seconds}')
+        if not self.simulate:
+            self.publish(topic, str(seconds), retain=True)
+        else:
+            logging.debug('^SIMULATED^')
+
     def publishLastGood(self, job, lastGood):
         topic = self.formatTopic(f'{job}/lastgood')
         if isinstance(lastGood, datetime):
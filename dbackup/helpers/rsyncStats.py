@@ -0,0 +1,51 @@
+from .changeLog import ChangeLog
+
+class RSyncStats:
+    """ Parses the summary that rsync prints with --stats
+
+    Attributes (None until seen in the output):
+        files (int) : Number of files
+        transferredFiles (int) : Number of regular files transferred
+        totalSize (int) : Total file size in bytes
+        transferredSize (int) : Total transferred file size in bytes
+        literalData (int) : Bytes that were sent as literal data
+        bytesSent (int) : Total bytes sent
+        bytesReceived (int) : Total bytes received
+    """
+
+    rsyncOpts = ['--stats']
+
+    _fields = {
+        'Number of files': 'files',
+        'Number of regular files transferred': 'transferredFiles',
+        'Total file size': 'totalSize',
+        'Total transferred file size': 'transferredSize',
+        'Literal data': 'literalData',
+        'Total bytes sent': 'bytesSent',
+        'Total bytes received': 'bytesReceived',
+    }
+
+    def __init__(self):
+        for attribute in self._fields.values():
+            setattr(self, attribute, None)
+
+    def feed(self, line : str) -> bool:
+        """ Parses a line of rsync output
+
+        Returns True if the line was part of the statistics
+        """
+        key, sep, value = line.partition(': ')
+        if not sep or key not in self._fields:
+            return False
+        number = value.split()[0] if value.split() else '0'
+        try:
+            setattr(self, self._fields[key], ChangeLog.parseSize(number))
+        except ValueError:
+            return False
+        return True
+
+    def parse(self, output : str):
+        """ Parses the complete output of rsync """
+        for line in output.splitlines():
+            self.feed(line)
+        return self
@@ -0,0 +1,124 @@
+import heapq
+import logging
+import statistics
+from datetime import datetime, timedelta
+
+class Scheduler:
+    """ Orders backup jobs by their predicted duration
+
+    The duration of a job is predicted from the history of its earlier runs
+    in the state tracker. Jobs that have no recorded durations, but have
+    recorded transfer sizes, are predicted from the throughput of all jobs.
+
+    When several jobs run in parallel, the longest jobs are started first,
+    so that a giant job doesn't start last and delay the whole run. When
+    jobs run one at a time, jobs with a deadline are run first, earliest
+    deadline first. The remaining jobs keep their configured order.
+    """
+
+    def __init__(self, stateTracker = None, workers = 1):
+        """
+        Arguments:
+            stateTracker (StateTracker) : Source of the history, or None
+            workers (int) : Number of jobs that run at the same time
+        """
+        self.stateTracker = stateTracker
+        self.workers = max(1, workers)
+
+    def _history(self, job, section) -> list:
+        if self.stateTracker is None:
+            return []
+        return self.stateTracker.getHistory(job, section)
+
+    def throughput(self, jobs) -> float:
+        """ Bytes per second over the recorded runs of jobs, or None if unknown """
+        transferred = 0
+        duration = 0
+        for job in jobs:
+            sizes = self._history(job, 'Transferred')
+            durations = self._history(job, 'Duration')
+            n = min(len(sizes), len(durations))
+            if n:
+                transferred += sum(sizes[-n:])
+                duration += sum(durations[-n:])
+        return transferred / duration if duration > 0 and transferred > 0 else None
+
+    def predictDuration(self, job, throughput = None):
+        """ Predicted duration of a job in seconds, or None if unknown """
+        durations = self._history(job, 'Duration')
+        if durations:
+            return statistics.median(durations)
+        sizes = self._history(job, 'Transferred')
+        if sizes and throughput:
+            return statistics.median(sizes) / throughput
+        return None
+
+    @staticmethod
+    def deadline(job, now : datetime):
+        """ The next time of day at which the job must be finished, or None """
+        if getattr(job, 'deadline', None) is None:
+            return None
+        deadline = datetime.combine(now.date(), job.deadline)
+        if deadline <= now:
+            deadline += timedelta(days=1)
+        return deadline
+
+    def order(self, jobs, now = None) -> list:
+        """ Returns the jobs in the order they should be started """
+        now = now or datetime.now()
+        throughput = self.throughput(jobs)
+        durations = { job.name : self.predictDuration(job, throughput) for job in jobs }
+
+        if self.workers > 1:
+            # Longest first. Jobs without history may be long as well
+            key = lambda job: -durations[job.name] if durations[job.name] is not None else float('-inf')
+        else:
+            # Earliest deadline first, then the others in configured order
+            key = lambda job: self.deadline(job, now) or datetime.max
+        return sorted(jobs, key=key)
+
+    def plan(self, jobs, now = None) -> list:
+        """ Predicts when each job is started and finished when run in the given order
+
+        Returns a list of (job, start, finish), where finish is None if the
+        duration of the job is unknown
+        """
+        now = now or datetime.now()
+        throughput = self.throughput(jobs)
+
+        # The time at which each worker is free
+        free = [ now ] * self.workers
+        plan = []
+        for job in jobs:
+            start = heapq.heappop(free)
+            duration = self.predictDuration(job, throughput)
+            finish = start + timedelta(seconds=duration) if duration is not None else None
+            heapq.heappush(free, finish or start)
+            plan.append((job, start, finish))
+        return plan
+
+    def checkWindow(self, jobs, now = None) -> list:
+        """ Warns about jobs that are predicted to finish after their deadline
+
+        Returns the list of late jobs
+        """
+        now = now or datetime.now()
+        plan = self.plan(jobs, now)
+
+        late = []
+        for job, start, finish in plan:
+            if finish is None:
+                logging.debug('No history of job %s, its duration is unknown', job)
+                continue
+            logging.debug('Job %s is predicted to run %s - %s', job, start.strftime('%H:%M'), finish.strftime('%H:%M'))
+            deadline = self.deadline(job, now)
+            if deadline is not None and finish > deadline:
+                logging.warning('Job %s is predicted to finish at %s, after its deadline %s',
+                    job, finish.strftime('%H:%M'), deadline.strftime('%H:%M'))
+                late.append(job)
+
+        finishes = [ finish for job, start, finish in plan if finish is not None ]
+        if finishes:
+            logging.info('Predicted to finish %d jobs at %s%s', len(plan), max(finishes).strftime('%H:%M'),
+                '' if len(finishes) == len(plan) else f' ({len(plan) - len(finishes)} jobs without history)')
+        return late
@@ -0,0 +1,63 @@
+import logging
+import os
+import re
+import subprocess
+
+from .errors import SshError
+from .callStats import callStats
+
+class SshAgent:
+    """ A temporary ssh-agent that holds one key
+
+    Used to forward the credentials of a job to a relay host with ssh -A,
+    without deploying the private key there. The agent is started when the
+    context is entered and killed when it is left. SSH_AUTH_SOCK is set for
+    child processes in between.
+    """
+
+    # Lifetime of the key in the agent, in seconds
+    keyLifetime = 24 * 3600
+
+    def __init__(self, keyFile):
+        self.keyFile = str(keyFile)
+        self._pid = None
+        self._previousSocket = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        try:
+            output = callStats.checkOutput('agent', ['ssh-agent', '-s'], stderr=subprocess.PIPE).decode('utf-8')
+            socket = re.search(r'SSH_AUTH_SOCK=([^;]+);', output).group(1)
+            self._pid = int(re.search(r'SSH_AGENT_PID=(\d+);', output).group(1))
+        except (OSError, subprocess.CalledProcessError, AttributeError):
+            raise SshError('Could not start ssh-agent')
+
+        logging.debug('Started ssh-agent %d for forwarding %s', self._pid, self.keyFile)
+        self._previousSocket = os.environ.get('SSH_AUTH_SOCK')
+        os.environ['SSH_AUTH_SOCK'] = socket
+
+        try:
+            callStats.checkOutput('agent', ['ssh-add', '-t', str(self.keyLifetime), self.keyFile], stderr=subprocess.PIPE)
+        except subprocess.CalledProcessError as e:
+            self.stop()
+            raise SshError('ssh-add failed %d: %s' %(e.returncode, e.stderr.decode("utf-8").rstrip()))
+
+    def stop(self):
+        if self._pid is None:
+            return
+        try:
+            os.kill(self._pid, 15)
+        except OSError:
+            pass
+        logging.debug('Stopped ssh-agent %d', self._pid)
+        self._pid = None
+        if self._previousSocket is None:
+            os.environ.pop('SSH_AUTH_SOCK', None)
+        else:
+            os.environ['SSH_AUTH_SOCK'] = self._previousSocket
@@ -1,5 +1,6 @@
 import configparser
 import logging
+import threading
 from datetime import datetime, timedelta
 
 from . import time
@@ -14,14 +15,39 @@ class StateTracker:
     job1 = 2020-10-03
     job2 = 2020-10-03
 
+    The history of the last runs of each job is kept in other sections,
+    with the latest value last
+
+    [Transferred]
+    job1 = 1048576,2097152
+
+    [Duration]
+    job1 = 3600,3700
+
+    [Incremental]
+    job1 = 2097152
+
+    Incremental only holds the transfers of runs that were linked to an
+    earlier snapshot, which estimate the size of the next backup.
+
+    The ssh cipher and MAC chosen by tune-ssh for each host
+
+    [SshCipher]
+    nas.example.com = aes128-ctr umac-64-etm@openssh.com
+
     """
 
     defaultStateFilePath = '/var/local/backup.state'
+
+    # Number of runs that are kept in the history
+    historyLength = 10
     
     def __init__(self, filePath = defaultStateFilePath):
         self.filePath = filePath
         self.today = time.today
         self.state = configparser.ConfigParser()
+        # Jobs may be backed up in parallel
+        self._lock = threading.Lock()
 
         # Might fail if the file doesn't exist
         self._read()
@@ -45,12 +71,19 @@ class StateTracker:
         with open(self.filePath, 'w') as stateFile:
             self.state.write(stateFile)
 
+    def getLastGood(self, job) -> str:
+        """ The date of the last good backup of a job, or None """
+        try:
+            return self.state['LastGood'][str(job)]
+        except KeyError:
+            return None
+
     def getJobAge(self, job):
         """ Get the job age in days """
 
         try:
             dateStr = self.state['LastGood'][str(job)]
-            lastDate = datetime.strptime(dateStr, '%Y-%m-%d')
+            lastDate = time.parseSnapshot(dateStr)
             logging.debug('lastDate ' + lastDate.isoformat())
             logging.debug('today is ' + datetime.now().isoformat())
             lastAge = datetime.now() - lastDate
@@ -73,15 +106,72 @@ class StateTracker:
         
         Arguments:
             job (str) : Job identifier
-            lastGood (str) : Date string of last good backup date or None
-                to specify self.today
+            lastGood (str) : Date or snapshot name of the last good backup, or
+                None to specify self.today
         """
 
-        # Init the state if it is empty
-        if not 'LastGood' in self.state:
-            self.state['LastGood'] = {}
-        
-        # Set last good date for the specified job
-        self.state['LastGood'][str(job)] = lastGood if lastGood is not None else self.today
+        with self._lock:
+            # Init the state if it is empty
+            if not 'LastGood' in self.state:
+                self.state['LastGood'] = {}
+            
+            # Set last good date for the specified job
+            self.state['LastGood'][str(job)] = lastGood if lastGood is not None else self.today
 
-        self._dirty = True
+            self._dirty = True
+
+    def getHistory(self, job : str, section : str) -> list:
+        """ Get the recorded values of a job, oldest first
+
+        Arguments:
+            job (str) : Job identifier
+            section (str) : What to get, e.g. 'Transferred' or 'Duration'
+        """
+        try:
+            return [ int(value) for value in self.state[section][str(job)].split(',') if value ]
+        except (KeyError, ValueError):
+            return []
+
+    def recordRun(self, job : str, transferred = None, duration = None, incremental = False):
+        """ Adds a completed run of a job to the history
+
+        Arguments:
+            job (str) : Job identifier
+            transferred (int) : Number of bytes transferred or None
+            duration (float) : Duration in seconds or None
+            incremental (bool) : The run was linked to an earlier snapshot
+        """
+        with self._lock:
+            runs = [('Transferred', transferred), ('Duration', duration)]
+            if incremental:
+                runs.append(('Incremental', transferred))
+            for section, value in runs:
+                if value is None:
+                    continue
+                if not section in self.state:
+                    self.state[section] = {}
+                values = self.getHistory(job, section) + [ int(value) ]
+                self.state[section][str(job)] = ','.join(map(str, values[-self.historyLength:]))
+
+            self._dirty = True
+
+    def getSshCiphers(self) -> dict:
+        """ Get the tuned ssh ciphers
+
+        Returns { host : (cipher, mac or None) }
+        """
+        if not 'SshCipher' in self.state:
+            return {}
+        ciphers = {}
+        for host, value in self.state['SshCipher'].items():
+            cipher, _, mac = value.partition(' ')
+            ciphers[host] = (cipher, mac or None)
+        return ciphers
+
+    def setSshCipher(self, host : str, cipher : str, mac = None):
+        """ Stores the ssh cipher and MAC to use for a host """
+        with self._lock:
+            if not 'SshCipher' in self.state:
+                self.state['SshCipher'] = {}
+            self.state['SshCipher'][host] = cipher + (' ' + mac if mac else '')
+            self._dirty = True
@@ -0,0 +1,311 @@
+import logging
+import os
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+
+from .callStats import callStats
+
+class RemoteSampler:
+    """ Samples the load of a remote host over the ssh connection of rsync
+
+    connect() opens a master connection to the host at controlPath, that
+    rsync uses as well when it is given sshOpts. The samples then run in a
+    session of that connection, without a connection and login of their own.
+    Without connect(), or if the master fails, the session connects by itself.
+
+    The session is kept open while rsync runs. Each sample is requested with
+    a line on stdin.
+    """
+
+    script = 'while read x; do cat /proc/loadavg; cat /proc/pressure/io 2>/dev/null; echo //; done'
+
+    def __init__(self, location, controlPath):
+        self.name = location.host
+        self.controlPath = controlPath
+        self._location = location
+        self._proc = None
+        self._master = False
+
+    @property
+    def sshOpts(self) -> list:
+        return ['-o', 'ControlPath=' + self.controlPath]
+
+    def _controlCmd(self, args) -> list:
+        return ['ssh'] + list(self._location.sshArgs) + self.sshOpts + args + [self._location.host]
+
+    def connect(self):
+        """ Opens the master connection, ssh returns once it is logged in """
+        cmd = self._controlCmd(['-M', '-N', '-f', '-o', 'ControlPersist=no'])
+        # The master stays in the background, so it must not hold a pipe of ours
+        with callStats.record('throttle', cmd):
+            returncode = subprocess.call(callStats.wrap(cmd), stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL)
+        self._master = returncode == 0
+        if not self._master:
+            logging.debug('No shared connection to %s, ssh failed with %d', self.name, returncode)
+
+    def start(self):
+        cmd = self._location._buildSshCmd(self.script, self.sshOpts)
+        # Counted as one call when it starts, as it runs alongside rsync
+        with callStats.record('throttle', cmd):
+            self._proc = subprocess.Popen(callStats.wrap(cmd), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL, text=True)
+
+    def sample(self) -> tuple:
+        """ Returns (load, io pressure) or None if the host didn't answer """
+        if self._proc is None or self._proc.poll() is not None:
+            return None
+        try:
+            self._proc.stdin.write('\n')
+            self._proc.stdin.flush()
+            lines = []
+            for line in self._proc.stdout:
+                if line.strip() == '//':
+                    return Throttle.parseSample(lines)
+                lines.append(line)
+        except (OSError, ValueError):
+            pass
+        return None
+
+    def close(self):
+        """ Closes the session, and the master connection if it was opened """
+        if self._master:
+            # Only talks to the local master
+            subprocess.run(self._controlCmd(['-O', 'exit']), stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL)
+            self._master = False
+        if self._proc is None:
+            return
+        # Ends the loop on the remote host
+        try:
+            self._proc.stdin.close()
+        except OSError:
+            pass
+        self._proc.terminate()
+        try:
+            self._proc.wait(10)
+        except subprocess.TimeoutExpired:
+            self._proc.kill()
+            self._proc.wait()
+        self._proc.stdout.close()
+        self._proc = None
+
+class Throttle:
+    """ Pauses rsync while the local or a remote host of a job is under load
+
+    Every interval seconds, the 1 minute load average and the share of time
+    that tasks waited for I/O during the last 10 seconds (PSI io some avg10,
+    in percent) are sampled on the local host and on the remote hosts of
+    the job. When a threshold is crossed on any host, rsync is stopped with
+    SIGSTOP. It is continued when all hosts are below resumeRatio of the
+    thresholds again, or when it has been paused for maxPause seconds in
+    total, so that a backup always finishes.
+
+    The local rsync processes are stopped, not ssh, so that the connection
+    stays up while the transfer waits. When the job is relayed, the local
+    process is ssh, and the relay rsync stops when its output is blocked.
+
+    The remote hosts are sampled over the connections of rsync: give rsync
+    sshOpts() of the host it connects to, and call connect() before it
+    starts. See RemoteSampler.
+    """
+
+    resumeRatio = 0.8
+
+    def __init__(self, remotes = None, maxLoad = None, maxIoPressure = None, interval = 30, maxPause = None,
+            onPause = None, onResume = None):
+        """
+        Arguments:
+            remotes (list(SshLocation)) : Remote locations whose hosts are sampled as well
+            maxLoad (float) : Load average that pauses rsync, or None
+            maxIoPressure (float) : I/O pressure in percent that pauses rsync, or None
+            interval (int) : Seconds between samples
+            maxPause (int) : Maximum total seconds to pause, or None
+            onPause, onResume : Called without arguments when rsync is paused and resumed
+        """
+        # ssh replaces %C with a hash of the host, port and user
+        controlPath = os.path.join(tempfile.gettempdir(), f'dbackup-{os.getpid()}-{id(self):x}-%C')
+        self.samplers = [ RemoteSampler(location, controlPath) for location in remotes or [] ]
+        self.maxLoad = maxLoad
+        self.maxIoPressure = maxIoPressure
+        self.interval = interval
+        self.maxPause = maxPause
+        self.onPause = onPause
+        self.onResume = onResume
+        self.pauses = 0
+        self._pausedTime = 0.0
+        self._pausedAt = None
+        self._proc = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def parseSample(lines) -> tuple:
+        """ Parses /proc/loadavg and /proc/pressure/io into (load, io pressure)
+
+        Either is None if unknown
+        """
+        load = None
+        pressure = None
+        for line in lines:
+            fields = line.split()
+            if fields and fields[0] == 'some':
+                values = dict(field.split('=', 1) for field in fields[1:] if '=' in field)
+                pressure = float(values['avg10']) if 'avg10' in values else None
+            elif len(fields) >= 3 and fields[0] not in ('full', 'some') and load is None:
+                try:
+                    load = float(fields[0])
+                except ValueError:
+                    pass
+        return load, pressure
+
+    @classmethod
+    def sampleLocal(cls) -> tuple:
+        lines = []
+        for path in ('/proc/loadavg', '/proc/pressure/io'):
+            try:
+                with open(path) as f:
+                    lines += f.read().splitlines()
+            except OSError:
+                pass
+        return cls.parseSample(lines)
+
+    def sample(self) -> dict:
+        """ Returns { host : (load, io pressure) } of the hosts that answered """
+        samples = { 'localhost': self.sampleLocal() }
+        for sampler in self.samplers:
+            result = sampler.sample()
+            if result is None:
+                logging.debug('No load sample from %s', sampler.name)
+            else:
+                samples[sampler.name] = result
+        return samples
+
+    def _exceeds(self, samples, ratio = 1.0) -> list:
+        """ Reasons why hosts are above ratio of the thresholds """
+        reasons = []
+        for host, (load, pressure) in samples.items():
+            if self.maxLoad is not None and load is not None and load > self.maxLoad * ratio:
+                reasons.append(f'load {load:.2f} on {host}')
+            if self.maxIoPressure is not None and pressure is not None and pressure > self.maxIoPressure * ratio:
+                reasons.append(f'io pressure {pressure:.1f}% on {host}')
+        return reasons
+
+    @property
+    def isPaused(self) -> bool:
+        return self._pausedAt is not None
+
+    @property
+    def pausedTime(self) -> float:
+        """ Total seconds that rsync has been paused, including a current pause """
+        with self._lock:
+            current = time.monotonic() - self._pausedAt if self._pausedAt is not None else 0.0
+            return self._pausedTime + current
+
+    @staticmethod
+    def _descendants(pid) -> list:
+        """ The pids of the children of a process, recursively """
+        pids = []
+        try:
+            for task in os.listdir(f'/proc/{pid}/task'):
+                with open(f'/proc/{pid}/task/{task}/children') as f:
+                    for child in map(int, f.read().split()):
+                        pids += [child] + Throttle._descendants(child)
+        except (OSError, ValueError):
+            pass
+        return pids
+
+    def _signal(self, sig):
+        """ Signals rsync and its children, except ssh """
+        pids = [ self._proc.pid ]
+        for pid in self._descendants(self._proc.pid):
+            try:
+                with open(f'/proc/{pid}/comm') as f:
+                    if f.read().strip() == 'ssh':
+                        continue
+            except OSError:
+                continue
+            pids.append(pid)
+        for pid in pids:
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def pause(self, reasons):
+        logging.warning('Pausing rsync: %s', ', '.join(reasons))
+        self._signal(signal.SIGSTOP)
+        with self._lock:
+            self._pausedAt = time.monotonic()
+        self.pauses += 1
+        if self.onPause is not None:
+            self.onPause()
+
+    def resume(self, reason):
+        self._signal(signal.SIGCONT)
+        with self._lock:
+            paused = time.monotonic() - self._pausedAt
+            self._pausedTime += paused
+            self._pausedAt = None
+        logging.info('Resuming rsync after %.0f s: %s', paused, reason)
+        if self.onResume is not None:
+            self.onResume()
+
+    def check(self, samples = None):
+        """ Pauses or resumes rsync depending on the load """
+        samples = self.sample() if samples is None else samples
+        if not self.isPaused:
+            reasons = self._exceeds(samples)
+            if reasons:
+                if self.maxPause is not None and self.pausedTime >= self.maxPause:
+                    logging.debug('Not pausing rsync, it has been paused for %.0f s', self.pausedTime)
+                else:
+                    self.pause(reasons)
+        elif self.maxPause is not None and self.pausedTime >= self.maxPause:
+            self.resume(f'paused for the maximum of {self.maxPause} s')
+        elif not self._exceeds(samples, self.resumeRatio):
+            self.resume('load is down')
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                logging.warning('Throttle failed: %s', e)
+
+    def sshOpts(self, location) -> list:
+        """ ssh options that share the connection to the host of location with the samples """
+        for sampler in self.samplers:
+            if sampler._location.hostKey == location.hostKey:
+                return sampler.sshOpts
+        return []
+
+    def connect(self):
+        """ Opens the connections to the remote hosts, before rsync starts """
+        for sampler in self.samplers:
+            sampler.connect()
+
+    def attach(self, proc):
+        """ Starts sampling while proc runs """
+        self._proc = proc
+        self._stop.clear()
+        for sampler in self.samplers:
+            sampler.start()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def detach(self):
+        """ Stops sampling and closes the connections, and resumes rsync if it is paused """
+        self._stop.set()
+        for sampler in self.samplers:
+            # Unblocks a sample that is waiting for an answer
+            sampler.close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.isPaused:
+            self.resume('rsync is done')
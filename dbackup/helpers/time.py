@@ -3,19 +3,33 @@ import logging
 import time
 
 today = time.strftime( "%Y-%m-%d")
+timeOfDay = time.strftime("%H%M")
+
+# Snapshots are named by their date, YYYY-MM-DD, or by date and time,
+# YYYY-MM-DDTHHMM, when several are made each day. Names sort by time, a
+# date only name as midnight
+snapshotPattern = r'\d{4}-\d{2}-\d{2}(?:T\d{4})?'
+
+def snapshotName(date : str, timeOfDay : str = None) -> str:
+    """ The name of a snapshot made on date, or at timeOfDay (HHMM) on date """
+    return date if timeOfDay is None else f'{date}T{timeOfDay}'
+
+def parseSnapshot(name : str) -> datetime:
+    """ The time of a snapshot from its name, midnight for date only names """
+    return datetime.strptime(name, '%Y-%m-%dT%H%M' if 'T' in name else '%Y-%m-%d')
 
 def checkAge(dateStr, okLimitDays = 2):
     """ Checks if the age of a date is smaller than a limit
     
     Arguments:
-        dateStr (str) : the date of interest
+        dateStr (str) : the date of interest, or a snapshot name
         okLimitDays (int, optional) : Maximum age in days to be considered OK
 
     Returns
         (state, lastDate)
     """
     try:
-        lastDate = datetime.strptime(dateStr, '%Y-%m-%d')
+        lastDate = parseSnapshot(dateStr)
         logging.debug('lastDate ' + lastDate.isoformat())
         logging.debug('today is ' + datetime.now().isoformat())
         lastAge = datetime.now() - lastDate
@@ -1,9 +1,12 @@
+import copy
 import os
 import re
 from . import location
 #from .location.factory import Factory
 from pathlib import Path
+from datetime import datetime
 from .sshArgs import SshArgs
+from .helpers import getBool, Priority, Excludes
 
 class Job:
     """ Defines a single backup job 
@@ -17,8 +20,37 @@ class Job:
         ssharg
         days
         months
+        hours
+        timestamps
         exec before
         exec after
+        manifest
+        changelog
+        catalog
+        preflight
+        relay
+        relay key
+        retries
+        retry delay
+        stall timeout
+        partial
+        deadline
+        nice
+        ionice
+        io weight
+        memory max
+        max load
+        max io pressure
+        throttle interval
+        max pause
+        exclude caches
+        exclude presets
+        max file size
+        password file
+        daemon ssh
+        storage
+        chunk size
+        gc time
 
 
     Attributes:
@@ -26,15 +58,72 @@ class Job:
         rsyncArgs (list(str)) : Extra arguments to rsync command
         daysToKeep (int) : Number of days to keep daily backups
         monthsToKeep (int) : Number of months to keep monthly backups
+        hoursToKeep (int) : Number of hours to keep hourly backups
+        timestamps (bool) : Name the snapshots by date and time, so that
+            several backups a day make separate snapshots
         sshPort (int) : The ssh port
         sshHostKeyFile (str) : path to the ssh host key file to use or None if not specified
         sshArgs (list(str)) : ssh arguments
 
         source (Location) : Source location (the files to backup)
         dest (Location) : Dest location (this is where the backups are stored)
+            Either may be an rsync daemon, rsync://[user@]host[:port]/module/path,
+            when the other is local. The daemon password is read from password
+            file, and daemon ssh is the ssh location of the module directory,
+            user@host:path, that is used to rename and delete snapshots. It is
+            required when dest is a daemon
+        extraDests (list(Location)) : More destinations, when dest lists
+            several locations on separate lines. Each new
+            snapshot in dest is replicated to them, see replicas()
 
         execBefore (str) : A command to execute before backup or None
         execAfter (str) : A command to execute after backup
+
+        manifest (bool) : Write a content manifest for each new snapshot
+        changeLog (bool) : Keep a log of changed files in each new snapshot
+        catalog (bool) : Add each new snapshot to the catalog of the destination
+        preflight (str) : How to estimate the transfer size before a backup,
+            'history', 'dryrun' or 'no' to skip the free space check
+
+        relay (str) : When both source and dest are remote, rsync is run on
+            the 'dest' host (pulling) or on the 'source' host (pushing). None
+            if either location is local
+        relayKey (str) : Path to a key on the relay host for reaching the
+            other host, or None to forward the job's cert with an agent
+
+        retries (int) : Number of times a failed or stalled rsync is retried
+        retryDelay (int) : Seconds to wait before the first retry, doubled
+            for each following retry
+        stallTimeout (int) : Seconds without output or transferred bytes
+            before rsync is killed, or None to wait forever (the default)
+        partial (bool) : Keep partially transferred files, so that a retry
+            resumes them
+
+        deadline (datetime.time) : Time of day when the backup should be
+            finished, or None. Used to order jobs, see Scheduler
+
+        priority (Priority) : CPU and I/O priority of the processes of the
+            job, from nice, ionice (class[:level]), io weight and memory max
+
+        maxLoad (float) : Load average on the local or a remote host that
+            pauses rsync, or None
+        maxIoPressure (float) : I/O pressure (PSI io some avg10, percent)
+            that pauses rsync, or None
+        throttleInterval (int) : Seconds between load samples
+        maxPause (int) : Maximum seconds that rsync is paused in total, or
+            None for no limit. See Throttle
+
+        excludes (Excludes) : Caches and files that are left out of the
+            backups, from exclude caches, exclude presets (comma separated
+            names) and max file size
+
+        storage (str) : 'snapshots' for hard linked snapshots, or 'chunks' to
+            store the snapshots in a chunk deduplicating store, for large
+            files that change in place. Manifests and the catalog are not
+            supported with chunks, and there can only be one destination
+        chunkSize (int) : Average chunk size in bytes, a power of two
+        gcTime (int) : Seconds that the garbage collection of the chunk store
+            may run in each clean, or None for no limit
     """
 
 
@@ -53,14 +142,81 @@ class Job:
 
         self.daysToKeep = int(jobConfig['days']) if 'days' in jobConfig else 3
         self.monthsToKeep = int(jobConfig['months']) if 'months' in jobConfig else 3
+        self.timestamps = getBool(jobConfig, 'timestamps')
+        self.hoursToKeep = int(jobConfig['hours']) if 'hours' in jobConfig else (24 if self.timestamps else 0)
 
         # Generate locations for source and dest. sshArgs are assembled below
-        self.source = location.Factory(jobConfig['source'], sshArgs=self.sshArgs, simulate=simulate)
-        self.dest   = location.Factory(jobConfig['dest'],   sshArgs=self.sshArgs, simulate=simulate)
+        self.passwordFile = jobConfig['password file'] if 'password file' in jobConfig else None
+        self.daemonSsh = jobConfig['daemon ssh'] if 'daemon ssh' in jobConfig else None
+        # Only newlines separate destinations, paths may contain commas
+        dests = [ spec.strip() for spec in jobConfig['dest'].splitlines() if spec.strip() ]
+        assert dests, 'dest must list at least one location'
+        self.source = self.makeLocation(jobConfig['source'], simulate)
+        self.dest   = self.makeLocation(dests[0], simulate)
+        self.extraDests = [ self.makeLocation(spec, simulate) for spec in dests[1:] ]
+        locations = [ self.source, self.dest ] + self.extraDests
+        if any(loc.isDaemon for loc in locations):
+            # rsync can't copy between two remote hosts
+            assert not any(loc.isRemote for loc in locations), 'rsync daemon locations can only be used with local locations'
+            assert self.daemonSsh is not None or not any(loc.isDaemon for loc in locations[1:]), \
+                'daemon ssh is required when dest is an rsync daemon'
 
         self.execBefore = jobConfig['exec before'] if 'exec before' in jobConfig else None
         self.execAfter = jobConfig['exec after'] if 'exec after' in jobConfig else None
 
+        self.manifest = getBool(jobConfig, 'manifest')
+        self.changeLog = getBool(jobConfig, 'changelog', True)
+        self.catalog = getBool(jobConfig, 'catalog')
+        self.preflight = jobConfig['preflight'].lower() if 'preflight' in jobConfig else 'history'
+        assert self.preflight in ('history', 'dryrun', 'no'), 'preflight must be history, dryrun or no'
+
+        relay = jobConfig['relay'].lower() if 'relay' in jobConfig else 'dest'
+        assert relay in ('source', 'dest'), 'relay must be source or dest'
+        self._relayConfig = relay
+        self.relay = relay if self.source.isRemote and self.dest.isRemote else None
+        self.relayKey = jobConfig['relay key'] if 'relay key' in jobConfig else None
+
+        self.retries = int(jobConfig['retries']) if 'retries' in jobConfig else 2
+        self.retryDelay = int(jobConfig['retry delay']) if 'retry delay' in jobConfig else 60
+        stallMinutes = int(jobConfig['stall timeout']) if 'stall timeout' in jobConfig else 0
+        self.stallTimeout = stallMinutes * 60 if stallMinutes > 0 else None
+        self.partial = getBool(jobConfig, 'partial', True)
+        self.deadline = datetime.strptime(jobConfig['deadline'], '%H:%M').time() if 'deadline' in jobConfig else None
+
+        ioClass, ioLevel = Priority.parseIoNice(jobConfig['ionice']) if 'ionice' in jobConfig else (None, None)
+        self.priority = Priority(
+            nice = int(jobConfig['nice']) if 'nice' in jobConfig else None,
+            ioClass = ioClass,
+            ioLevel = ioLevel,
+            ioWeight = int(jobConfig['io weight']) if 'io weight' in jobConfig else None,
+            memoryMax = jobConfig['memory max'] if 'memory max' in jobConfig else None)
+        for loc in [ self.source, self.dest ] + self.extraDests:
+            loc.priority = self.priority
+
+        self.maxLoad = float(jobConfig['max load']) if 'max load' in jobConfig else None
+        self.maxIoPressure = float(jobConfig['max io pressure']) if 'max io pressure' in jobConfig else None
+        self.throttleInterval = int(jobConfig['throttle interval']) if 'throttle interval' in jobConfig else 30
+        pauseMinutes = int(jobConfig['max pause']) if 'max pause' in jobConfig else 120
+        self.maxPause = pauseMinutes * 60 if pauseMinutes > 0 else None
+
+        self.excludes = Excludes(
+            caches = getBool(jobConfig, 'exclude caches'),
+            presets = [ name.strip() for name in jobConfig['exclude presets'].split(',') if name.strip() ]
+                if 'exclude presets' in jobConfig else [],
+            maxSize = Excludes.parseSize(jobConfig['max file size']) if 'max file size' in jobConfig else None)
+
+        self.storage = jobConfig['storage'].lower() if 'storage' in jobConfig else 'snapshots'
+        assert self.storage in ('snapshots', 'chunks'), 'storage must be snapshots or chunks'
+        self.chunkSize = Excludes.parseSize(jobConfig['chunk size']) if 'chunk size' in jobConfig else 1024 * 1024
+        assert self.chunkSize & (self.chunkSize - 1) == 0, 'chunk size must be a power of two'
+        gcMinutes = int(jobConfig['gc time']) if 'gc time' in jobConfig else 10
+        self.gcTime = gcMinutes * 60 if gcMinutes > 0 else None
+        if self.storage == 'chunks':
+            # These work on the files in the snapshots, which only hold the chunk manifest
+            self.manifest = False
+            self.catalog = False
+            assert not self.extraDests, 'storage = chunks supports a single dest'
+
         assert isinstance(self.source, location.Location)
         assert isinstance(self.dest, location.Location)
 
@@ -68,6 +224,11 @@ class Job:
         """ Implicit conversion to string """
         return self.name
 
+    def makeLocation(self, spec : str, simulate = False):
+        """ A location with the ssh arguments and daemon options of the job """
+        return location.Factory(spec, sshArgs=self.sshArgs, simulate=simulate, passwordFile=self.passwordFile,
+            daemonSsh=self.daemonSsh)
+
     @property
     def simulate(self):
         return self._simulate
@@ -76,6 +237,8 @@ class Job:
     def simulate(self, simulate):
         self.source.simulate = simulate
         self.dest.simulate = simulate
+        for dest in self.extraDests:
+            dest.simulate = simulate
         self._simulate = simulate
 
     @property
@@ -92,3 +255,48 @@ class Job:
     def id(self) -> str:
         return self.name
 
+    @property
+    def relayLocation(self):
+        """ The location whose host runs rsync for remote to remote jobs, or None """
+        if self.relay is None:
+            return None
+        return self.dest if self.relay == 'dest' else self.source
+
+    def forDest(self, index : int):
+        """ The job as it applies to extraDests[index], e.g. for cleaning
+
+        It is named <job>.dest<n>, where n is 2 for the first extra destination
+        """
+        job = copy.copy(self)
+        job.name = f'{self.name}.dest{index + 2}'
+        job.dest = self.extraDests[index]
+        job.extraDests = []
+        job.relay = self._relayConfig if job.source.isRemote and job.dest.isRemote else None
+        return job
+
+    def destJobs(self) -> list:
+        """ The job for each of its destinations, dest first """
+        return [ self ] + [ self.forDest(index) for index in range(len(self.extraDests)) ]
+
+    def copyJob(self, snapshot : str, dest, name : str):
+        """ A job that copies a snapshot in dest to another location
+
+        The source of the job is the snapshot, so the source of this job
+        isn't read again. The hooks are not run, and nothing is excluded.
+        """
+        job = copy.copy(self)
+        job.name = name
+        job.source = self.makeLocation(os.path.join(self.dest.spec, snapshot), self.dest.simulate)
+        job.source.priority = self.priority
+        job.dest = dest
+        job.extraDests = []
+        job.relay = self._relayConfig if job.source.isRemote and job.dest.isRemote else None
+        job.execBefore = None
+        job.execAfter = None
+        job.excludes = Excludes()
+        return job
+
+    def replicas(self, snapshot : str) -> list:
+        """ Jobs that copy a snapshot in dest to each of the extra destinations """
+        return [ self.copyJob(snapshot, dest, f'{self.name}.dest{index + 2}')
+            for index, dest in enumerate(self.extraDests) ]
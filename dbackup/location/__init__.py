@@ -1,4 +1,5 @@
 from .location import Location
 from .localLocation import LocalLocation
 from .sshLocation import SshLocation
+from .rsyncDaemonLocation import RsyncDaemonLocation
 from .factory import Factory
\ No newline at end of file
@@ -1,12 +1,15 @@
 
 from ..sshArgs import SshArgs
-from . import LocalLocation, SshLocation
+from . import LocalLocation, SshLocation, RsyncDaemonLocation
 import re
 
 # TODO: Refactor so that the entire job specification is available to the factory
-def Factory( spec, sshArgs : SshArgs = None, simulate = False):
+def Factory( spec, sshArgs : SshArgs = None, simulate = False, passwordFile = None, daemonSsh = None):
 
-    if re.match(r'^[^@:]*@[^@:]*:.*$', spec) is not None:
+    if spec.startswith('rsync://'):
+        return RsyncDaemonLocation(spec, sshArgs = sshArgs, passwordFile = passwordFile, daemonSsh = daemonSsh,
+            simulate = simulate)
+    elif re.match(r'^[^@:]*@[^@:]*:.*$', spec) is not None:
         return SshLocation(spec, sshArgs = sshArgs, simulate = simulate)
     else:
         return LocalLocation(spec, simulate = simulate)
\ No newline at end of file
@@ -1,7 +1,13 @@
 from . import Location
 import os
+import sys
 import logging
 import shutil
+import subprocess
+import shlex
+
+from ..helpers.errors import ScriptError
+from ..helpers.callStats import callStats
 
 class LocalLocation(Location):
 
@@ -20,6 +26,13 @@ class LocalLocation(Location):
     def __str__(self):
         return f'LocalLocation:{self.path}'
 
+    @property
+    def filesystemKey(self) -> str:
+        try:
+            return f'local:{os.stat(self.path).st_dev}'
+        except OSError:
+            return f'local:{self.path}'
+
     def rsyncPath(self, subpath = None):
         return self.path if subpath is None else os.path.join(self.path, subpath)
 
@@ -83,9 +96,68 @@ class LocalLocation(Location):
             for n in name:
                 filePath = os.path.join(self.path, n)
                 logging.debug('Removing ' + filePath)
-                if not self.simulate:
+                if self.simulate:
+                    continue
+                if self.priority:
+                    # Delete in a child process that runs with the priority of the job
+                    proc = callStats.run('delete', ['rm', '-rf', '--', filePath], stderr=subprocess.PIPE)
+                    if proc.returncode != 0:
+                        logging.error('Could not remove %s: %s', filePath, proc.stderr.decode('utf-8', 'replace').rstrip())
+                        return False
+                else:
                     shutil.rmtree(filePath)
             return True
         except PermissionError as e:
             logging.error('Permission denied: %s', e.filename)
-        return False
\ No newline at end of file
+        return False
+
+    def freeSpace(self):
+        """ Get the number of bytes available to unprivileged users """
+        try:
+            st = os.statvfs(self.path)
+            return st.f_bavail * st.f_frsize
+        except OSError:
+            return None
+
+    def readFile(self, subpath, localPath):
+        """ Copies a file from the location to a local file """
+        try:
+            shutil.copyfile(os.path.join(self.path, subpath), localPath)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def writeFile(self, subpath, localPath):
+        """ Copies a local file into the location """
+        filePath = os.path.join(self.path, subpath)
+        logging.debug('Writing %s', filePath)
+        if self.simulate:
+            return True
+        try:
+            os.makedirs(os.path.dirname(filePath), exist_ok=True)
+            shutil.copyfile(localPath, filePath)
+            return True
+        except OSError as e:
+            logging.error('Could not write %s: %s', filePath, e.strerror)
+        return False
+
+    def _runScript(self, source, args):
+        """ Runs the script in an isolated local python interpreter """
+        cmd = [sys.executable, '-I', '-'] + list(args)
+        try:
+            output = callStats.run('tool', cmd, input=source, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+            return output.stdout
+        except subprocess.CalledProcessError as e:
+            raise ScriptError('Script failed %d: %s' %(e.returncode, e.stderr.decode("utf-8").rstrip()))
+
+    def _streamScript(self, source, args, outFile, pipe = None):
+        """ Runs the script in an isolated local python interpreter, optionally piped through a shell command """
+        cmd = ' '.join(shlex.quote(str(a)) for a in [sys.executable, '-I', '-'] + list(args))
+        if pipe:
+            cmd += ' | ' + pipe
+        with callStats.record('stream', cmd):
+            proc = subprocess.Popen(callStats.wrap(cmd), shell=True, stdin=subprocess.PIPE, stdout=outFile, stderr=subprocess.PIPE)
+            _, stderr = proc.communicate(source)
+        if proc.returncode != 0:
+            raise ScriptError('Script failed %d: %s' %(proc.returncode, stderr.decode("utf-8", "replace").rstrip()))
+        return stderr
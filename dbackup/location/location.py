@@ -1,12 +1,15 @@
 import re
 import os
+import json
 import logging
 import subprocess
 from abc import abstractmethod
 
 from ..helpers.errors import SshError
+from ..helpers.time import snapshotPattern
 
 from .. import incomplete
+from .. import tools
 
 class Location:
     """ Location is a class that handles local and remote RSYNC locations
@@ -14,6 +17,10 @@ class Location:
         user@host:path/to/location
 
     """
+
+    # Priority of the processes that work on the location, or None
+    priority = None
+
     def __init__(self, spec, typeName = None, simulate = False):
         self.spec = spec
         #self.type = 'remote' if re.match(r'^[^@:]*@[^@:]*:.*$', spec) is not None else 'local'
@@ -29,6 +36,20 @@ class Location:
     def isRemote(self):
         return self.typeName == 'remote'
 
+    @property
+    def isDaemon(self):
+        return self.typeName == 'daemon'
+
+    @property
+    def hostKey(self) -> str:
+        """ Identifies the host of the location, e.g. to group locations by host """
+        return 'local'
+
+    @property
+    def filesystemKey(self) -> str:
+        """ Identifies the filesystem of the location, as far as it can be known cheaply """
+        return self.hostKey
+
     @property
     def path(self):
         return self._path
@@ -41,6 +62,14 @@ class Location:
     def rsyncPath(self, subpath = None):
         return None
 
+    def transferOpts(self) -> list:
+        """ rsync options that are needed to transfer files to or from the location """
+        return []
+
+    def linkDest(self, name : str) -> str:
+        """ The --link-dest path of the snapshot name, for a transfer into the location """
+        return self.path + '/' + name
+
     @abstractmethod
     def _createLocal(self) -> bool:
         """ Creates local location """
@@ -76,18 +105,49 @@ class Location:
         """
 
         # List all files in dest folder
-        folderList = self.listDir()
+        return self.filterBackups(self.listDir(), includeAll)
 
+    @staticmethod
+    def filterBackups(folderList, includeAll = False):
+        """ Filters the backup names out of a directory listing
+
+        Returns None if folderList is None
+        """
         if folderList is not None:
             # Filter out backup names
             if includeAll:
-                dirNameRegex = re.compile(r'^\d{4}-\d{2}-\d{2}(' + incomplete.suffix + '|)$')
+                dirNameRegex = re.compile('^' + snapshotPattern + '(' + re.escape(incomplete.suffix) + '|)$')
             else:
-                dirNameRegex = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+                dirNameRegex = re.compile('^' + snapshotPattern + '$')
             return list(filter(dirNameRegex.match, folderList))
         else:
             return None
 
+    @classmethod
+    def listDirs(cls, locations : list, timeout = None) -> list:
+        """ Lists the directories of several locations on the same host
+
+        Subclasses may do it in a single call to the host, and give up
+        after timeout seconds. This implementation ignores timeout, callers
+        that must not hang enforce it themselves, like Reconcile
+
+        Returns a list with the listDir() result of each location
+        """
+        return [ location.listDir() for location in locations ]
+
+    @classmethod
+    def deleteChildren(cls, requests : list) -> list:
+        """ Removes children of several locations on the same host
+
+        Subclasses may do it in a single call to the host
+
+        Arguments:
+            requests (list) : (location, [names]) tuples
+
+        Returns a list with the success of each request
+        """
+        return [ location.deleteChild(names) for location, names in requests ]
+
 
     @abstractmethod
     def renameChild(self, oldName, newName):
@@ -97,4 +157,72 @@ class Location:
     def deleteChild(self, name):
         """ Removes a file/dir in the location and all sub-files/folders
         """
-        pass
\ No newline at end of file
+        pass
+
+    @abstractmethod
+    def freeSpace(self) -> int:
+        """ Get the number of bytes available in the location
+
+        Returns None if it can't be determined
+        """
+        return None
+
+    @abstractmethod
+    def readFile(self, subpath : str, localPath : str) -> bool:
+        """ Copies a file from the location to a local file
+
+        Returns False if the file doesn't exist in the location
+        """
+        return False
+
+    @abstractmethod
+    def writeFile(self, subpath : str, localPath : str) -> bool:
+        """ Copies a local file to the location, creating parent directories """
+        return False
+
+    @abstractmethod
+    def _runScript(self, source : bytes, args : list) -> bytes:
+        """ Executes python source with arguments on the host of the location
+
+        Returns the stdout of the script
+        """
+        assert False, 'This method should be overloaded'
+
+    @abstractmethod
+    def _streamScript(self, source : bytes, args : list, outFile, pipe = None) -> bytes:
+        """ Executes python source on the host of the location, streaming its output
+
+        Arguments:
+            outFile : File object that receives the output
+            pipe (str) : Shell command on the same host that the output is piped through
+
+        Returns stderr. Raises ScriptError if the script or pipe failed
+        """
+        return b''
+
+    def runTool(self, name : str, args : list) -> list:
+        """ Runs a tool script from dbackup.tools where the files are
+
+        The tools write one JSON object per line to stdout.
+
+        Arguments:
+            name (str) : Name of the tool, e.g. 'manifest'
+            args (list(str)) : Arguments to the tool
+
+        Returns a list of the objects reported by the tool
+        """
+        source = tools.scriptSource(name)
+        logging.debug('Running tool %s %s on %s', name, ' '.join(args), str(self))
+        output = self._runScript(source, args)
+        return [ json.loads(line) for line in output.decode('utf-8').splitlines() if line.strip() ]
+
+    def streamTool(self, name : str, args : list, outFile, pipe = None) -> bytes:
+        """ Runs a tool script where the files are and writes its output to outFile
+
+        Unlike runTool(), the output isn't kept in memory, so it may be of any size
+
+        Returns what the tool wrote to stderr
+        """
+        source = tools.scriptSource(name)
+        logging.debug('Streaming tool %s %s on %s', name, ' '.join(args), str(self))
+        return self._streamScript(source, args, outFile, pipe)
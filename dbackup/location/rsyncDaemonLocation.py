@@ -0,0 +1,221 @@
+from . import Location
+from .sshLocation import SshLocation
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+
+from ..helpers import DaemonError, ScriptError, ArgumentError
+from ..helpers import callStats
+from ..sshArgs import SshArgs
+
+class RsyncDaemonLocation(Location):
+    """ Locations in a module of an rsync daemon
+
+    Location specification has the form rsync://[user]@host[:port]/module/path
+
+    Files are transferred by the daemon, without the encryption of ssh, so
+    it is meant for trusted networks with slow hosts. The password of the
+    daemon user is read from passwordFile.
+
+    The daemon can only list, read and write files. Renaming and deleting
+    snapshots, checking free space and running tools is done with ssh to
+    the host, in daemonSsh, the ssh location of the module directory, e.g.
+    admin@nas:/volume1/backup. Without it, the location can still be the
+    source of a job.
+    """
+
+    defaultPort = 873
+
+    # Seconds to wait for the daemon to accept a connection
+    connectTimeout = 30
+
+    _priority = None
+
+    def __init__(self, spec, sshArgs : SshArgs = None, passwordFile = None, daemonSsh = None, simulate = False):
+        # Set before the base class sets simulate, which is passed on
+        self.ssh = None
+        super().__init__(spec, typeName='daemon', simulate=simulate)
+
+        m = re.match(r'^rsync://(?:([^@/]*)@)?([^@:/]+)(?::(\d+))?/([^/]+)/*(.*)$', spec)
+        if m is None:
+            raise ArgumentError('Invalid rsync daemon location ' + spec)
+        self.user = m.group(1) or None
+        self.host = m.group(2)
+        self.port = int(m.group(3)) if m.group(3) else self.defaultPort
+        self.module = m.group(4)
+        self.modulePath = m.group(5).rstrip('/')
+        self.passwordFile = passwordFile
+
+        if daemonSsh is not None:
+            assert sshArgs is not None, 'daemon ssh needs the ssh arguments of the job'
+            sshSpec = daemonSsh.rstrip('/') + ('/' + self.modulePath if self.modulePath else '')
+            self.ssh = SshLocation(sshSpec, sshArgs=sshArgs, simulate=simulate)
+            self.path = self.ssh.path
+        else:
+            self.path = '/' + self.module + ('/' + self.modulePath if self.modulePath else '')
+
+    def __str__(self):
+        return f'RsyncDaemonLocation:{self.url()}'
+
+    @property
+    def simulate(self):
+        return self._simulate
+
+    @simulate.setter
+    def simulate(self, simulate):
+        self._simulate = simulate
+        if self.ssh is not None:
+            self.ssh.simulate = simulate
+
+    @property
+    def priority(self):
+        return self._priority
+
+    @priority.setter
+    def priority(self, priority):
+        self._priority = priority
+        if self.ssh is not None:
+            self.ssh.priority = priority
+
+    @property
+    def hostKey(self) -> str:
+        return f'rsync://{self.host}:{self.port}'
+
+    def url(self, subpath = None, root = False) -> str:
+        """ The rsync URL of a path in the location, or in the module root """
+        url = f'rsync://{self.user + "@" if self.user else ""}{self.host}:{self.port}/{self.module}/'
+        if not root and self.modulePath:
+            url += self.modulePath + '/'
+        return url if subpath is None else url + subpath
+
+    def rsyncPath(self, subpath = None):
+        return self.url(subpath)
+
+    def transferOpts(self) -> list:
+        opts = [f'--contimeout={self.connectTimeout}']
+        if self.passwordFile:
+            opts.append('--password-file=' + self.passwordFile)
+        return opts
+
+    def linkDest(self, name):
+        """ Relative to the new snapshot, as the daemon doesn't reveal the module path """
+        return '../' + name
+
+    def _rsync(self, name : str, args : list) -> subprocess.CompletedProcess:
+        """ Runs rsync against the daemon
+
+        Raises DaemonError if the daemon couldn't be reached or refused the
+        request. Code 23 is returned when a path doesn't exist.
+        """
+        cmd = ['rsync'] + self.transferOpts() + args
+        logging.debug('Daemon command: ' + ' '.join(cmd))
+        proc = callStats.run(name, cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if proc.returncode not in (0, 23):
+            raise DaemonError('rsync daemon failed %d: %s' %(proc.returncode, proc.stderr.decode('utf-8').rstrip()))
+        return proc
+
+    def _list(self, subpath = '') -> list:
+        """ Lists a directory with the daemon
+
+        Returns (name, isDir) tuples, or None if the directory doesn't exist
+        """
+        proc = self._rsync('list', ['--list-only', self.url(subpath)])
+        if proc.returncode != 0:
+            return None
+        entries = []
+        for line in proc.stdout.decode('utf-8').splitlines():
+            # drwxr-xr-x          4,096 2020/10/01 12:00:00 name
+            fields = line.split(None, 4)
+            if len(fields) == 5 and fields[4] != '.':
+                entries.append((fields[4], fields[0].startswith('d')))
+        return entries
+
+    def _push(self, name, relpaths, localRoot) -> bool:
+        """ Copies relpaths in localRoot to the same relative paths in the module root """
+        args = ['-r', '--relative'] + [ os.path.join(localRoot, '.', relpath) for relpath in relpaths ]
+        return self._rsync(name, args + [self.url(root=True)]).returncode == 0
+
+    def _manager(self, operation : str):
+        """ The ssh location for operations that the daemon can't do """
+        if self.ssh is None:
+            raise DaemonError(f'{operation} in {self} needs ssh access, set daemon ssh')
+        return self.ssh
+
+    def validate(self):
+        """ Validates that the daemon has the location, and the ssh connection if it is used """
+        if self._list() is None:
+            logging.info('Directory %s does not exist on rsync daemon %s', self.path, self.host)
+            return False
+        return self.ssh is None or self.ssh.validate()
+
+    def create(self):
+        """ Creates the directory and its parents in the module """
+        if self.simulate:
+            logging.debug('simulated')
+            return True
+        if not self.modulePath:
+            # The module root always exists
+            return True
+        with tempfile.TemporaryDirectory() as tmp:
+            os.makedirs(os.path.join(tmp, self.modulePath))
+            if self._push('create', [self.modulePath], tmp):
+                return True
+        logging.error('Could not create %s on rsync daemon %s', self.path, self.host)
+        return False
+
+    def listDir(self):
+        """ Lists the directories in the location with the daemon """
+        entries = self._list()
+        folderList = [ name for name, isDir in entries or [] if isDir ]
+        if not folderList:
+            logging.info('Remote is empty')
+            return None
+        logging.debug('Remote files: ' + ', '.join(folderList))
+        return folderList
+
+    def renameChild(self, fromName, toName):
+        self._manager('Renaming').renameChild(fromName, toName)
+
+    def deleteChild(self, name):
+        return self._manager('Deleting').deleteChild(name)
+
+    def freeSpace(self):
+        if self.ssh is None:
+            logging.debug('Free space of %s is unknown without daemon ssh', self)
+            return None
+        return self.ssh.freeSpace()
+
+    def readFile(self, subpath, localPath):
+        """ Copies a file from the daemon to a local file """
+        proc = self._rsync('read', [self.url(subpath), localPath])
+        if proc.returncode != 0:
+            logging.debug('Remote file %s not found', subpath)
+            return False
+        return True
+
+    def writeFile(self, subpath, localPath):
+        """ Copies a local file to the daemon, creating parent directories """
+        if self.simulate:
+            logging.debug('simulated')
+            return True
+        relpath = os.path.join(self.modulePath, subpath)
+        with tempfile.TemporaryDirectory() as tmp:
+            os.makedirs(os.path.dirname(os.path.join(tmp, relpath)), exist_ok=True)
+            shutil.copyfile(localPath, os.path.join(tmp, relpath))
+            if self._push('write', [relpath], tmp):
+                return True
+        logging.error('Could not write remote file %s on rsync daemon %s', subpath, self.host)
+        return False
+
+    def _runScript(self, source, args):
+        if self.ssh is None:
+            raise ScriptError(f'Tools need ssh access to {self}, set daemon ssh')
+        return self.ssh._runScript(source, args)
+
+    def _streamScript(self, source, args, outFile, pipe = None):
+        if self.ssh is None:
+            raise ScriptError(f'Tools need ssh access to {self}, set daemon ssh')
+        return self.ssh._streamScript(source, args, outFile, pipe)
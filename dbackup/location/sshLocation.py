@@ -3,8 +3,11 @@ import logging
 import subprocess
 import os
 import re
+import copy
+import shlex
 
-from ..helpers import SshError
+from ..helpers import SshError, ScriptError
+from ..helpers import callStats
 from ..sshArgs import SshArgs
 
 class SshLocation(Location):
@@ -22,14 +25,21 @@ class SshLocation(Location):
         # Decode user, host and path from spec
         self.__DecodeRemoteLocation(spec)
 
-        self.sshArgs = sshArgs
-        self.sshArgs.user = self.user
+        # The job's ssh arguments are used for rsync, so they get the user.
+        # Keep a copy, in case source and dest are remote with different users
+        sshArgs.user = self.user
+        self.sshArgs = copy.copy(sshArgs)
+        self.sshArgs.host = self.host
 
         self._sshKnownHostArgs = None
 
     def __str__(self):
         return f'SshLocation:{self.user}@{self.host}:{self.path}'
 
+    @property
+    def hostKey(self) -> str:
+        return f'{self.user}@{self.host}:{self.sshArgs.port}'
+
     def __DecodeRemoteLocation(self, spec):
         logging.debug('Decoding remote location %s', spec)
         try:
@@ -67,7 +77,7 @@ class SshLocation(Location):
         cmd += [self.host]
 
         # Finally, add the command
-        cmd += [command]
+        cmd += [self.priority.wrapRemote(command) if self.priority else command]
 
         logging.debug('Build ssh command: '+ ' '.join(cmd))
         return cmd
@@ -75,6 +85,18 @@ class SshLocation(Location):
     def rsyncPath(self, subpath = None):
         return self.host + ':' + (self.path if subpath is None else os.path.join(self.path, subpath))
 
+    def relaySshArgs(self, keyFile = None) -> list:
+        """ ssh arguments to reach this location from another (relay) host
+
+        Files that only exist on this host, like the known hosts file, are
+        left out. The key is either keyFile on the relay host, or the
+        forwarded agent if None.
+        """
+        args = ['-p', str(self.sshArgs.port), '-l', self.user]
+        if keyFile:
+            args += ['-i', keyFile]
+        return args + self.sshArgs.cipherArgs() + SshArgs.mandatorySshArgs
+
     #def sshUserHostArgs(self):
     #    """ Returns arguments needed for user and host arguments to SSH as a list"""
     #    if self.user is not None and self.host is not None:
@@ -113,7 +135,7 @@ class SshLocation(Location):
         cmd = self._buildSshCmd('hostname')
         logging.debug('Remote command: '+' '.join(cmd))
         try:
-            output = subprocess.check_output(cmd, stderr=subprocess.PIPE)
+            output = callStats.checkOutput('connect', cmd, stderr=subprocess.PIPE)
             logging.debug('ssh output: ' + output.decode("utf-8").rstrip())
         except subprocess.CalledProcessError as e:
             raise SshError('SSH failed %d: %s' %(e.returncode, e.stderr.decode("utf-8").rstrip()))
@@ -125,7 +147,7 @@ class SshLocation(Location):
             # TODO: Check if remote folder exists
             # test -d path returns 0 if is directory, and 1 if it isn't a dir or doesn't exist
             cmd = self._buildSshCmd('test -d %s'%(folderPath))
-            output = subprocess.check_output(cmd, stderr=subprocess.PIPE)
+            output = callStats.checkOutput('test', cmd, stderr=subprocess.PIPE)
 
             # subprocess.check_output raises CalledProcessError if return code of cmd is nonzero, so if
             # execution continues here, the folder exists
@@ -157,7 +179,7 @@ class SshLocation(Location):
         cmd = self._buildSshCmd('[ -d "' + self.path + '" ] || mkdir -p "' + self.path + '"')
 
         try:
-            output = subprocess.check_output(cmd, stderr=subprocess.PIPE)
+            output = callStats.checkOutput('create', cmd, stderr=subprocess.PIPE)
             logging.debug('ssh output: ' + output.decode("utf-8").rstrip())
             return True
         except subprocess.CalledProcessError as e:
@@ -170,7 +192,7 @@ class SshLocation(Location):
 
         cmd = self._buildSshCmd('ls -d "'+self.path+'/"*/ | xargs -r -L 1 basename')
         try:
-            output = subprocess.check_output(cmd, stderr=subprocess.PIPE)
+            output = callStats.checkOutput('list', cmd, stderr=subprocess.PIPE)
             folderList = output.decode("utf-8").splitlines()
             if not folderList:
                 logging.info('Remote is empty')
@@ -183,6 +205,60 @@ class SshLocation(Location):
             
         return None
 
+    @classmethod
+    def listDirs(cls, locations, timeout = None):
+        """ Lists the directories of several locations on the same host in one ssh call
+
+        Each listing is preceded by a marker line with the index of the location.
+        Raises SshError if the host doesn't answer within timeout seconds
+        """
+        script = ';'.join(
+            f'echo "//{n}"; ls -d {shlex.quote(location.path)}/*/ 2>/dev/null | xargs -r -L 1 basename'
+            for n, location in enumerate(locations))
+        cmd = locations[0]._buildSshCmd(script)
+        try:
+            output = callStats.checkOutput('list', cmd, stderr=subprocess.PIPE, timeout=timeout)
+        except subprocess.CalledProcessError as e:
+            raise SshError('ssh failed %d: %s' %(e.returncode, e.stderr.decode("utf-8").rstrip()))
+        except subprocess.TimeoutExpired:
+            raise SshError('ssh to %s timed out after %s s' %(locations[0].host, timeout))
+
+        listings = [ [] for location in locations ]
+        current = None
+        for line in output.decode("utf-8").splitlines():
+            if line.startswith('//'):
+                current = listings[int(line[2:])]
+            elif current is not None and line:
+                current.append(line)
+        return [ listing if listing else None for listing in listings ]
+
+    @classmethod
+    def deleteChildren(cls, requests):
+        """ Removes children of several locations on the same host in one ssh call
+
+        Reports the result of each request back with a marker line
+        """
+        script = ';'.join(
+            'rm -rf ' + ' '.join(shlex.quote(location.path + '/' + name) for name in names) +
+            f' && echo "//OK {n}" || echo "//FAILED {n}"'
+            for n, (location, names) in enumerate(requests))
+        if all(location.simulate for location, names in requests):
+            logging.debug('simulated')
+            return [ True for request in requests ]
+
+        cmd = requests[0][0]._buildSshCmd(script)
+        proc = callStats.run('delete', cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if proc.returncode == 255:
+            raise SshError('ssh failed %d: %s' %(proc.returncode, proc.stderr.decode("utf-8").rstrip()))
+
+        results = [ False for request in requests ]
+        for line in proc.stdout.decode("utf-8").splitlines():
+            if line.startswith('//OK '):
+                results[int(line[5:])] = True
+        if not all(results):
+            logging.debug('rm failed: %s', proc.stderr.decode("utf-8").rstrip())
+        return results
+
     def renameChild(self, fromName, toName):
         """ Renames an item in the location 
         
@@ -198,7 +274,7 @@ class SshLocation(Location):
         cmd = self._buildSshCmd('rm -rf "'+toPath+'";mv "'+fromPath+'" "'+toPath+'"')
         try:
             if not self.simulate:
-                output = subprocess.check_output(cmd, stderr=subprocess.PIPE)
+                output = callStats.checkOutput('rename', cmd, stderr=subprocess.PIPE)
                 logging.debug('ssh output: ' + output.decode("utf-8").rstrip())
             else:
                 logging.debug('simulated')
@@ -223,8 +299,79 @@ class SshLocation(Location):
         cmd = self._buildSshCmd('rm -rf '+rmString)
         try:
             if not self.simulate:
-                subprocess.check_output(cmd, stderr=subprocess.PIPE)
+                callStats.checkOutput('delete', cmd, stderr=subprocess.PIPE)
             return True
         except subprocess.CalledProcessError as e:
             logging.debug('ssh failed %d: %s' %(e.returncode, e.stderr.decode("utf-8").rstrip()))
         return False
+
+    def freeSpace(self):
+        """ Get the number of bytes available on the remote filesystem """
+        cmd = self._buildSshCmd('df -Pk "' + self.path + '" | tail -n 1')
+        try:
+            output = callStats.checkOutput('df', cmd, stderr=subprocess.PIPE).decode("utf-8").split()
+            # Filesystem 1024-blocks Used Available Capacity Mounted-on
+            return int(output[3]) * 1024
+        except subprocess.CalledProcessError as e:
+            if e.returncode == 255:
+                raise SshError('ssh failed %d: %s' %(e.returncode, e.stderr.decode("utf-8").rstrip()))
+            logging.warning('Could not determine free space at %s', self.path)
+        except (IndexError, ValueError):
+            logging.warning('Unexpected output from df at %s', self.path)
+        return None
+
+    def readFile(self, subpath, localPath):
+        """ Copies a file from the remote location to a local file """
+        filePath = os.path.join(self.path, subpath)
+        cmd = self._buildSshCmd('cat "' + filePath + '"')
+        with open(localPath, 'wb') as localFile:
+            proc = callStats.run('read', cmd, stdout=localFile, stderr=subprocess.PIPE)
+        if proc.returncode == 255:
+            raise SshError('ssh failed %d: %s' %(proc.returncode, proc.stderr.decode("utf-8").rstrip()))
+        if proc.returncode != 0:
+            logging.debug('Remote file %s not found', filePath)
+            return False
+        return True
+
+    def writeFile(self, subpath, localPath):
+        """ Copies a local file to the remote location """
+        filePath = os.path.join(self.path, subpath)
+        cmd = self._buildSshCmd('mkdir -p "' + os.path.dirname(filePath) + '" && cat > "' + filePath + '"')
+        if self.simulate:
+            logging.debug('simulated')
+            return True
+        with open(localPath, 'rb') as localFile:
+            proc = callStats.run('write', cmd, stdin=localFile, stderr=subprocess.PIPE)
+        if proc.returncode != 0:
+            logging.error('Could not write remote file %s: %s', filePath, proc.stderr.decode("utf-8").rstrip())
+            return False
+        return True
+
+    def _runScript(self, source, args):
+        """ Pipes the script to python3 on the remote host """
+        cmd = self._buildSshCmd('python3 -I - ' + ' '.join(shlex.quote(str(a)) for a in args))
+        try:
+            output = callStats.run('tool', cmd, input=source, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+            return output.stdout
+        except subprocess.CalledProcessError as e:
+            message = '%d: %s' %(e.returncode, e.stderr.decode("utf-8").rstrip())
+            if e.returncode == 255:
+                # ssh itself failed
+                raise SshError('ssh failed ' + message)
+            raise ScriptError('Remote script failed ' + message)
+
+    def _streamScript(self, source, args, outFile, pipe = None):
+        """ Pipes the script to python3 on the remote host and streams its output back """
+        command = 'python3 -I - ' + ' '.join(shlex.quote(str(a)) for a in args)
+        if pipe:
+            command += ' | ' + pipe
+        cmd = self._buildSshCmd(command)
+        with callStats.record('stream', cmd):
+            proc = subprocess.Popen(callStats.wrap(cmd), stdin=subprocess.PIPE, stdout=outFile, stderr=subprocess.PIPE)
+            _, stderr = proc.communicate(source)
+        if proc.returncode != 0:
+            message = '%d: %s' %(proc.returncode, stderr.decode("utf-8", "replace").rstrip())
+            if proc.returncode == 255:
+                raise SshError('ssh failed ' + message)
+            raise ScriptError('Remote script failed ' + message)
+        return stderr
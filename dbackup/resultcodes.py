@@ -9,4 +9,13 @@ BAD_JOBS = 5
 CLEAN_FAILED = 6
 INVALID_JOB = 7
 UNEXPECTED_ERROR = 8
-RSYNC_FAILED = 9
\ No newline at end of file
+RSYNC_FAILED = 9
+VERIFY_FAILED = 10
+DEDUPE_FAILED = 11
+INSUFFICIENT_SPACE = 12
+CATALOG_FAILED = 13
+RESTORE_FAILED = 14
+EXPORT_FAILED = 15
+DIFF_FAILED = 16
+MIGRATE_FAILED = 17
+REPLICA_FAILED = 18
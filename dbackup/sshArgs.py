@@ -14,6 +14,10 @@ class SshArgs:
     """
 
     mandatorySshArgs = ['-o', 'BatchMode=yes']
+
+    # Cipher and MAC for each host, as chosen by 'dbackup tune-ssh'.
+    # Loaded from the state tracker, { host : (cipher, mac or None) }
+    tunedCiphers = {}
     #mandatorySshArgs = ['-o', 'PubkeyAuthentication=yes', '-o', 'PreferredAuthentications=publickey']
 
     def __init__(self, jobConfig):
@@ -27,6 +31,8 @@ class SshArgs:
         self._hostKeyFile = self.__determineHostKeyFile(jobConfig)
         self._user = self.__determineUser(jobConfig)
         self._cert = Path(jobConfig['cert']) if 'cert' in jobConfig else None
+        # Set by the location that uses the arguments
+        self.host = None
         #self.__args = self.__buildSshArgs(jobConfig)
 
     def __determinePort(self, jobConfig : dict) -> int:
@@ -74,11 +80,23 @@ class SshArgs:
         if self.user and '-l' not in self.extraArgs:
             args += ['-l', self.user]
 
+        args += self.cipherArgs()
         args += self.extraArgs
         args += self.mandatorySshArgs
 
         return args
 
+    def cipherArgs(self) -> list:
+        """ The -c and -m arguments for the tuned cipher of the host
+
+        Empty if the host hasn't been tuned, or if ssharg selects a cipher
+        """
+        tuned = self.tunedCiphers.get(self.host.lower()) if self.host else None
+        if not tuned or '-c' in self.extraArgs:
+            return []
+        cipher, mac = tuned
+        return ['-c', cipher] + (['-m', mac] if mac else [])
+
     @property
     def user(self) -> str:
         return self._user
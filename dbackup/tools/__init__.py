@@ -0,0 +1,28 @@
+# Self-contained helper scripts
+#
+# The modules in this package are executed on the host that holds the files,
+# i.e. locally for LocalLocation and piped to 'python3 -' over ssh for
+# SshLocation (see Location.runTool). They must therefore only import
+# modules from the python standard library. Tools that share code list the
+# tool modules they need in 'requires', and those are bundled in front of the
+# tool when it is executed.
+import importlib
+import os
+
+def scriptPath(name : str) -> str:
+    """ Full path to the source of a tool script """
+    return os.path.join(os.path.dirname(__file__), name + '.py')
+
+def scriptSource(name : str) -> bytes:
+    """ Source of a tool script, with the tool modules it requires bundled in front """
+    module = importlib.import_module('.' + name, __name__)
+    lines = ['import sys, types']
+    for requirement in getattr(module, 'requires', []):
+        with open(scriptPath(requirement)) as f:
+            source = f.read()
+        lines.append(f'_module = types.ModuleType({requirement!r})')
+        lines.append(f'exec(compile({source!r}, {requirement + ".py"!r}, "exec"), _module.__dict__)')
+        lines.append(f'sys.modules[{requirement!r}] = _module')
+    with open(scriptPath(name)) as f:
+        lines.append(f.read())
+    return '\n'.join(lines).encode('utf-8')
@@ -0,0 +1,211 @@
+""" A searchable catalog of the files in all snapshots of a destination
+
+The catalog is an SQLite database in <dest>/.dbackup/catalog.sqlite.
+Unchanged files are hard links to the same inode in consecutive snapshots,
+so a file is stored as a version that spans a range of snapshots
+
+    versions(path, ino, size, mtime, first, last)
+
+where first and last are sequence numbers of snapshots, and last is NULL
+while the version is present in the latest snapshot. A version is present
+in every snapshot in the range that still exists. Paths are stored once
+in a separate table.
+
+Adding a snapshot only inserts rows for new inodes and closes the
+versions that are no longer present. Snapshots that have been removed
+are pruned, together with the versions that no longer are in any snapshot.
+If a snapshot older than the latest indexed one shows up, the catalog is
+rebuilt.
+
+This script is executed remotely, so it must only use the standard library.
+
+Usage:
+    catalog.py build <dest>
+    catalog.py prune <dest>
+    catalog.py find <dest> <pattern> [--limit N]
+"""
+
+import argparse
+import json
+import os
+import re
+import sqlite3
+import sys
+
+try:
+    from . import hashing
+except ImportError:
+    # Bundled by Location.runTool
+    import hashing
+
+# Tool modules that are bundled with this script
+requires = ['hashing']
+
+# Name of the metadata directory in the destination and in each snapshot
+metaDir = '.dbackup'
+
+catalogName = 'catalog.sqlite'
+
+snapshotRegex = re.compile(r'^\d{4}-\d{2}-\d{2}(?:T\d{4})?$')
+
+schema = '''
+    CREATE TABLE IF NOT EXISTS snapshots (seq INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE NOT NULL);
+    CREATE TABLE IF NOT EXISTS paths (id INTEGER PRIMARY KEY, path BLOB UNIQUE NOT NULL);
+    CREATE TABLE IF NOT EXISTS versions (path INTEGER NOT NULL, ino INTEGER NOT NULL,
+        size INTEGER NOT NULL, mtime INTEGER NOT NULL, first INTEGER NOT NULL, last INTEGER);
+    CREATE INDEX IF NOT EXISTS versionsPath ON versions (path, ino);
+    CREATE INDEX IF NOT EXISTS versionsOpen ON versions (last);
+'''
+
+def catalogPath(dest):
+    return os.path.join(dest, metaDir, catalogName)
+
+def connect(dest, create = True):
+    """ Opens the catalog of a destination, or returns None if it doesn't exist """
+    path = catalogPath(dest)
+    if not create and not os.path.exists(path):
+        return None
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    db = sqlite3.connect(path)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    db.executescript(schema)
+    return db
+
+def listSnapshots(dest) -> list:
+    """ Names of the complete snapshots in dest, oldest first """
+    try:
+        return sorted(name for name in os.listdir(dest)
+            if snapshotRegex.match(name) and os.path.isdir(os.path.join(dest, name)))
+    except FileNotFoundError:
+        return []
+
+def prune(db, existing) -> int:
+    """ Removes snapshots that no longer exist, and the versions only they held
+
+    Returns the number of removed snapshots
+    """
+    existing = set(existing)
+    removed = [ (seq,) for seq, name in db.execute('SELECT seq, name FROM snapshots') if name not in existing ]
+    if not removed:
+        return 0
+    db.executemany('DELETE FROM snapshots WHERE seq = ?', removed)
+    # Keep versions that span at least one remaining snapshot
+    db.execute('''DELETE FROM versions WHERE NOT EXISTS (SELECT 1 FROM snapshots
+        WHERE seq >= versions.first AND (versions.last IS NULL OR seq <= versions.last))''')
+    db.execute('DELETE FROM paths WHERE NOT EXISTS (SELECT 1 FROM versions WHERE versions.path = paths.id)')
+    return len(removed)
+
+def addSnapshot(db, dest, name) -> dict:
+    """ Adds a snapshot that is newer than all snapshots in the catalog
+
+    Returns statistics of the snapshot
+    """
+    head = db.execute('SELECT max(seq) FROM snapshots').fetchone()[0]
+    seq = db.execute('INSERT INTO snapshots (name) VALUES (?)', (name,)).lastrowid
+
+    db.execute('CREATE TEMP TABLE scan (path BLOB PRIMARY KEY, ino INTEGER, size INTEGER, mtime INTEGER) WITHOUT ROWID')
+    try:
+        db.executemany('INSERT OR IGNORE INTO scan VALUES (?, ?, ?, ?)',
+            ((relpath, st.st_ino, st.st_size, st.st_mtime_ns)
+                for relpath, st in hashing.scanTree(os.path.join(dest, name), skip=metaDir)))
+        files = db.execute('SELECT count(*) FROM scan').fetchone()[0]
+
+        db.execute('INSERT OR IGNORE INTO paths (path) SELECT path FROM scan')
+
+        # Close the versions that aren't in the new snapshot
+        closed = db.execute('''UPDATE versions SET last = ? WHERE last IS NULL AND NOT EXISTS
+            (SELECT 1 FROM scan JOIN paths ON paths.path = scan.path
+                WHERE paths.id = versions.path AND scan.ino = versions.ino)''', (head,)).rowcount
+
+        # Add the new inodes
+        added = db.execute('''INSERT INTO versions (path, ino, size, mtime, first, last)
+            SELECT paths.id, scan.ino, scan.size, scan.mtime, ?, NULL FROM scan JOIN paths ON paths.path = scan.path
+                WHERE NOT EXISTS (SELECT 1 FROM versions WHERE versions.path = paths.id
+                    AND versions.ino = scan.ino AND versions.last IS NULL)''', (seq,)).rowcount
+    finally:
+        db.execute('DROP TABLE temp.scan')
+
+    return { 'snapshot': name, 'files': files, 'added': added, 'closed': closed }
+
+def build(dest) -> list:
+    """ Brings the catalog up to date with the snapshots in dest
+
+    Returns a list of statistics, one for each added snapshot
+    """
+    snapshots = listSnapshots(dest)
+    db = connect(dest)
+    try:
+        with db:
+            pruned = prune(db, snapshots)
+            indexed = [ name for (name,) in db.execute('SELECT name FROM snapshots ORDER BY seq') ]
+            new = [ name for name in snapshots if name not in set(indexed) ]
+            if indexed and new and min(new) < indexed[-1]:
+                # Versions can only be appended, start over
+                db.executescript('DELETE FROM versions; DELETE FROM paths; DELETE FROM snapshots;')
+                new = snapshots
+        results = []
+        for name in new:
+            with db:
+                results.append(addSnapshot(db, dest, name))
+        if pruned or results:
+            db.execute('PRAGMA optimize')
+        return [ dict(result, pruned=pruned) for result in results ] or [ { 'snapshot': None, 'pruned': pruned } ]
+    finally:
+        db.close()
+
+def find(dest, pattern, limit = None):
+    """ Yields the versions whose path matches a glob pattern
+
+    Patterns without wildcards match anywhere in the path
+    """
+    db = connect(dest, create=False)
+    if db is None:
+        return
+    try:
+        with db:
+            prune(db, listSnapshots(dest))
+        if not any(c in pattern for c in '*?['):
+            pattern = '*' + pattern + '*'
+        query = '''SELECT paths.path, versions.size, versions.mtime,
+                (SELECT group_concat(name, ' ') FROM (SELECT name FROM snapshots WHERE seq >= versions.first
+                    AND (versions.last IS NULL OR seq <= versions.last) ORDER BY seq))
+            FROM versions JOIN paths ON paths.id = versions.path
+            WHERE CAST(paths.path AS TEXT) GLOB ? ORDER BY paths.path, versions.first'''
+        if limit:
+            query += ' LIMIT %d' % limit
+        for path, size, mtime, snapshots in db.execute(query, (pattern,)):
+            yield { 'path': os.fsdecode(path), 'size': size, 'mtime': mtime // 1000000000,
+                'snapshots': snapshots.split(' ') if snapshots else [] }
+    finally:
+        db.close()
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Build or search the catalog of a destination')
+    parser.add_argument('action', choices=['build', 'prune', 'find'])
+    parser.add_argument('dest', help='Destination directory that holds the snapshots')
+    parser.add_argument('pattern', nargs='?', help='Glob pattern to find')
+    parser.add_argument('--limit', type=int, default=None, help='Maximum number of versions to find')
+    args = parser.parse_args(argv)
+
+    if args.action == 'build':
+        results = build(args.dest)
+    elif args.action == 'prune':
+        db = connect(args.dest, create=False)
+        results = []
+        if db is not None:
+            with db:
+                results = [ { 'pruned': prune(db, listSnapshots(args.dest)) } ]
+            db.close()
+    else:
+        if args.pattern is None:
+            parser.error('find requires a pattern')
+        results = find(args.dest, args.pattern, args.limit)
+
+    for result in results:
+        sys.stdout.write(json.dumps(result) + '\n')
+    sys.stdout.flush()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
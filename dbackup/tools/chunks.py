@@ -0,0 +1,439 @@
+""" Chunk deduplicating storage for files that change in place
+
+Hard linked snapshots store a complete copy of every file that changed,
+which is expensive for large files that only change a little, like disk
+images, mailboxes and databases. With chunk storage, rsync updates a single
+mirror of the source in <dest>/.dbackup-mirror in place, and this tool
+stores the mirror as a snapshot:
+
+    - Files are split into content defined chunks, where a few bytes match
+      a pattern, so an unchanged region gives the same chunks wherever it
+      is in the file.
+      Large files are split into segments first, and the segments are
+      chunked and hashed in parallel in a pool of worker processes
+    - Each chunk is stored once, under its hash, in
+      <dest>/.dbackup-chunks/store/<aa>/<hash>
+    - The snapshot directory only holds a manifest of the tree, in
+      .dbackup/chunks.gz, one JSON line per file, directory or symlink,
+      listing the chunks of each file
+
+Files whose inode, size, mtime and ctime in the mirror are the same as in
+the previous snapshot aren't read again, the chunks are taken from its
+manifest.
+
+An index in <dest>/.dbackup-chunks/index.sqlite counts how many snapshots
+refer to each chunk. Snapshots are deleted like any other snapshot. The
+garbage collection then releases the chunks of the snapshots that are gone,
+one snapshot at a time, and deletes the chunks that no snapshot refers to.
+It stops after a time budget and continues where it stopped in the next
+run. Chunks are marked as garbage in the same transaction that releases
+them, and only removed after it is committed, so an interrupted collection
+never loses a chunk that is still needed.
+
+This script is executed remotely, so it must only use the standard library.
+
+Usage:
+    chunks.py commit <dest> <snapshot dir> <name> [--chunk-size N] [--workers N]
+    chunks.py gc <dest> [--max-seconds N]
+    chunks.py extract <dest> <snapshot dir> <into> [--path P]
+"""
+
+import argparse
+import concurrent.futures
+import functools
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import stat
+import sys
+import time
+
+# Layout in the destination
+mirrorName = '.dbackup-mirror'
+storeName = '.dbackup-chunks'
+indexName = 'index.sqlite'
+metaDir = '.dbackup'
+manifestName = 'chunks.gz'
+
+manifestFormat = 'dbackup chunks 1'
+
+defaultChunkSize = 1024 * 1024
+
+# Large files are chunked in segments of this size in parallel. Each
+# segment ends a chunk, so the chunks only depend on the content in between.
+# Each worker reads one segment into memory at a time
+segmentSize = 64 * 1024 * 1024
+
+# Chunk inline if fewer segments than this needs chunking
+poolThreshold = 4
+
+# Number of garbage chunks that are removed per transaction
+garbageBatch = 1000
+
+@functools.lru_cache()
+def _boundary(chunkSize) -> tuple:
+    """ The symbol table and the boundary pattern for an average chunk size
+
+    Each byte is mapped to one of a symbols, the same on every host. A chunk
+    ends after k symbols that match the pattern, which happens once in
+    about chunkSize bytes. Consecutive pattern symbols differ, so runs of a
+    single byte value, like zeroed disk blocks, never match.
+    """
+    bits = chunkSize.bit_length() - 1
+    k = max(2, -(-bits // 4))
+    a = max(2, round(2 ** (bits / k)))
+    table = bytes(int.from_bytes(hashlib.blake2b(bytes([n]), digest_size=8).digest(), 'big') % a for n in range(256))
+    pattern = bytes(n % a for n in range(1, k + 1))
+    return table, pattern
+
+def cutPoints(data, chunkSize):
+    """ Yields the end offset of each content defined chunk in data
+
+    Chunks are between a quarter and four times chunkSize. chunkSize must
+    be a power of two. The boundaries are searched with bytes.find in the
+    translated data, so that the bytes aren't looped over in python.
+    """
+    minSize = chunkSize // 4
+    maxSize = chunkSize * 4
+    table, pattern = _boundary(chunkSize)
+    symbols = bytes(data).translate(table)
+    size = len(symbols)
+    start = 0
+    while start < size:
+        end = min(start + maxSize, size)
+        cut = end
+        if end - start > minSize:
+            found = symbols.find(pattern, start + minSize, end)
+            if found >= 0:
+                cut = found + len(pattern)
+        yield cut
+        start = cut
+
+def chunkPath(store, digest) -> str:
+    return os.path.join(store, 'store', digest[:2], digest)
+
+def _writeChunk(store, digest, data) -> bool:
+    """ Stores a chunk unless it exists. Returns True if it was written """
+    path = chunkPath(store, digest)
+    if os.path.exists(path):
+        return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmpPath = f'{path}.tmp{os.getpid()}'
+    with open(tmpPath, 'wb') as f:
+        f.write(data)
+    os.replace(tmpPath, path)
+    return True
+
+def chunkSegment(task) -> tuple:
+    """ Chunks, hashes and stores a segment of a file
+
+    Arguments:
+        task : (store, path, offset, length, chunkSize)
+
+    Returns ([[hash, size], ...], bytes written) or None if the file couldn't be read
+    """
+    store, path, offset, length, chunkSize = task
+    chunks = []
+    written = 0
+    try:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            view = memoryview(f.read(length))
+    except OSError:
+        return None
+    start = 0
+    for end in cutPoints(view, chunkSize):
+        data = view[start:end]
+        digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+        if _writeChunk(store, digest, data):
+            written += end - start
+        chunks.append([digest, end - start])
+        start = end
+    return chunks, written
+
+def walk(root):
+    """ Yields (relpath, stat) for the files, directories and symlinks below root """
+    stack = ['']
+    while stack:
+        rel = stack.pop()
+        try:
+            entries = sorted(os.scandir(os.path.join(root, rel)), key=lambda entry: entry.name)
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            relpath = os.path.join(rel, entry.name) if rel else entry.name
+            if stat.S_ISDIR(st.st_mode):
+                stack.append(relpath)
+            elif not (stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode)):
+                continue
+            yield relpath, st
+
+def readManifest(path) -> list:
+    """ Reads the entries of a manifest, or None if there is none """
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8', errors='surrogateescape') as f:
+            header = json.loads(f.readline())
+            if header.get('format') != manifestFormat:
+                raise ValueError('Not a chunk manifest: %s' % path)
+            return [ json.loads(line) for line in f if line.strip() ]
+    except FileNotFoundError:
+        return None
+
+def writeManifest(path, entries):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmpPath = path + '.tmp'
+    with gzip.open(tmpPath, 'wt', encoding='utf-8', errors='surrogateescape', compresslevel=3) as f:
+        f.write(json.dumps({ 'format': manifestFormat }) + '\n')
+        for entry in entries:
+            f.write(json.dumps(entry) + '\n')
+    os.replace(tmpPath, path)
+
+def openIndex(store):
+    os.makedirs(store, exist_ok=True)
+    db = sqlite3.connect(os.path.join(store, indexName))
+    db.executescript('''
+        CREATE TABLE IF NOT EXISTS chunks (hash TEXT PRIMARY KEY, size INTEGER, refs INTEGER);
+        CREATE TABLE IF NOT EXISTS snapshots (name TEXT PRIMARY KEY, created REAL);
+        CREATE TABLE IF NOT EXISTS members (snapshot TEXT, hash TEXT);
+        CREATE INDEX IF NOT EXISTS membersBySnapshot ON members (snapshot);
+        CREATE TABLE IF NOT EXISTS garbage (hash TEXT PRIMARY KEY, size INTEGER);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+    ''')
+    return db
+
+def release(db, name):
+    """ Drops the references of a snapshot and marks the unreferenced chunks as garbage
+
+    Must be called within a transaction
+    """
+    db.execute('UPDATE chunks SET refs = refs - 1 WHERE hash IN (SELECT hash FROM members WHERE snapshot = ?)', (name,))
+    db.execute('INSERT OR IGNORE INTO garbage SELECT c.hash, c.size FROM chunks c JOIN members m ON c.hash = m.hash '
+        'WHERE m.snapshot = ? AND c.refs <= 0', (name,))
+    db.execute('DELETE FROM chunks WHERE hash IN (SELECT hash FROM members WHERE snapshot = ?) AND refs <= 0', (name,))
+    db.execute('DELETE FROM members WHERE snapshot = ?', (name,))
+    db.execute('DELETE FROM snapshots WHERE name = ?', (name,))
+
+def drainGarbage(db, store, deadline = None) -> tuple:
+    """ Removes the chunks that are marked as garbage
+
+    Returns (chunks, bytes) that were removed
+    """
+    removed = 0
+    freed = 0
+    while deadline is None or time.monotonic() < deadline:
+        batch = db.execute('SELECT hash, size FROM garbage LIMIT ?', (garbageBatch,)).fetchall()
+        if not batch:
+            break
+        for digest, size in batch:
+            try:
+                os.remove(chunkPath(store, digest))
+                freed += size
+            except FileNotFoundError:
+                pass
+        with db:
+            db.executemany('DELETE FROM garbage WHERE hash = ?', [ (digest,) for digest, size in batch ])
+        removed += len(batch)
+    return removed, freed
+
+def _fileKey(st) -> list:
+    return [st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns]
+
+def commit(dest, snapshotDir, name, chunkSize = defaultChunkSize, workers = None) -> dict:
+    """ Stores the mirror in the chunk store, as the snapshot in snapshotDir that is registered as name
+
+    Returns a dict with statistics
+    """
+    assert chunkSize & (chunkSize - 1) == 0, 'The chunk size must be a power of two'
+    mirror = os.path.join(dest, mirrorName)
+    store = os.path.join(dest, storeName)
+    db = openIndex(store)
+    # A chunk that is about to be removed must not be reused
+    drainGarbage(db, store)
+
+    # Files that haven't changed since the previous snapshot keep their chunks
+    previous = {}
+    row = db.execute("SELECT value FROM meta WHERE key = 'last'").fetchone()
+    if row is not None and db.execute('SELECT 1 FROM snapshots WHERE name = ?', row).fetchone():
+        for candidate in (row[0], row[0] + '.incomplete'):
+            entries = readManifest(os.path.join(dest, candidate, metaDir, manifestName))
+            if entries is not None:
+                previous = { entry['path']: entry for entry in entries if entry['type'] == 'f' }
+                break
+
+    entries = []
+    tasks = []
+    for relpath, st in walk(mirror):
+        relpath = os.fsdecode(relpath)
+        entry = { 'path': relpath, 'mode': stat.S_IMODE(st.st_mode), 'uid': st.st_uid, 'gid': st.st_gid,
+            'mtime': st.st_mtime_ns }
+        if stat.S_ISDIR(st.st_mode):
+            entry['type'] = 'd'
+        elif stat.S_ISLNK(st.st_mode):
+            entry['type'] = 'l'
+            entry['target'] = os.fsdecode(os.readlink(os.path.join(mirror, relpath)))
+        else:
+            entry.update(type='f', size=st.st_size, key=_fileKey(st))
+            old = previous.get(relpath)
+            if old is not None and old['key'] == entry['key']:
+                entry['chunks'] = old['chunks']
+            else:
+                entry['chunks'] = None
+                for offset in range(0, max(st.st_size, 1), segmentSize):
+                    tasks.append((len(entries), (store, os.path.join(mirror, relpath), offset,
+                        min(segmentSize, st.st_size - offset), chunkSize)))
+        entries.append(entry)
+
+    if len(tasks) < poolThreshold or workers == 1:
+        results = [ chunkSegment(task) for n, task in tasks ]
+    else:
+        # Fork explicitly, the tools may be run from stdin where spawn can't work
+        ctx = multiprocessing.get_context('fork')
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+            results = list(pool.map(chunkSegment, [ task for n, task in tasks ]))
+
+    written = 0
+    unreadable = set()
+    for (n, task), result in zip(tasks, results):
+        if result is None:
+            unreadable.add(n)
+            continue
+        chunks, segmentWritten = result
+        entries[n]['chunks'] = (entries[n]['chunks'] or []) + chunks
+        written += segmentWritten
+    entries = [ entry for n, entry in enumerate(entries) if n not in unreadable ]
+
+    writeManifest(os.path.join(dest, snapshotDir, metaDir, manifestName), entries)
+
+    sizes = {}
+    for entry in entries:
+        for digest, size in entry.get('chunks') or []:
+            sizes[digest] = size
+    with db:
+        if db.execute('SELECT 1 FROM snapshots WHERE name = ?', (name,)).fetchone():
+            # A snapshot with the same name is replaced, its chunks are
+            # released after the new references are counted
+            db.execute('UPDATE snapshots SET name = ? WHERE name = ?', (name + '.replaced', name))
+            db.execute('UPDATE members SET snapshot = ? WHERE snapshot = ?', (name + '.replaced', name))
+        db.executemany('INSERT OR IGNORE INTO chunks VALUES (?, ?, 0)', sizes.items())
+        db.executemany('UPDATE chunks SET refs = refs + 1 WHERE hash = ?', [ (digest,) for digest in sizes ])
+        db.executemany('INSERT INTO members VALUES (?, ?)', [ (name, digest) for digest in sizes ])
+        db.execute('INSERT INTO snapshots VALUES (?, ?)', (name, time.time()))
+        release(db, name + '.replaced')
+        db.execute("INSERT OR REPLACE INTO meta VALUES ('last', ?)", (name,))
+    removed, freed = drainGarbage(db, store)
+    db.close()
+
+    return { 'snapshot': name, 'files': sum(1 for entry in entries if entry['type'] == 'f'),
+        'chunked': len(set(n for n, task in tasks)), 'chunks': len(sizes), 'written': written,
+        'size': sum(sizes.values()), 'unreadable': len(unreadable) }
+
+def gc(dest, maxSeconds = None) -> dict:
+    """ Releases the snapshots that were deleted from dest and removes their chunks
+
+    Stops after maxSeconds, between two snapshots or batches of chunks
+    """
+    store = os.path.join(dest, storeName)
+    deadline = time.monotonic() + maxSeconds if maxSeconds is not None else None
+    db = openIndex(store)
+    present = set()
+    for name in os.listdir(dest):
+        if not name.startswith('.') and os.path.isdir(os.path.join(dest, name)):
+            present.add(name[:-len('.incomplete')] if name.endswith('.incomplete') else name)
+
+    removed, freed = drainGarbage(db, store, deadline)
+    registered = [ name for (name,) in db.execute('SELECT name FROM snapshots ORDER BY created') ]
+    gone = [ name for name in registered if name not in present ]
+    released = 0
+    for name in gone:
+        if deadline is not None and time.monotonic() >= deadline:
+            break
+        with db:
+            release(db, name)
+        released += 1
+        chunks, size = drainGarbage(db, store, deadline)
+        removed += chunks
+        freed += size
+
+    pending = len(gone) - released
+    garbage = db.execute('SELECT COUNT(*) FROM garbage').fetchone()[0]
+    stored = db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM chunks').fetchone()
+    db.close()
+    return { 'released': released, 'removed': removed, 'freed': freed, 'pending': pending, 'garbage': garbage,
+        'chunks': stored[0], 'size': stored[1] }
+
+def extract(dest, snapshotDir, into, path = '') -> dict:
+    """ Rebuilds the files of a snapshot below path in dest/into """
+    entries = readManifest(os.path.join(dest, snapshotDir, metaDir, manifestName))
+    if entries is None:
+        raise ValueError('No chunk manifest in %s' % snapshotDir)
+    store = os.path.join(dest, storeName)
+    path = path.strip('/')
+    root = os.path.join(dest, into)
+    # Left over from an interrupted extract
+    shutil.rmtree(root, ignore_errors=True)
+    os.makedirs(root)
+    files = 0
+    size = 0
+    dirs = []
+    for entry in entries:
+        relpath = entry['path']
+        if path and relpath != path and not relpath.startswith(path + '/'):
+            continue
+        target = os.path.join(root, relpath)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if entry['type'] == 'd':
+            os.makedirs(target, exist_ok=True)
+            dirs.append((target, entry))
+            continue
+        if entry['type'] == 'l':
+            os.symlink(entry['target'], target)
+            continue
+        with open(target, 'wb') as f:
+            for digest, chunkSize in entry['chunks']:
+                with open(chunkPath(store, digest), 'rb') as chunk:
+                    f.write(chunk.read())
+        _restoreAttributes(target, entry)
+        files += 1
+        size += entry['size']
+    # Directory times last, after their contents are written
+    for target, entry in reversed(dirs):
+        _restoreAttributes(target, entry)
+    return { 'files': files, 'size': size }
+
+def _restoreAttributes(target, entry):
+    if os.geteuid() == 0:
+        os.chown(target, entry['uid'], entry['gid'])
+    os.chmod(target, entry['mode'])
+    os.utime(target, ns=(entry['mtime'], entry['mtime']))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Chunk deduplicating snapshot storage')
+    parser.add_argument('action', choices=['commit', 'gc', 'extract'])
+    parser.add_argument('dest', help='Destination directory')
+    parser.add_argument('args', nargs='*', help='commit: <snapshot dir> <name>, extract: <snapshot dir> <into>')
+    parser.add_argument('--chunk-size', type=int, default=defaultChunkSize, help='Average chunk size, a power of two')
+    parser.add_argument('--workers', type=int, default=None, help='Number of chunking processes')
+    parser.add_argument('--max-seconds', type=float, default=None, help='Time budget of the garbage collection')
+    parser.add_argument('--path', default='', help='Path in the snapshot to extract')
+    args = parser.parse_args(argv)
+
+    if args.action == 'commit':
+        result = commit(args.dest, args.args[0], args.args[1], args.chunk_size, args.workers)
+    elif args.action == 'gc':
+        result = gc(args.dest, args.max_seconds)
+    else:
+        result = extract(args.dest, args.args[0], args.args[1], args.path)
+    sys.stdout.write(json.dumps(result) + '\n')
+    sys.stdout.flush()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,265 @@
+""" Deduplicates identical files across the snapshots of several jobs
+
+Hard links only deduplicate within the snapshot chain of one job. This
+tool finds identical files in snapshots of different jobs on the same
+filesystem and replaces the duplicates with hard links.
+
+Candidates are found in stages, so most files are never read:
+
+    1. Files with the same size, mtime, mode and owner (linking files with
+       different metadata would change the metadata of one of them)
+    2. The same partial hash of the first and last blocks
+    3. The same full hash
+
+An index of the inodes that have been seen is persisted, together with the
+snapshots that have been scanned. Later runs only scan new snapshots and
+only hash new inodes. The index is stored as NUL-terminated records
+
+    S <snapshot dir>
+    I <ino> <size> <mtime_ns> <mode> <uid> <gid> <partial> <hash> <snapshot no> <relpath>
+
+This script is executed remotely, so it must only use the standard library.
+
+Usage:
+    dedupe.py --index <path> [--min-size N] [--workers N] [--dry-run] <snapshot dir> ...
+"""
+
+import argparse
+import collections
+import errno
+import functools
+import gzip
+import json
+import os
+import sys
+
+try:
+    from . import hashing
+except ImportError:
+    # Bundled by Location.runTool
+    import hashing
+
+# Tool modules that are bundled with this script
+requires = ['hashing']
+
+# Name of the metadata directory in the destination and in each snapshot
+metaDir = '.dbackup'
+
+indexHeader = b'# dbackup dedupe index 1\0'
+
+# Files smaller than this are not worth linking
+defaultMinSize = 64 * 1024
+
+class Inode:
+    """ An inode in the index or found in a new snapshot """
+
+    __slots__ = ['ino', 'size', 'mtime', 'mode', 'uid', 'gid', 'partial', 'digest', 'snapshot', 'relpath', 'paths']
+
+    def __init__(self, ino, size, mtime, mode, uid, gid, partial, digest, snapshot, relpath):
+        self.ino = ino
+        self.size = size
+        self.mtime = mtime
+        self.mode = mode
+        self.uid = uid
+        self.gid = gid
+        self.partial = partial
+        self.digest = digest
+        # The snapshot dir and relative path of the newest known link
+        self.snapshot = snapshot
+        self.relpath = relpath
+        # All links found in new snapshots, None for indexed inodes
+        self.paths = None
+
+    @property
+    def path(self):
+        return os.path.join(self.snapshot, self.relpath)
+
+    @property
+    def key(self):
+        return (self.size, self.mtime, self.mode, self.uid, self.gid)
+
+def readIndex(path):
+    """ Reads the index
+
+    Returns (list of snapshot dirs, { ino : Inode })
+    """
+    snapshots = []
+    inodes = {}
+    try:
+        with gzip.open(path, 'rb') as f:
+            records = f.read().split(b'\0')
+    except (OSError, EOFError):
+        return snapshots, inodes
+    if not records or records[0] + b'\0' != indexHeader:
+        return snapshots, inodes
+    for record in records[1:]:
+        if record.startswith(b'S '):
+            snapshots.append(record[2:])
+        elif record.startswith(b'I '):
+            fields = record[2:].split(b' ', 9)
+            ino, size, mtime, mode, uid, gid = map(int, fields[:6])
+            partial, digest = [ None if f == b'-' else f.decode() for f in fields[6:8] ]
+            inodes[ino] = Inode(ino, size, mtime, mode, uid, gid, partial, digest, snapshots[int(fields[8])], fields[9])
+    return snapshots, inodes
+
+def writeIndex(path, snapshots, inodes):
+    """ Writes the index, dropping inodes in snapshots that no longer are in the list """
+    numbers = { snapshot : n for n, snapshot in enumerate(snapshots) }
+    def records():
+        yield indexHeader
+        for snapshot in snapshots:
+            yield b'S %s\0' % snapshot
+        for inode in inodes.values():
+            if inode.snapshot in numbers:
+                yield b'I %d %d %d %d %d %d %s %s %d %s\0' % (inode.ino, inode.size, inode.mtime, inode.mode,
+                    inode.uid, inode.gid, (inode.partial or '-').encode(), (inode.digest or '-').encode(),
+                    numbers[inode.snapshot], inode.relpath)
+    hashing.writeAtomic(path, records(), functools.partial(gzip.open, compresslevel=3))
+
+def replaceWithLink(source, target):
+    """ Atomically replaces target with a hard link to source """
+    tmpPath = target + b'.dbackup-dedupe'
+    os.link(source, tmpPath)
+    try:
+        os.replace(tmpPath, target)
+    except OSError:
+        os.remove(tmpPath)
+        raise
+
+def dedupe(snapshotDirs, indexPath, minSize = defaultMinSize, workers = None, dryRun = False) -> dict:
+    """ Deduplicates files in a list of snapshot directories
+
+    Returns a dict with statistics
+    """
+    stats = { 'snapshots': 0, 'files': 0, 'newInodes': 0, 'hashed': 0,
+        'linked': 0, 'inodes': 0, 'saved': 0, 'skipped': [] }
+
+    snapshots, known = readIndex(indexPath)
+
+    # Forget snapshots that have been removed
+    snapshots = [ s for s in snapshots if os.path.isdir(s) ]
+    processed = set(snapshots)
+    known = { ino : inode for ino, inode in known.items() if inode.snapshot in processed }
+
+    # Scan the new snapshots, oldest first so the newest link is remembered
+    device = None
+    new = {}
+    for snapshot in sorted(map(os.fsencode, snapshotDirs), key=os.path.basename):
+        if snapshot in processed:
+            continue
+        try:
+            st = os.stat(snapshot)
+        except OSError:
+            stats['skipped'].append(os.fsdecode(snapshot))
+            continue
+        if device is None:
+            device = st.st_dev
+        elif st.st_dev != device:
+            # Hard links can't cross filesystems
+            stats['skipped'].append(os.fsdecode(snapshot))
+            continue
+
+        stats['snapshots'] += 1
+        for relpath, st in hashing.scanTree(snapshot, skip=metaDir):
+            if st.st_size < minSize:
+                continue
+            stats['files'] += 1
+            inode = known.get(st.st_ino)
+            if inode is not None and inode.size == st.st_size and inode.mtime == st.st_mtime_ns:
+                inode.snapshot, inode.relpath = snapshot, relpath
+                continue
+            inode = new.get(st.st_ino)
+            if inode is None:
+                inode = Inode(st.st_ino, st.st_size, st.st_mtime_ns, st.st_mode, st.st_uid, st.st_gid,
+                    None, None, snapshot, relpath)
+                inode.paths = []
+                new[st.st_ino] = inode
+            else:
+                inode.snapshot, inode.relpath = snapshot, relpath
+            inode.paths.append(os.path.join(snapshot, relpath))
+        snapshots.append(snapshot)
+
+    stats['newInodes'] = len(new)
+
+    # Inodes that could be identical to a new inode
+    for ino in new:
+        known.pop(ino, None)
+    newKeys = set(inode.key for inode in new.values())
+    groups = collections.defaultdict(list)
+    for inode in list(known.values()) + list(new.values()):
+        if inode.key in newKeys:
+            groups[inode.key].append(inode)
+    candidates = [ group for group in groups.values() if len(group) > 1 ]
+
+    # Narrow down with partial hashes, then full hashes
+    for partial in (True, False):
+        attribute = 'partial' if partial else 'digest'
+        toHash = { inode.ino : inode.path for group in candidates for inode in group
+            if getattr(inode, attribute) is None }
+        stats['hashed'] += len(toHash)
+        for ino, digest in hashing.hashPaths(toHash, workers, partial=partial).items():
+            setattr(new[ino] if ino in new else known[ino], attribute, digest)
+
+        narrowed = []
+        for group in candidates:
+            byHash = collections.defaultdict(list)
+            for inode in group:
+                if getattr(inode, attribute) is not None:
+                    byHash[getattr(inode, attribute)].append(inode)
+            narrowed += [ g for g in byHash.values() if len(g) > 1 ]
+        candidates = narrowed
+
+    # Link the new duplicates to an indexed inode if possible
+    for group in candidates:
+        group.sort(key=lambda inode: inode.paths is not None)
+        canonical = group[0]
+        for inode in group[1:]:
+            if inode.paths is None:
+                continue
+            merged = True
+            for path in inode.paths:
+                try:
+                    if os.lstat(canonical.path).st_ino != canonical.ino or os.lstat(path).st_ino != inode.ino:
+                        merged = False
+                        continue
+                    if not dryRun:
+                        replaceWithLink(canonical.path, path)
+                    stats['linked'] += 1
+                except OSError as e:
+                    merged = False
+                    if e.errno == errno.EMLINK:
+                        # Too many links, use this inode for the following duplicates
+                        break
+            if merged:
+                stats['inodes'] += 1
+                stats['saved'] += inode.size
+                if not dryRun:
+                    del new[inode.ino]
+            else:
+                canonical = inode
+
+    # Remember the new inodes
+    for inode in new.values():
+        inode.paths = None
+        known[inode.ino] = inode
+
+    if not dryRun:
+        writeIndex(indexPath, snapshots, known)
+
+    return stats
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Deduplicate files across snapshots with hard links')
+    parser.add_argument('snapshot', nargs='+', help='Snapshot directories')
+    parser.add_argument('--index', required=True, help='Path of the index')
+    parser.add_argument('--min-size', type=int, default=defaultMinSize, help='Ignore smaller files')
+    parser.add_argument('--workers', type=int, default=None, help='Number of hashing processes')
+    parser.add_argument('--dry-run', action='store_true', help='Only report what would be linked')
+    args = parser.parse_args(argv)
+
+    stats = dedupe(args.snapshot, args.index, args.min_size, args.workers, args.dry_run)
+    sys.stdout.write(json.dumps(stats) + '\n')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,167 @@
+""" Compares two snapshots by inode identity
+
+Unchanged files are hard links to the same inode in consecutive snapshots,
+so a file at the same path with the same inode is unchanged, and no file is
+read. Both trees are walked in lockstep, one directory pair at a time, by a
+pool of threads.
+
+A file at the same path with a different inode is modified. If its size and
+modification time are the same as well, rsync --link-dest should have
+linked it, so such files are counted as unlinked. Many unlinked files show
+that link-dest stopped working, e.g. after the destination was copied
+without preserving hard links.
+
+The hardlink efficiency is the share of the bytes in files that are present
+in both snapshots that are shared by a hard link.
+
+Prints one JSON line for each added, removed or modified file, unless
+--summary is given, followed by a line with kind summary and the totals.
+
+Only regular files are compared. This script is executed remotely, so it
+must only use the standard library.
+
+Usage:
+    diff.py <snapshot dir> <snapshot dir> [--summary] [--workers N]
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import stat
+import sys
+
+try:
+    from . import hashing
+except ImportError:
+    # Bundled by Location.runTool
+    import hashing
+
+# Tool modules that are bundled with this script
+requires = ['hashing']
+
+# Name of the metadata directory in each snapshot
+metaDir = b'.dbackup'
+
+kinds = ['added', 'removed', 'modified', 'unchanged', 'unlinked']
+
+def listDir(path) -> dict:
+    """ Returns { name : stat } of the entries of a directory, or {} """
+    entries = {}
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    entries[entry.name] = entry.stat(follow_symlinks=False)
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return entries
+
+def compareDir(before, after, rel):
+    """ Compares one directory of two snapshots
+
+    Returns (changes, subdirs, totals), where changes is a list of
+    (kind, size, relpath) and subdirs the directories present in both
+    """
+    changes = []
+    subdirs = []
+    totals = { kind : [0, 0] for kind in kinds }
+
+    def add(kind, size, relpath):
+        totals[kind][0] += 1
+        totals[kind][1] += size
+        if kind not in ('unchanged', 'unlinked'):
+            changes.append((kind, size, relpath))
+
+    def addTree(kind, root, relpath):
+        for path, st in hashing.scanTree(os.path.join(root, relpath)):
+            add(kind, st.st_size, os.path.join(relpath, path))
+
+    old = listDir(os.path.join(before, rel) if rel else before)
+    new = listDir(os.path.join(after, rel) if rel else after)
+    if not rel:
+        old.pop(metaDir, None)
+        new.pop(metaDir, None)
+
+    for name in old.keys() | new.keys():
+        relpath = os.path.join(rel, name) if rel else name
+        a = old.get(name)
+        b = new.get(name)
+        aDir = a is not None and stat.S_ISDIR(a.st_mode)
+        bDir = b is not None and stat.S_ISDIR(b.st_mode)
+        aFile = a is not None and stat.S_ISREG(a.st_mode)
+        bFile = b is not None and stat.S_ISREG(b.st_mode)
+        if aDir and bDir:
+            subdirs.append(relpath)
+        elif aFile and bFile:
+            if a.st_ino == b.st_ino and a.st_dev == b.st_dev:
+                add('unchanged', b.st_size, relpath)
+            else:
+                add('modified', b.st_size, relpath)
+                if a.st_size == b.st_size and int(a.st_mtime) == int(b.st_mtime):
+                    add('unlinked', b.st_size, relpath)
+        else:
+            if aDir:
+                addTree('removed', before, relpath)
+            elif aFile:
+                add('removed', a.st_size, relpath)
+            if bDir:
+                addTree('added', after, relpath)
+            elif bFile:
+                add('added', b.st_size, relpath)
+    return changes, subdirs, totals
+
+def diff(before, after, workers = 8):
+    """ Yields (kind, size, relpath) for each changed file
+
+    Returns the totals as { kind : [files, bytes] } when exhausted
+    """
+    before = os.fsencode(before)
+    after = os.fsencode(after)
+    totals = { kind : [0, 0] for kind in kinds }
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        pending = { pool.submit(compareDir, before, after, b'') }
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                changes, subdirs, dirTotals = future.result()
+                for relpath in subdirs:
+                    pending.add(pool.submit(compareDir, before, after, relpath))
+                for kind, (files, size) in dirTotals.items():
+                    totals[kind][0] += files
+                    totals[kind][1] += size
+                yield from changes
+    return totals
+
+def efficiency(totals) -> float:
+    """ Share of the bytes in files present in both snapshots that are hard linked, or None """
+    common = totals['unchanged'][1] + totals['modified'][1]
+    if common == 0:
+        return 1.0 if totals['unchanged'][0] else None
+    return totals['unchanged'][1] / common
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Compare two snapshots by inode')
+    parser.add_argument('before', help='Older snapshot directory')
+    parser.add_argument('after', help='Newer snapshot directory')
+    parser.add_argument('--summary', action='store_true', help='Only print the totals')
+    parser.add_argument('--workers', type=int, default=8, help='Number of directories compared at the same time')
+    args = parser.parse_args(argv)
+
+    changes = diff(args.before, args.after, args.workers)
+    while True:
+        try:
+            kind, size, relpath = next(changes)
+        except StopIteration as e:
+            totals = e.value
+            break
+        if not args.summary:
+            sys.stdout.write(json.dumps({ 'kind': kind, 'size': size, 'path': os.fsdecode(relpath) }) + '\n')
+    sys.stdout.write(json.dumps({ 'kind': 'summary', 'totals': totals, 'efficiency': efficiency(totals) }) + '\n')
+    sys.stdout.flush()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,141 @@
+""" Finds what the exclude rules of a job leave out of a backup
+
+Walks the source of a job without reading any file and reports
+
+    - the directories that are tagged with a valid CACHEDIR.TAG file, which
+      rsync can't detect by itself
+    - the number of files and bytes that each rule excludes
+
+Patterns are matched like rsync does for simple exclude rules: a trailing /
+only matches directories, a leading / anchors the pattern at the root, and
+a pattern without a leading / matches the end of the path, one component
+per path component. * and ? don't match /, and ** isn't supported. The
+first matching rule is credited with an excluded directory and everything
+below it.
+
+Prints one JSON line with cachedirs (relative paths) and saved, a map from
+rule to [files, bytes].
+
+This script is executed remotely, so it must only use the standard library.
+
+Usage:
+    excludes.py <root> [--caches] [--rule PATTERN ...] [--max-size N]
+"""
+
+import argparse
+import fnmatch
+import json
+import os
+import stat
+import sys
+
+cacheDirTag = 'CACHEDIR.TAG'
+cacheDirSignature = b'Signature: 8a477f597d28d172789f06886806bc55'
+
+# Rule names for the rules that are not patterns
+cacheDirRule = 'CACHEDIR.TAG'
+maxSizeRule = 'max file size'
+
+def isCacheDir(path) -> bool:
+    """ Checks if a directory has a CACHEDIR.TAG that starts with the signature """
+    try:
+        with open(os.path.join(path, cacheDirTag), 'rb') as f:
+            return f.read(len(cacheDirSignature)) == cacheDirSignature
+    except OSError:
+        return False
+
+def matches(pattern : str, relpath : str, isDir : bool) -> bool:
+    """ Checks if an rsync exclude pattern matches a path relative to the root """
+    if pattern.endswith('/'):
+        if not isDir:
+            return False
+        pattern = pattern.rstrip('/')
+    anchored = pattern.startswith('/')
+    parts = pattern.strip('/').split('/')
+    components = relpath.split('/')
+    if anchored and len(components) != len(parts):
+        return False
+    if len(components) < len(parts):
+        return False
+    tail = components[len(components) - len(parts):]
+    return all(fnmatch.fnmatchcase(component, part) for component, part in zip(tail, parts))
+
+def treeSize(path) -> tuple:
+    """ (files, bytes) in a directory, recursively. Links are not followed """
+    files = 0
+    size = 0
+    stack = [ path ]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    if stat.S_ISDIR(st.st_mode):
+                        stack.append(entry.path)
+                        continue
+                    files += 1
+                    if stat.S_ISREG(st.st_mode):
+                        size += st.st_size
+        except OSError:
+            pass
+    return files, size
+
+def scan(root, caches = False, rules = (), maxSize = None) -> tuple:
+    """ Walks root and returns (cachedirs, { rule : [files, bytes] }) """
+    cacheDirs = []
+    saved = {}
+
+    def credit(rule, files, size):
+        totals = saved.setdefault(rule, [0, 0])
+        totals[0] += files
+        totals[1] += size
+
+    stack = [ '' ]
+    while stack:
+        reldir = stack.pop()
+        try:
+            entries = list(os.scandir(os.path.join(root, reldir)))
+        except OSError:
+            continue
+        for entry in entries:
+            relpath = os.path.join(reldir, entry.name) if reldir else entry.name
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            isDir = stat.S_ISDIR(st.st_mode)
+            rule = next((rule for rule in rules if matches(rule, relpath, isDir)), None)
+            if isDir:
+                if rule is None and caches and isCacheDir(entry.path):
+                    cacheDirs.append(relpath)
+                    rule = cacheDirRule
+                if rule is None:
+                    stack.append(relpath)
+                else:
+                    credit(rule, *treeSize(entry.path))
+                continue
+            size = st.st_size if stat.S_ISREG(st.st_mode) else 0
+            if rule is None and maxSize is not None and stat.S_ISREG(st.st_mode) and size > maxSize:
+                rule = maxSizeRule
+            if rule is not None:
+                credit(rule, 1, size)
+    return sorted(cacheDirs), saved
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Find what exclude rules leave out of a backup')
+    parser.add_argument('root', help='Source directory')
+    parser.add_argument('--caches', action='store_true', help='Exclude directories tagged with CACHEDIR.TAG')
+    parser.add_argument('--rule', action='append', default=[], help='rsync exclude pattern')
+    parser.add_argument('--max-size', type=int, default=None, help='Size of the largest file in bytes')
+    args = parser.parse_args(argv)
+
+    cacheDirs, saved = scan(args.root, args.caches, args.rule, args.max_size)
+    sys.stdout.write(json.dumps({ 'cachedirs': [ os.fsdecode(path) for path in cacheDirs ], 'saved': saved }) + '\n')
+    sys.stdout.flush()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,142 @@
+""" Streams a snapshot as a tar archive
+
+The archive is written to stdout in PAX format, one block at a time, so
+memory use doesn't depend on the size of the snapshot. Compression is left
+to a pipe, e.g. zstd -T0.
+
+With --previous, only the files whose inode differs from the same path in
+the previous snapshot are archived. Unchanged files are hard links between
+snapshots, so this needs no index of the previous export. Directories are
+always archived. Entries that were deleted since the previous snapshot are
+listed per directory in members named
+
+    .dbackup-export/deleted/<directory>
+
+that contain the NUL-terminated names of the deleted entries.
+
+Hard links inside the snapshot are archived as separate files, as tracking
+them would need memory for every inode.
+
+A summary is written to stderr as a line starting with 'dbackup-export '.
+
+This script is executed remotely, so it must only use the standard library.
+
+Usage:
+    export.py <snapshot dir> [--previous <snapshot dir>]
+"""
+
+import argparse
+import io
+import json
+import os
+import stat
+import sys
+import tarfile
+
+# Name of the metadata directory in each snapshot
+metaDir = b'.dbackup'
+
+deletedDir = '.dbackup-export/deleted'
+
+summaryPrefix = 'dbackup-export '
+
+def tarInfo(name, st, linkname = None):
+    info = tarfile.TarInfo(name)
+    info.mode = stat.S_IMODE(st.st_mode)
+    info.uid = st.st_uid
+    info.gid = st.st_gid
+    info.mtime = st.st_mtime
+    if stat.S_ISDIR(st.st_mode):
+        info.type = tarfile.DIRTYPE
+    elif stat.S_ISLNK(st.st_mode):
+        info.type = tarfile.SYMTYPE
+        info.linkname = linkname
+    else:
+        info.type = tarfile.REGTYPE
+        info.size = st.st_size
+    return info
+
+def listDir(path) -> dict:
+    """ Returns { name : stat } of the entries of a directory, or {} """
+    entries = {}
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    entries[entry.name] = entry.stat(follow_symlinks=False)
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return entries
+
+def export(snapshot, out, previous = None) -> dict:
+    """ Writes a snapshot as a tar stream to the binary file out
+
+    Returns statistics
+    """
+    stats = { 'files': 0, 'dirs': 0, 'bytes': 0, 'unchanged': 0, 'deleted': 0, 'unreadable': 0 }
+    snapshot = os.fsencode(snapshot)
+    previous = os.fsencode(previous) if previous else None
+
+    with tarfile.open(fileobj=out, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+        stack = [b'']
+        while stack:
+            rel = stack.pop()
+            entries = listDir(os.path.join(snapshot, rel) if rel else snapshot)
+            if not rel:
+                entries.pop(metaDir, None)
+
+            if previous is not None:
+                before = listDir(os.path.join(previous, rel) if rel else previous)
+                if not rel:
+                    before.pop(metaDir, None)
+                deleted = sorted(name for name in before if name not in entries)
+                if deleted:
+                    data = b''.join(name + b'\0' for name in deleted)
+                    info = tarfile.TarInfo(os.fsdecode(os.path.join(deletedDir.encode(), rel) if rel else deletedDir.encode()))
+                    info.size = len(data)
+                    tar.addfile(info, io.BytesIO(data))
+                    stats['deleted'] += len(deleted)
+            else:
+                before = {}
+
+            for name in sorted(entries):
+                st = entries[name]
+                relpath = os.path.join(rel, name) if rel else name
+                path = os.path.join(snapshot, relpath)
+                if stat.S_ISDIR(st.st_mode):
+                    tar.addfile(tarInfo(os.fsdecode(relpath), st))
+                    stats['dirs'] += 1
+                    stack.append(relpath)
+                elif name in before and before[name].st_ino == st.st_ino:
+                    stats['unchanged'] += 1
+                elif stat.S_ISLNK(st.st_mode):
+                    tar.addfile(tarInfo(os.fsdecode(relpath), st, os.fsdecode(os.readlink(path))))
+                    stats['files'] += 1
+                elif stat.S_ISREG(st.st_mode):
+                    try:
+                        with open(path, 'rb') as f:
+                            # The size in the header must match what is read
+                            st = os.fstat(f.fileno())
+                            tar.addfile(tarInfo(os.fsdecode(relpath), st), f)
+                    except OSError:
+                        stats['unreadable'] += 1
+                        continue
+                    stats['files'] += 1
+                    stats['bytes'] += st.st_size
+    return stats
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Stream a snapshot as a tar archive')
+    parser.add_argument('snapshot', help='Snapshot directory')
+    parser.add_argument('--previous', default=None, help='Only archive what changed since this snapshot')
+    args = parser.parse_args(argv)
+
+    stats = export(args.snapshot, sys.stdout.buffer, args.previous)
+    sys.stdout.buffer.flush()
+    sys.stderr.write(summaryPrefix + json.dumps(stats) + '\n')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,121 @@
+""" Hashing and tree walking shared by the tools
+
+Files are read with mmap and hashed with blake2b. Many files are hashed in
+parallel in a pool of forked worker processes.
+
+This module is bundled with the tools that require it, so it must only use
+the standard library.
+"""
+
+import concurrent.futures
+import hashlib
+import mmap
+import multiprocessing
+import os
+import stat
+
+# Size of each slice that is fed to the hash function
+hashBlockSize = 8 * 1024 * 1024
+
+# Number of bytes from the start and the end of a file in a partial hash
+partialSize = 64 * 1024
+
+# Hash inline if fewer files than this needs hashing
+poolThreshold = 64
+
+def _hashView(h, view, start, end):
+    for offset in range(start, end, hashBlockSize):
+        h.update(view[offset:min(offset + hashBlockSize, end)])
+
+def hashFile(path, partial = False):
+    """ Hashes the contents of a file with mmap'd reads
+
+    If partial is set, only the first and last partialSize bytes are hashed
+
+    Returns the hex digest or None if the file could not be read
+    """
+    h = hashlib.blake2b(digest_size=16)
+    try:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size > 0:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    if hasattr(m, 'madvise') and not partial:
+                        m.madvise(mmap.MADV_SEQUENTIAL)
+                    view = memoryview(m)
+                    try:
+                        if partial and size > 2 * partialSize:
+                            _hashView(h, view, 0, partialSize)
+                            _hashView(h, view, size - partialSize, size)
+                        else:
+                            _hashView(h, view, 0, size)
+                    finally:
+                        view.release()
+    except (OSError, ValueError):
+        return None
+    return h.hexdigest()
+
+def hashPartial(path):
+    return hashFile(path, partial=True)
+
+def hashPaths(paths : dict, workers = None, partial = False) -> dict:
+    """ Hashes files in parallel
+
+    Arguments:
+        paths (dict) : Maps a key (typically inode) to a path to hash
+
+    Returns a dict from key to hex digest (or None if unreadable)
+    """
+    function = hashPartial if partial else hashFile
+    keys = list(paths.keys())
+    if len(keys) < poolThreshold or workers == 1:
+        return { key : function(paths[key]) for key in keys }
+
+    # Fork explicitly, the tools may be run from stdin where spawn can't work
+    ctx = multiprocessing.get_context('fork')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+        digests = pool.map(function, [paths[key] for key in keys], chunksize=32)
+        return dict(zip(keys, digests))
+
+def scanTree(root, skip = None):
+    """ Walks a tree and yields (relpath, stat) for each regular file
+
+    Paths are bytes relative to root. An entry named skip in the root
+    directory is not walked.
+    """
+    root = os.fsencode(root)
+    skip = os.fsencode(skip) if skip else None
+    stack = [b'']
+    while stack:
+        rel = stack.pop()
+        try:
+            it = os.scandir(os.path.join(root, rel) if rel else root)
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                if not rel and entry.name == skip:
+                    continue
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                relpath = os.path.join(rel, entry.name) if rel else entry.name
+                if stat.S_ISDIR(st.st_mode):
+                    stack.append(relpath)
+                elif stat.S_ISREG(st.st_mode):
+                    yield relpath, st
+
+def writeAtomic(path, data, opener = open):
+    """ Writes chunks of bytes to path via a temporary file
+
+    Arguments:
+        data : iterable of bytes
+        opener : function that opens the file, e.g. gzip.open
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmpPath = path + '.tmp'
+    with opener(tmpPath, 'wb') as f:
+        for chunk in data:
+            f.write(chunk)
+    os.replace(tmpPath, path)
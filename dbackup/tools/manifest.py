@@ -0,0 +1,197 @@
+""" Content manifests for snapshots
+
+Builds and verifies manifests of the regular files in a snapshot. The
+manifest is stored inside the snapshot as .dbackup/manifest.gz and consists
+of NUL-terminated records
+
+    <hash> <size> <mtime_ns> <path>
+
+Unchanged files are hard links to the same inode in all snapshots of a job,
+so each inode is only hashed once. While building, a cache from inode to
+hash is kept in <dest>/.dbackup/hashcache.gz, which holds the inodes of the
+latest manifest. While verifying, the hashes are shared between all
+snapshots in the same run.
+
+Hashing is done with mmap'd reads in a pool of worker processes, see hashing.py
+
+This script is executed remotely, so it must only use the standard library.
+
+Usage:
+    manifest.py build <dest> <snapshot> [--workers N]
+    manifest.py verify <dest> <snapshot> [<snapshot> ...] [--workers N]
+"""
+
+import argparse
+import functools
+import gzip
+import json
+import os
+import sys
+
+try:
+    from . import hashing
+except ImportError:
+    # Bundled by Location.runTool
+    import hashing
+
+# Tool modules that are bundled with this script
+requires = ['hashing']
+
+# Name of the metadata directory in the destination and in each snapshot
+metaDir = '.dbackup'
+
+manifestName = 'manifest.gz'
+cacheName = 'hashcache.gz'
+
+manifestHeader = b'# dbackup manifest 1\0'
+
+# Number of offending paths listed per snapshot when verifying
+maxListed = 20
+
+def scanTree(root):
+    """ Yields (relpath, ino, size, mtime_ns) for each regular file in a snapshot """
+    for relpath, st in hashing.scanTree(root, skip=metaDir):
+        yield relpath, st.st_ino, st.st_size, st.st_mtime_ns
+
+def readManifest(path) -> dict:
+    """ Reads a manifest file and returns { relpath : (hash, size, mtime_ns) } """
+    manifest = {}
+    with gzip.open(path, 'rb') as f:
+        records = f.read().split(b'\0')
+    if not records or records[0] + b'\0' != manifestHeader:
+        raise ValueError('Not a manifest: %s' % path)
+    for record in records[1:]:
+        if not record:
+            continue
+        digest, size, mtime, relpath = record.split(b' ', 3)
+        manifest[relpath] = (digest.decode(), int(size), int(mtime))
+    return manifest
+
+def _writeAtomic(path, records):
+    """ Writes gzip'ed records to path via a temporary file """
+    hashing.writeAtomic(path, records, functools.partial(gzip.open, compresslevel=3))
+
+def readCache(path) -> dict:
+    """ Reads the inode hash cache { (ino, size, mtime_ns) : hash } """
+    cache = {}
+    try:
+        with gzip.open(path, 'rt') as f:
+            for line in f:
+                ino, size, mtime, digest = line.split()
+                cache[(int(ino), int(size), int(mtime))] = digest
+    except (OSError, ValueError, EOFError):
+        pass
+    return cache
+
+def writeCache(path, cache : dict):
+    _writeAtomic(path, (('%d %d %d %s\n' % (key + (digest,))).encode() for key, digest in cache.items()))
+
+def build(dest, snapshot, workers = None) -> dict:
+    """ Builds the manifest of a snapshot
+
+    Only inodes that are not in the hash cache of the destination are hashed.
+
+    Returns a dict with statistics
+    """
+    snapshotDir = os.path.join(dest, snapshot)
+    cachePath = os.path.join(dest, metaDir, cacheName)
+
+    entries = list(scanTree(snapshotDir))
+    cache = readCache(cachePath)
+
+    toHash = {}
+    for relpath, ino, size, mtime in entries:
+        key = (ino, size, mtime)
+        if key not in cache and key not in toHash:
+            toHash[key] = os.path.join(os.fsencode(snapshotDir), relpath)
+
+    cache.update(hashing.hashPaths(toHash, workers))
+
+    # The cache only keeps the inodes of the latest snapshot, as the next
+    # snapshot links to those
+    newCache = {}
+    records = [manifestHeader]
+    unreadable = 0
+    for relpath, ino, size, mtime in entries:
+        key = (ino, size, mtime)
+        digest = cache.get(key)
+        if digest is None:
+            unreadable += 1
+            continue
+        newCache[key] = digest
+        records.append(b'%s %d %d %s\0' % (digest.encode(), size, mtime, relpath))
+
+    _writeAtomic(os.path.join(snapshotDir, metaDir, manifestName), records)
+    writeCache(cachePath, newCache)
+
+    return { 'snapshot': snapshot, 'files': len(entries), 'hashed': len(toHash), 'unreadable': unreadable }
+
+def _report(result, kind, relpath):
+    """ Counts a problem in a verify result and lists the first few paths """
+    result[kind] += 1
+    if len(result['paths']) < maxListed:
+        result['paths'].append(kind + ': ' + os.fsdecode(relpath))
+
+def verify(dest, snapshots, workers = None):
+    """ Verifies snapshots against their manifests
+
+    Hashes are shared between the snapshots, so each inode is read at most once.
+
+    Yields a dict with the result of each snapshot
+    """
+    hashes = {}
+    for snapshot in snapshots:
+        snapshotDir = os.path.join(dest, snapshot)
+        result = { 'snapshot': snapshot, 'files': 0, 'hashed': 0,
+            'missing': 0, 'extra': 0, 'modified': 0, 'paths': [] }
+        try:
+            manifest = readManifest(os.path.join(snapshotDir, metaDir, manifestName))
+        except (OSError, ValueError, EOFError):
+            result['status'] = 'nomanifest'
+            yield result
+            continue
+
+        found = {}
+        toHash = {}
+        for relpath, ino, size, mtime in scanTree(snapshotDir):
+            found[relpath] = (ino, size)
+            if relpath not in manifest:
+                _report(result, 'extra', relpath)
+            elif ino not in hashes and ino not in toHash and manifest[relpath][1] == size:
+                toHash[ino] = os.path.join(os.fsencode(snapshotDir), relpath)
+        hashes.update(hashing.hashPaths(toHash, workers))
+
+        for relpath, (digest, size, mtime) in manifest.items():
+            if relpath not in found:
+                _report(result, 'missing', relpath)
+                continue
+            ino, actualSize = found[relpath]
+            if actualSize != size or hashes.get(ino) != digest:
+                _report(result, 'modified', relpath)
+
+        result['files'] = len(manifest)
+        result['hashed'] = len(toHash)
+        bad = result['missing'] or result['extra'] or result['modified']
+        result['status'] = 'failed' if bad else 'ok'
+        yield result
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Build or verify snapshot manifests')
+    parser.add_argument('action', choices=['build', 'verify'])
+    parser.add_argument('dest', help='Destination directory that holds the snapshots')
+    parser.add_argument('snapshot', nargs='+', help='Snapshot name(s)')
+    parser.add_argument('--workers', type=int, default=None, help='Number of hashing processes')
+    args = parser.parse_args(argv)
+
+    if args.action == 'build':
+        results = [ build(args.dest, snapshot, args.workers) for snapshot in args.snapshot ]
+    else:
+        results = verify(args.dest, args.snapshot, args.workers)
+
+    for result in results:
+        sys.stdout.write(json.dumps(result) + '\n')
+        sys.stdout.flush()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
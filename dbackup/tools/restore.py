@@ -0,0 +1,122 @@
+""" Splits a restore into balanced parallel streams
+
+Walks the directory that is restored once to find the size of every
+subtree. Subtrees that are larger than a fair share of a stream are split
+into their children, until every entry fits. The entries are then assigned
+to the streams, largest first, each to the stream with the fewest bytes.
+
+Each stream is a list of paths relative to the restored directory, for
+rsync --files-from. Directories in the list are restored recursively.
+
+This script is executed remotely, so it must only use the standard library.
+
+Entries of the restored directory given with --exclude, like the .dbackup
+metadata of a snapshot, are left out of the plan.
+
+Usage:
+    restore.py plan <dir> [--streams N] [--exclude NAME]...
+"""
+
+import argparse
+import heapq
+import json
+import os
+import stat
+import sys
+
+def treeSizes(root, exclude = ()) -> dict:
+    """ Returns { relpath : total size of the regular files } for all directories under root
+
+    The names in exclude are skipped in root itself
+    """
+    sizes = {}
+    def walk(rel):
+        total = 0
+        try:
+            it = os.scandir(os.path.join(root, rel) if rel else root)
+        except OSError:
+            return 0
+        with it:
+            for entry in it:
+                if not rel and entry.name in exclude:
+                    continue
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                if stat.S_ISDIR(st.st_mode):
+                    total += walk(os.path.join(rel, entry.name) if rel else entry.name)
+                elif stat.S_ISREG(st.st_mode):
+                    total += st.st_size
+        sizes[rel] = total
+        return total
+    walk(b'')
+    return sizes
+
+def children(root, rel, sizes, exclude = ()):
+    """ Yields (size, relpath, isdir) for the entries of a directory, but not the names in exclude in root """
+    try:
+        it = os.scandir(os.path.join(root, rel) if rel else root)
+    except OSError:
+        return
+    with it:
+        for entry in it:
+            if not rel and entry.name in exclude:
+                continue
+            relpath = os.path.join(rel, entry.name) if rel else entry.name
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                yield sizes.get(relpath, 0), relpath, True
+            else:
+                yield (st.st_size if stat.S_ISREG(st.st_mode) else 0), relpath, False
+
+def plan(root, streams = 4, exclude = ()) -> dict:
+    """ Splits the entries under root, except the names in exclude, into streams of about the same size """
+    root = os.fsencode(root)
+    exclude = set(map(os.fsencode, exclude))
+    sizes = treeSizes(root, exclude)
+    total = sizes.get(b'', 0)
+    share = total / max(1, streams)
+
+    # Split the largest directories until all entries fit in a share
+    entries = []
+    pending = [ (-size, relpath, isdir) for size, relpath, isdir in children(root, b'', sizes, exclude) ]
+    heapq.heapify(pending)
+    while pending:
+        size, relpath, isdir = heapq.heappop(pending)
+        if isdir and -size > share and len(entries) + len(pending) < 10000:
+            split = [ (-s, r, d) for s, r, d in children(root, relpath, sizes) ]
+            if split:
+                for item in split:
+                    heapq.heappush(pending, item)
+                continue
+        entries.append((-size, relpath))
+
+    # Largest first, each to the least loaded stream
+    loads = [ (0, n) for n in range(max(1, streams)) ]
+    paths = [ [] for n in range(max(1, streams)) ]
+    for size, relpath in sorted(entries, reverse=True):
+        load, n = heapq.heappop(loads)
+        paths[n].append(os.fsdecode(relpath))
+        heapq.heappush(loads, (load + size, n))
+    sizes = { n : load for load, n in loads }
+
+    return { 'dir': os.path.isdir(root), 'bytes': total, 'streams': [ { 'bytes': sizes[n], 'paths': paths[n] }
+        for n in range(len(paths)) if paths[n] ] }
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Split a restore into parallel streams')
+    parser.add_argument('action', choices=['plan'])
+    parser.add_argument('dir', help='Directory to restore')
+    parser.add_argument('--streams', type=int, default=4, help='Number of streams')
+    parser.add_argument('--exclude', action='append', default=[], help='Entry of dir to leave out')
+    args = parser.parse_args(argv)
+
+    sys.stdout.write(json.dumps(plan(args.dir, args.streams, args.exclude)) + '\n')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,4 +1,25 @@
 from .job import TestJob
 from .sshArgs import TestSshArgs
 from .sshLocation import TestSshLocation
-from .locationFactory import TestLocationFactory
\ No newline at end of file
+from .locationFactory import TestLocationFactory
+from .manifest import TestManifest
+from .changeLog import TestChangeLog
+from .dedupe import TestDedupe
+from .rsyncStats import TestRSyncStats
+from .stateTracker import TestStateTracker
+from .backup import TestBackup
+from .clean import TestCleanPipeline, TestCleanHost
+from .scheduler import TestScheduler
+from .catalog import TestCatalog
+from .restore import TestRestore
+from .callStats import TestCallStats
+from .export import TestExport
+from .diff import TestDiff
+from .priority import TestPriority
+from .throttle import TestThrottle
+from .migrate import TestMigrate
+from .excludes import TestExcludes
+from .rsyncDaemon import TestRsyncDaemon
+from .chunks import TestChunks
+from .leases import TestLeases
+from .reconcile import TestReconcile
@@ -0,0 +1,157 @@
+import os
+import tempfile
+import time
+import shutil
+import sys
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import dbackup
+from dbackup.commands import Backup
+
+class TestBackup(unittest.TestCase):
+
+    jobSpec = {
+        'cert': str(Path(__file__).parent / 'data' / 'dummy_key.pub'),
+        'source': 'gud@source.host:/srv/source',
+        'dest': 'backup@dest.host:/srv/mirror/gud',
+        'ssharg': '-p 1234',
+    }
+
+    def test_localToRemote(self):
+        spec = dict(self.jobSpec, source='/srv/source')
+        job = dbackup.Job('test', spec)
+        self.assertIsNone(job.relay)
+
+        rsync = Backup(None).buildRSync(job, [], '2020-10-01.incomplete')
+        self.assertEqual(rsync[-2:], ['/srv/source/', 'dest.host:/srv/mirror/gud/2020-10-01.incomplete'])
+        self.assertIs(Backup(None).relayCommand(job, rsync), rsync)
+
+    def test_relayOnDest(self):
+        job = dbackup.Job('test', self.jobSpec)
+        self.assertEqual(job.relay, 'dest')
+        self.assertIs(job.relayLocation, job.dest)
+
+        backup = Backup(None)
+        rsync = backup.buildRSync(job, ['--link-dest=/srv/mirror/gud/2020-09-30'], '2020-10-01.incomplete')
+        self.assertEqual(rsync[-2:], ['source.host:/srv/source/', '/srv/mirror/gud/2020-10-01.incomplete'])
+        self.assertIn('--rsh=ssh -p 1234 -l gud -o BatchMode=yes', rsync)
+
+        command = backup.relayCommand(job, rsync)
+        self.assertEqual(command[0], 'ssh')
+        self.assertIn('-A', command)
+        self.assertEqual(command[command.index('-l') + 1], 'backup')
+        self.assertEqual(command[-2], 'dest.host')
+        self.assertTrue(command[-1].startswith('rsync '))
+
+    def test_relayOnSourceWithKey(self):
+        spec = dict(self.jobSpec, relay='source')
+        spec['relay key'] = '/etc/dbackup/relay_key'
+        job = dbackup.Job('test', spec)
+
+        backup = Backup(None)
+        rsync = backup.buildRSync(job, [], '2020-10-01.incomplete')
+        self.assertEqual(rsync[-2:], ['/srv/source/', 'dest.host:/srv/mirror/gud/2020-10-01.incomplete'])
+        self.assertIn('--rsh=ssh -p 1234 -l backup -i /etc/dbackup/relay_key -o BatchMode=yes', rsync)
+
+        command = backup.relayCommand(job, rsync)
+        self.assertNotIn('-A', command)
+        self.assertEqual(command[-2], 'source.host')
+
+    def test_timestamps(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, 'source')
+            dest = os.path.join(tmp, 'dest')
+            os.makedirs(source)
+            os.makedirs(os.path.join(dest, '2020-09-30'))
+            job = dbackup.Job('test', { 'source': source, 'dest': dest, 'timestamps': 'yes', 'changelog': 'no' })
+            self.assertEqual(job.hoursToKeep, 24)
+            commands = []
+            def fakeRSync(rsync, *args, **kwargs):
+                commands.append(rsync)
+                shutil.copytree(source, rsync[-1])
+                return True
+
+            stateTracker = dbackup.helpers.StateTracker(os.path.join(tmp, 'state'))
+            backup = Backup(None, stateTracker)
+            backup.today = '2020-10-01'
+            with mock.patch.object(Backup, 'invokeRSync', side_effect=fakeRSync):
+                for timeOfDay in ('0900', '1000'):
+                    backup.timeOfDay = timeOfDay
+                    self.assertEqual(backup.execute(job), dbackup.resultcodes.SUCCESS)
+
+            # Each run makes a new snapshot, linked to the previous one
+            self.assertEqual(sorted(os.listdir(dest)), ['2020-09-30', '2020-10-01T0900', '2020-10-01T1000'])
+            self.assertIn('--link-dest=' + os.path.join(dest, '2020-09-30'), commands[0])
+            self.assertIn('--link-dest=' + os.path.join(dest, '2020-10-01T0900'), commands[1])
+            self.assertEqual(stateTracker.getLastGood(job), '2020-10-01T1000')
+            self.assertIsNotNone(stateTracker.getJobAge(job))
+
+    def test_estimateTransfer(self):
+        job = dbackup.Job('test', dict(self.jobSpec, source='/srv/source'))
+        with tempfile.TemporaryDirectory() as tmp:
+            stateTracker = dbackup.helpers.StateTracker(os.path.join(tmp, 'state'))
+            backup = Backup(None, stateTracker)
+            stateTracker.recordRun(job, transferred=1000000)
+            # A full transfer doesn't estimate the next incremental backup
+            self.assertIsNone(backup.estimateTransfer(job, [], incremental=True))
+            self.assertEqual(backup.estimateTransfer(job, []), 1000000)
+            for transferred in (1000, 3000, 2000):
+                stateTracker.recordRun(job, transferred=transferred, incremental=True)
+            self.assertEqual(backup.estimateTransfer(job, [], incremental=True), 2000)
+            self.assertEqual(stateTracker.getHistory(job, 'Transferred'), [1000000, 1000, 3000, 2000])
+
+    def test_input(self):
+        self.assertEqual(Backup(None).runRSync(['sh', '-c', 'test "$(cat)" = /thumbs/'], input=b'/thumbs/\n'), 0)
+
+    def test_replicate(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, 'source')
+            dests = [ os.path.join(tmp, 'site1'), os.path.join(tmp, 'site2') ]
+            os.makedirs(source)
+            job = dbackup.Job('test', { 'source': source, 'dest': '\n'.join(dests), 'changelog': 'no' })
+            commands = []
+            def fakeRSync(rsync, *args, **kwargs):
+                commands.append(rsync)
+                if len(commands) > 1:
+                    # The copy to site2 fails
+                    return False
+                shutil.copytree(source, rsync[-1])
+                return True
+
+            backup = Backup(None)
+            backup.today = '2020-10-01'
+            with mock.patch.object(Backup, 'invokeRSync', side_effect=fakeRSync):
+                with self.assertLogs(level='ERROR'):
+                    self.assertEqual(backup.execute(job), dbackup.resultcodes.REPLICA_FAILED)
+            self.assertEqual(len(commands), 2)
+            self.assertNotIn('--exclude=/.dbackup', commands[0])
+            self.assertIn('--exclude=/.dbackup', commands[1])
+            self.assertEqual(os.listdir(dests[0]), ['2020-10-01'])
+
+    def test_acceptedExitCode(self):
+        self.assertTrue(Backup(None).invokeRSync(['sh', '-c', 'exit 24']))
+        self.assertFalse(Backup(None).invokeRSync(['sh', '-c', 'exit 23'], retries=2, retryDelay=0))
+
+    def test_retry(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            counter = os.path.join(tmp, 'attempts')
+            # Fails with a connection error the first time
+            script = f'echo x >> {counter}; [ $(wc -l < {counter}) -ge 2 ] || exit 12'
+            self.assertTrue(Backup(None).invokeRSync(['sh', '-c', script], retries=2, retryDelay=0))
+            with open(counter) as f:
+                self.assertEqual(len(f.readlines()), 2)
+
+    def test_stallTimeout(self):
+        start = time.monotonic()
+        backup = Backup(None)
+        self.assertEqual(backup.runRSync(['sleep', '30'], stallTimeout=1), Backup.stalledExitCode)
+        self.assertLess(time.monotonic() - start, 10)
+
+    def test_stallTimeoutChildIo(self):
+        # Like the receiver of a pull, a child does the I/O while its parent only waits
+        with tempfile.TemporaryDirectory() as tmp:
+            child = f'import time\nfor n in range(40):\n    open(\"{tmp}/out\", \"w\").write(\"x\" * 4096); time.sleep(0.1)'
+            script = f'{sys.executable} -c \'{child}\'; true'
+            self.assertEqual(Backup(None).runRSync(['sh', '-c', script], stallTimeout=1), 0)
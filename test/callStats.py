@@ -0,0 +1,68 @@
+import unittest
+import os
+import tempfile
+from pathlib import Path
+
+import dbackup
+from dbackup.commands import Clean
+from dbackup.helpers import callStats
+
+from .fakessh import FakeSsh
+
+class TestCallStats(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        callStats.reset()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        callStats.reset()
+
+    def makeJobs(self, count):
+        jobs = []
+        for n in range(count):
+            dest = os.path.join(self.tmp.name, f'job{n}')
+            for snapshot in ['2020-09-29', '2020-09-30', '2020-10-02']:
+                os.makedirs(os.path.join(dest, snapshot))
+            jobs.append(dbackup.Job(f'job{n}', {
+                'cert': str(Path(__file__).parent / 'data' / 'dummy_key.pub'),
+                'source': '/srv/source',
+                'dest': 'backup@localhost:' + dest,
+                'ssharg': '-p 1234',
+                'days': 1,
+                'months': 0,
+            }))
+        return jobs
+
+    def remaining(self, job):
+        return sorted(os.listdir(job.dest.path))
+
+    def test_record(self):
+        with callStats.job('job1'):
+            callStats.run('true', ['true'])
+            with callStats.record('list', ['ssh', '-p', '22', 'host', 'ls']):
+                pass
+            with callStats.record('rsync', ['rsync', '--rsh=ssh -p 22', 'a', 'b']):
+                pass
+        self.assertEqual(callStats.jobTotals('job1')[:2], (3, 2))
+        self.assertEqual(callStats.jobTotals('job2'), (0, 0, 0.0))
+        self.assertTrue(callStats.report()[0].startswith('job1: 3 processes, 2 ssh'))
+
+    def test_cleanRoundTrips(self):
+        jobs = self.makeJobs(3)
+        with FakeSsh(latency=0.01) as ssh:
+            # One job at a time lists and deletes with one call each
+            for job in jobs[:1]:
+                with callStats.job(job):
+                    self.assertTrue(Clean(simulate=False).CleanJob(job))
+            self.assertEqual(callStats.jobTotals(jobs[0])[1], 2)
+
+            # All jobs on the host share the same two calls
+            callStats.reset()
+            self.assertEqual(Clean(simulate=False).execute(jobs[1:]), dbackup.resultcodes.SUCCESS)
+            self.assertEqual(callStats.jobTotals('job1, job2')[1], 2)
+            self.assertEqual(len(ssh.commands), 4)
+
+        for job in jobs:
+            self.assertEqual(self.remaining(job), ['2020-10-02'])
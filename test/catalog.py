@@ -0,0 +1,74 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from dbackup.tools import catalog
+
+class TestCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dest = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def snapshot(self, name, previous = None, files = {}):
+        """ Creates a snapshot, linking the files of previous like rsync --link-dest """
+        path = os.path.join(self.dest, name)
+        if previous is not None:
+            shutil.copytree(os.path.join(self.dest, previous), path, copy_function=os.link)
+        else:
+            os.makedirs(path)
+        for relpath, content in files.items():
+            filePath = os.path.join(path, relpath)
+            if os.path.exists(filePath):
+                os.remove(filePath)
+            if content is not None:
+                os.makedirs(os.path.dirname(filePath), exist_ok=True)
+                with open(filePath, 'w') as f:
+                    f.write(content)
+
+    def find(self, pattern):
+        return { (v['path'], tuple(v['snapshots'])) for v in catalog.find(self.dest, pattern) }
+
+    def test_incremental(self):
+        self.snapshot('2020-10-01', files={ 'photos/2005/IMG_1234.jpg': 'a', 'doc.txt': 'v1' })
+        self.snapshot('2020-10-02', '2020-10-01', files={ 'doc.txt': 'v2' })
+        stats = catalog.build(self.dest)
+        self.assertEqual([ s['added'] for s in stats ], [2, 1])
+
+        # Only the changed inodes are added
+        self.snapshot('2020-10-03', '2020-10-02', files={ 'photos/2005/IMG_1234.jpg': None, 'new.txt': 'x' })
+        stats = catalog.build(self.dest)
+        self.assertEqual(len(stats), 1)
+        self.assertEqual((stats[0]['added'], stats[0]['closed']), (1, 1))
+
+        self.assertEqual(self.find('IMG_1234'), { ('photos/2005/IMG_1234.jpg', ('2020-10-01', '2020-10-02')) })
+        self.assertEqual(self.find('*.txt'), {
+            ('doc.txt', ('2020-10-01',)),
+            ('doc.txt', ('2020-10-02', '2020-10-03')),
+            ('new.txt', ('2020-10-03',)) })
+
+    def test_prune(self):
+        self.snapshot('2020-10-01', files={ 'old.txt': 'a', 'kept.txt': 'b' })
+        self.snapshot('2020-10-02', '2020-10-01', files={ 'old.txt': None })
+        catalog.build(self.dest)
+
+        shutil.rmtree(os.path.join(self.dest, '2020-10-01'))
+        self.assertEqual(self.find('old.txt'), set())
+        self.assertEqual(self.find('kept.txt'), { ('kept.txt', ('2020-10-02',)) })
+
+        db = catalog.connect(self.dest)
+        self.assertEqual(db.execute('SELECT count(*) FROM versions').fetchone()[0], 1)
+        self.assertEqual(db.execute('SELECT count(*) FROM paths').fetchone()[0], 1)
+        db.close()
+
+    def test_olderSnapshotRebuilds(self):
+        self.snapshot('2020-10-02', files={ 'a.txt': 'a' })
+        catalog.build(self.dest)
+        self.snapshot('2020-10-01', files={ 'a.txt': 'old' })
+        stats = catalog.build(self.dest)
+        self.assertEqual([ s['snapshot'] for s in stats ], ['2020-10-01', '2020-10-02'])
+        self.assertEqual(len(self.find('a.txt')), 2)
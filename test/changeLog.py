@@ -0,0 +1,63 @@
+import unittest
+import os
+import tempfile
+
+from dbackup.helpers.changeLog import ChangeLog
+
+class TestChangeLog(unittest.TestCase):
+
+    previousOutput = [
+        'sending incremental file list\n',
+        'cd+++++++++ 0 photos/\n',
+        '>f+++++++++ 1,024 photos/a.jpg\n',
+        '>f+++++++++ 2,048 photos/b.jpg\n',
+        '>f+++++++++ 10 notes.txt\n',
+    ]
+
+    output = [
+        'sending incremental file list\n',
+        '.d          0 photos/\n',
+        '.f          1,024 photos/a.jpg\n',
+        '>f.st...... 3,000 notes.txt\n',
+        '>f+++++++++ 1.50M photos/c.jpg\n',
+        '*deleting   0 stale.tmp\n',
+        'sent 1,234 bytes  received 56 bytes  2,580.00 bytes/sec\n',
+    ]
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def writeLog(self, name, lines, previousLog = None):
+        with ChangeLog(os.path.join(self.tmp.name, name)) as changeLog:
+            for line in lines:
+                changeLog.feed(line)
+            changeLog.finish(previousLog)
+        return changeLog
+
+    def test_parseSize(self):
+        self.assertEqual(ChangeLog.parseSize('1,234,567'), 1234567)
+        self.assertEqual(ChangeLog.parseSize('12'), 12)
+        self.assertEqual(ChangeLog.parseSize('1.50M'), 1500000)
+
+    def test_isItemized(self):
+        self.assertTrue(ChangeLog.isItemized('>f+++++++++ 10 notes.txt'))
+        self.assertTrue(ChangeLog.isItemized('*deleting   0 stale.tmp'))
+        self.assertFalse(ChangeLog.isItemized('sending incremental file list'))
+        self.assertFalse(ChangeLog.isItemized('created directory /tmp/dest'))
+
+    def test_changes(self):
+        previous = self.writeLog('previous.gz', self.previousOutput)
+        self.assertEqual(previous.counts[ChangeLog.added], 3)
+
+        current = self.writeLog('current.gz', self.output, previous.filePath)
+        entries = { path: (kind, size) for kind, size, path in ChangeLog.read(current.filePath) }
+
+        self.assertEqual(entries['photos/a.jpg'], (ChangeLog.unchanged, 1024))
+        self.assertEqual(entries['notes.txt'], (ChangeLog.modified, 3000))
+        self.assertEqual(entries['photos/c.jpg'], (ChangeLog.added, 1500000))
+        self.assertEqual(entries['photos/b.jpg'], (ChangeLog.deleted, 2048))
+        self.assertNotIn('photos/', entries)
+        self.assertNotIn('stale.tmp', entries)
@@ -0,0 +1,175 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import dbackup
+from dbackup.commands import Backup, Clean, Restore, Export, Diff, Verify, Dedupe, Catalog, Find
+from dbackup.helpers import ArgumentError
+from dbackup.tools import chunks
+
+class TestChunks(unittest.TestCase):
+
+    chunkSize = 4096
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dest = os.path.join(self.tmp.name, 'dest')
+        self.mirror = os.path.join(self.dest, chunks.mirrorName)
+        os.makedirs(self.mirror)
+        self.data = random.Random(1).randbytes(200 * 1024)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def writeFile(self, relpath, content):
+        path = os.path.join(self.mirror, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+
+    def commit(self, name, **kwargs):
+        os.makedirs(os.path.join(self.dest, name), exist_ok=True)
+        return chunks.commit(self.dest, name, name, self.chunkSize, **kwargs)
+
+    def storedChunks(self) -> int:
+        return sum(len(files) for path, dirs, files in os.walk(os.path.join(self.dest, chunks.storeName, 'store')))
+
+    def test_cutPoints(self):
+        cuts = list(chunks.cutPoints(self.data, self.chunkSize))
+        self.assertEqual(cuts[-1], len(self.data))
+        sizes = [ end - start for start, end in zip([0] + cuts, cuts) ]
+        self.assertTrue(all(size <= 4 * self.chunkSize for size in sizes))
+        self.assertTrue(all(size >= self.chunkSize // 4 for size in sizes[:-1]))
+
+        # Boundaries after an insertion are found again
+        shifted = list(chunks.cutPoints(b'inserted' + self.data, self.chunkSize))
+        self.assertTrue(set(cut + 8 for cut in cuts[2:]) <= set(shifted))
+
+    def test_commit(self):
+        self.writeFile('image', self.data)
+        self.writeFile('dir/small', b'small')
+        self.writeFile('dir/empty', b'')
+        os.symlink('small', os.path.join(self.mirror, 'dir', 'link'))
+        first = self.commit('2020-10-01')
+        self.assertEqual((first['files'], first['chunked'], first['unreadable']), (3, 3, 0))
+        self.assertEqual(first['written'], len(self.data) + 5)
+
+        # A change in place only stores the chunks around it
+        changed = bytearray(self.data)
+        changed[100000:100010] = b'x' * 10
+        self.writeFile('image', bytes(changed))
+        second = self.commit('2020-10-02')
+        self.assertEqual(second['chunked'], 1)
+        self.assertLess(second['written'], 4 * 4 * self.chunkSize)
+
+        chunks.extract(self.dest, '2020-10-01', 'restored')
+        with open(os.path.join(self.dest, 'restored', 'image'), 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertEqual(os.readlink(os.path.join(self.dest, 'restored', 'dir', 'link')), 'small')
+        chunks.extract(self.dest, '2020-10-02', 'restored', path='image')
+        with open(os.path.join(self.dest, 'restored', 'image'), 'rb') as f:
+            self.assertEqual(f.read(), bytes(changed))
+        self.assertFalse(os.path.exists(os.path.join(self.dest, 'restored', 'dir')))
+
+    def test_pool(self):
+        self.writeFile('image', self.data)
+        self.writeFile('small', b'small')
+        with mock.patch.object(chunks, 'segmentSize', 32 * 1024):
+            stats = self.commit('2020-10-01', workers=2)
+        self.assertEqual((stats['files'], stats['chunked'], stats['size']), (2, 2, len(self.data) + 5))
+        chunks.extract(self.dest, '2020-10-01', 'restored')
+        with open(os.path.join(self.dest, 'restored', 'image'), 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_gc(self):
+        self.writeFile('a', self.data[:50000])
+        self.commit('2020-10-01')
+        self.writeFile('a', self.data[50000:100000])
+        self.commit('2020-10-02')
+        self.writeFile('a', self.data[100000:150000])
+        self.commit('2020-10-03')
+        stored = self.storedChunks()
+
+        shutil.rmtree(os.path.join(self.dest, '2020-10-01'))
+        shutil.rmtree(os.path.join(self.dest, '2020-10-02'))
+        # Nothing is done without time, and the work is left for the next run
+        stats = chunks.gc(self.dest, maxSeconds=0)
+        self.assertEqual((stats['released'], stats['pending']), (0, 2))
+        self.assertEqual(self.storedChunks(), stored)
+
+        stats = chunks.gc(self.dest)
+        self.assertEqual((stats['released'], stats['pending'], stats['garbage']), (2, 0, 0))
+        self.assertEqual(self.storedChunks(), stored - stats['removed'])
+        self.assertEqual(self.storedChunks(), stats['chunks'])
+        chunks.extract(self.dest, '2020-10-03', 'restored')
+        with open(os.path.join(self.dest, 'restored', 'a'), 'rb') as f:
+            self.assertEqual(f.read(), self.data[100000:150000])
+
+    def test_replace(self):
+        self.writeFile('a', self.data[:50000])
+        self.commit('2020-10-01')
+        self.writeFile('a', self.data[50000:100000])
+        stats = self.commit('2020-10-01')
+        self.assertEqual(self.storedChunks(), stats['chunks'])
+
+    def test_backup(self):
+        source = os.path.join(self.tmp.name, 'source')
+        os.makedirs(source)
+        with open(os.path.join(source, 'image'), 'wb') as f:
+            f.write(self.data)
+        job = dbackup.Job('test', { 'source': source, 'dest': self.dest, 'storage': 'chunks', 'chunk size': '4K',
+            'manifest': 'yes', 'changelog': 'no' })
+        self.assertFalse(job.manifest)
+        commands = []
+        def fakeRSync(rsync, *args, **kwargs):
+            commands.append(rsync)
+            shutil.copytree(source, rsync[-1], dirs_exist_ok=True)
+            return True
+
+        backup = Backup(mock.Mock())
+        backup.today = '2020-10-01'
+        with mock.patch.object(Backup, 'invokeRSync', side_effect=fakeRSync):
+            self.assertEqual(backup.execute(job), dbackup.resultcodes.SUCCESS)
+        self.assertEqual(commands[0][-1], os.path.join(self.dest, chunks.mirrorName))
+        self.assertIn('--inplace', commands[0])
+        self.assertFalse(any(arg.startswith('--partial-dir') for arg in commands[0]))
+        self.assertTrue(os.path.isfile(os.path.join(self.dest, '2020-10-01', chunks.metaDir, chunks.manifestName)))
+
+        # Clean collects the chunks of the removed snapshots
+        os.makedirs(os.path.join(self.dest, '2020-10-02'))
+        job.daysToKeep = 1
+        job.monthsToKeep = 0
+        Clean(simulate=False).execute([job])
+        self.assertEqual(self.storedChunks(), 0)
+
+    def test_restore(self):
+        self.writeFile('dir/file', b'content')
+        self.commit('2020-10-01')
+        target = os.path.join(self.tmp.name, 'target')
+        job = dbackup.Job('test', { 'source': '/srv/source', 'dest': self.dest, 'storage': 'chunks' })
+        with mock.patch.object(Backup, 'runRSync', return_value=0) as runRSync:
+            self.assertEqual(Restore().execute(job, '2020-10-01', 'dir', target), dbackup.resultcodes.SUCCESS)
+        rsync = runRSync.call_args[0][0]
+        self.assertEqual(rsync[-2], os.path.join(self.dest, chunks.storeName, 'restore', '2020-10-01', 'dir', ''))
+        self.assertFalse(os.path.exists(os.path.join(self.dest, chunks.storeName, 'restore')))
+
+    def test_snapshotCommands(self):
+        self.writeFile('file', b'content')
+        self.commit('2020-10-01')
+        job = dbackup.Job('test', { 'source': '/srv/source', 'dest': self.dest, 'storage': 'chunks' })
+        # The snapshot directories only hold the chunk index
+        with self.assertRaises(ArgumentError):
+            Export(simulate=True).execute(job, '2020-10-01')
+        with self.assertRaises(ArgumentError):
+            Diff().execute(job)
+        with self.assertRaises(ArgumentError):
+            Verify().execute([job])
+        with self.assertRaises(ArgumentError):
+            Dedupe(simulate=True).execute([job])
+        with self.assertRaises(ArgumentError):
+            Catalog(simulate=True).execute([job])
+        with self.assertRaises(ArgumentError):
+            Find().execute(job, '*.jpg')
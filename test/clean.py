@@ -0,0 +1,155 @@
+import unittest
+import os
+import tempfile
+import threading
+import time
+
+import dbackup
+import dbackup.resultcodes
+from dbackup.commands.clean import Clean, CleanPipeline
+
+class FakeDest:
+    def __init__(self, filesystemKey):
+        self.filesystemKey = filesystemKey
+
+class FakeJob:
+    def __init__(self, name, filesystemKey):
+        self.name = name
+        self.dest = FakeDest(filesystemKey)
+
+    def __str__(self):
+        return self.name
+
+class FakeClean:
+    """ Records how many cleans run at the same time on each filesystem """
+
+    def __init__(self, failing = ()):
+        self.failing = failing
+        self.running = {}
+        self.maxRunning = {}
+        self.lock = threading.Lock()
+
+    def execute(self, jobs):
+        key = jobs[0].dest.filesystemKey
+        with self.lock:
+            self.running[key] = self.running.get(key, 0) + 1
+            self.maxRunning[key] = max(self.maxRunning.get(key, 0), self.running[key])
+        time.sleep(0.05)
+        with self.lock:
+            self.running[key] -= 1
+        if jobs[0].name in self.failing:
+            return dbackup.resultcodes.CLEAN_FAILED
+        return dbackup.resultcodes.SUCCESS
+
+class TestCleanPipeline(unittest.TestCase):
+
+    def test_limitPerFilesystem(self):
+        cleaner = FakeClean()
+        pipeline = CleanPipeline(cleaner, maxPerFilesystem=1, workers=4)
+        for n in range(3):
+            pipeline.submit(FakeJob(f'a{n}', 'diskA'))
+            pipeline.submit(FakeJob(f'b{n}', 'diskB'))
+
+        self.assertEqual(pipeline.wait(), dbackup.resultcodes.SUCCESS)
+        self.assertEqual(cleaner.maxRunning, { 'diskA': 1, 'diskB': 1 })
+
+    def test_combinedResult(self):
+        cleaner = FakeClean(failing=['b'])
+        pipeline = CleanPipeline(cleaner, maxPerFilesystem=2)
+        pipeline.submit(FakeJob('a', 'diskA'))
+        pipeline.submit(FakeJob('b', 'diskA'))
+        self.assertEqual(pipeline.wait(), dbackup.resultcodes.CLEAN_FAILED)
+
+class BatchLocation:
+    """ A destination that records the calls to its host """
+
+    listings = {}
+    calls = []
+    failing = ()
+
+    def __init__(self, path, hostKey):
+        self.path = path
+        self.hostKey = hostKey
+        self.simulate = False
+
+    @classmethod
+    def listDirs(cls, locations):
+        cls.calls.append(('list', [ location.path for location in locations ]))
+        return [ cls.listings.get(location.path) for location in locations ]
+
+    @classmethod
+    def deleteChildren(cls, requests):
+        cls.calls.append(('delete', [ (location.path, names) for location, names in requests ]))
+        return [ location.path not in cls.failing for location, names in requests ]
+
+class BatchJob:
+    def __init__(self, name, path, hostKey = 'user@host:22'):
+        self.name = name
+        self.dest = BatchLocation(path, hostKey)
+        self.daysToKeep = 2
+        self.monthsToKeep = 1
+        self.hoursToKeep = 0
+        self.catalog = False
+        self.priority = None
+        self.storage = 'snapshots'
+
+    def destJobs(self):
+        return [ self ]
+
+    def __str__(self):
+        return self.name
+
+class TestCleanHost(unittest.TestCase):
+
+    def setUp(self):
+        BatchLocation.calls = []
+        BatchLocation.failing = ()
+        BatchLocation.listings = {
+            '/backup/a': ['2020-09-01', '2020-09-30', '2020-10-01', '2020-10-02', '2020-10-03.incomplete'],
+            '/backup/b': ['2020-10-01', '2020-10-02', 'lost+found'],
+            '/backup/c': None,
+        }
+
+    def test_selectBackupsToRemove(self):
+        job = BatchJob('a', '/backup/a')
+        toRemove = Clean(simulate=False).selectBackupsToRemove(job, BatchLocation.listings['/backup/a'],
+            keep=['2020-10-03.incomplete'])
+        self.assertEqual(toRemove, { '2020-09-30', '2020-09-01' })
+
+    def test_hourlyRetention(self):
+        job = BatchJob('a', '/backup/a')
+        job.hoursToKeep = 3
+        backups = ['2020-09-01', '2020-09-30', '2020-10-01T0800', '2020-10-01T1000', '2020-10-01T1015',
+            '2020-10-02T0900', '2020-10-02T1100', '2020-10-02T1130', '2020-10-02T1200.incomplete']
+        toRemove = Clean(simulate=False).selectBackupsToRemove(job, backups)
+        # Hours 2020-10-02T11, T09 and 2020-10-01T10, days 2020-10-02 and 2020-10-01,
+        # and the first backup on the first of October
+        self.assertEqual(toRemove, { '2020-09-01', '2020-09-30', '2020-10-01T1000', '2020-10-02T1100',
+            '2020-10-02T1200.incomplete' })
+
+    def test_oneCallPerHost(self):
+        jobs = [ BatchJob('a', '/backup/a'), BatchJob('b', '/backup/b'), BatchJob('c', '/backup/c') ]
+        self.assertEqual(Clean(simulate=False).execute(jobs), dbackup.resultcodes.SUCCESS)
+        self.assertEqual(BatchLocation.calls, [
+            ('list', ['/backup/a', '/backup/b', '/backup/c']),
+            ('delete', [('/backup/a', ['2020-09-01', '2020-09-30', '2020-10-03.incomplete'])]),
+        ])
+
+    def test_perJobFailure(self):
+        BatchLocation.listings['/backup/b'] = ['2020-09-01', '2020-10-01', '2020-10-02']
+        BatchLocation.failing = ('/backup/b',)
+        jobs = [ BatchJob('a', '/backup/a'), BatchJob('b', '/backup/b', 'other@host:22') ]
+        self.assertEqual(Clean(simulate=False).execute(jobs), dbackup.resultcodes.CLEAN_FAILED)
+        self.assertEqual([ call[0] for call in BatchLocation.calls ], ['list', 'delete', 'list', 'delete'])
+
+    def test_extraDests(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            dests = [ os.path.join(tmp, 'site1'), os.path.join(tmp, 'site2') ]
+            for dest in dests:
+                for snapshot in ['2020-09-29', '2020-09-30', '2020-10-02']:
+                    os.makedirs(os.path.join(dest, snapshot))
+            job = dbackup.Job('test', { 'source': '/srv/source', 'dest': '\n'.join(dests), 'days': 1, 'months': 0 })
+            self.assertEqual(Clean(simulate=False).execute([job]), dbackup.resultcodes.SUCCESS)
+            for dest in dests:
+                self.assertEqual(os.listdir(dest), ['2020-10-02'])
+
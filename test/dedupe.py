@@ -0,0 +1,88 @@
+import unittest
+import os
+import tempfile
+from unittest import mock
+
+import dbackup
+from dbackup.commands import Dedupe
+from dbackup.location import LocalLocation
+from dbackup.tools import dedupe
+
+class TestDedupe(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.index = os.path.join(self.tmp.name, '.dbackup', 'dedupe.gz')
+        self.content = os.urandom(2 * dedupe.defaultMinSize)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def writeFile(self, job, snapshot, name, content):
+        path = os.path.join(self.tmp.name, job, snapshot, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+        os.utime(path, ns=(1600000000000000000, 1600000000000000000))
+        return path
+
+    def snapshots(self):
+        return [ os.path.join(self.tmp.name, job, snapshot)
+            for job in sorted(os.listdir(self.tmp.name)) if job != '.dbackup'
+            for snapshot in sorted(os.listdir(os.path.join(self.tmp.name, job))) ]
+
+    def test_linksDuplicates(self):
+        a = self.writeFile('david', '2020-10-01', 'photo.jpg', self.content)
+        b = self.writeFile('theo', '2020-10-01', 'photo.jpg', self.content)
+        c = self.writeFile('theo', '2020-10-01', 'other.jpg', os.urandom(len(self.content)))
+        small = self.writeFile('KoD', '2020-10-01', 'small.txt', b'small')
+        self.writeFile('theo', '2020-10-01', 'small.txt', b'small')
+
+        stats = dedupe.dedupe(self.snapshots(), self.index)
+        self.assertEqual(stats['inodes'], 1)
+        self.assertEqual(stats['saved'], len(self.content))
+        self.assertEqual(os.stat(a).st_ino, os.stat(b).st_ino)
+        self.assertNotEqual(os.stat(a).st_ino, os.stat(c).st_ino)
+        self.assertEqual(os.stat(small).st_nlink, 1)
+
+        # Nothing new to scan the next time
+        stats = dedupe.dedupe(self.snapshots(), self.index)
+        self.assertEqual(stats['snapshots'], 0)
+
+        # A new snapshot is linked to the indexed inode
+        d = self.writeFile('KoD', '2020-10-02', 'photo.jpg', self.content)
+        stats = dedupe.dedupe(self.snapshots(), self.index)
+        self.assertEqual(stats['snapshots'], 1)
+        self.assertEqual(stats['newInodes'], 1)
+        self.assertEqual(os.stat(a).st_ino, os.stat(d).st_ino)
+
+    def test_dryRun(self):
+        a = self.writeFile('david', '2020-10-01', 'photo.jpg', self.content)
+        b = self.writeFile('theo', '2020-10-01', 'photo.jpg', self.content)
+
+        stats = dedupe.dedupe(self.snapshots(), self.index, dryRun=True)
+        self.assertEqual(stats['linked'], 1)
+        self.assertNotEqual(os.stat(a).st_ino, os.stat(b).st_ino)
+        self.assertFalse(os.path.exists(self.index))
+
+    def test_differentMetadataIsKept(self):
+        a = self.writeFile('david', '2020-10-01', 'photo.jpg', self.content)
+        b = self.writeFile('theo', '2020-10-01', 'photo.jpg', self.content)
+        os.chmod(b, 0o600)
+
+        dedupe.dedupe(self.snapshots(), self.index)
+        self.assertNotEqual(os.stat(a).st_ino, os.stat(b).st_ino)
+
+    def test_indexPerFilesystem(self):
+        self.writeFile('disk1/a', '2020-10-01', 'photo.jpg', self.content)
+        self.writeFile('disk2/b', '2020-10-01', 'photo.jpg', self.content)
+        jobs = [ dbackup.Job(name, { 'source': '/srv/source', 'dest': os.path.join(self.tmp.name, name) })
+            for name in ('disk1/a', 'disk2/b') ]
+        stats = { 'snapshots': 1, 'newInodes': 1, 'hashed': 0, 'linked': 0, 'inodes': 0, 'saved': 0, 'skipped': [] }
+        # Each of the local destinations is on its own disk
+        filesystemKey = property(lambda location: os.path.dirname(location.path))
+        with mock.patch.object(LocalLocation, 'filesystemKey', filesystemKey), \
+                mock.patch.object(LocalLocation, 'runTool', return_value=[ stats ]) as runTool:
+            self.assertEqual(Dedupe().execute(jobs), dbackup.resultcodes.SUCCESS)
+        indexes = [ call[0][1][1] for call in runTool.call_args_list ]
+        self.assertEqual(indexes, [ os.path.join(job.dest.path, '.dbackup', 'dedupe.gz') for job in jobs ])
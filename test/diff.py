@@ -0,0 +1,73 @@
+import unittest
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+
+import dbackup
+from dbackup.commands import Diff
+from dbackup.tools import diff
+
+class TestDiff(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def path(self, relpath):
+        return os.path.join(self.tmp.name, relpath)
+
+    def writeFile(self, relpath, content):
+        os.makedirs(os.path.dirname(self.path(relpath)), exist_ok=True)
+        with open(self.path(relpath), 'wb') as f:
+            f.write(content)
+
+    def makeSnapshots(self):
+        """ a is linked, b is modified, c is copied without a link, old/ is removed and new/ is added """
+        self.writeFile('2020-10-01/dir/a', b'aaa')
+        self.writeFile('2020-10-01/dir/b', b'old')
+        self.writeFile('2020-10-01/c', b'cccc')
+        self.writeFile('2020-10-01/old/x', b'x')
+        self.writeFile('2020-10-01/.dbackup/changes', b'')
+        self.writeFile('2020-10-02/dir/b', b'new!')
+        self.writeFile('2020-10-02/new/y/z', b'zz')
+        os.link(self.path('2020-10-01/dir/a'), self.path('2020-10-02/dir/a'))
+        shutil.copy2(self.path('2020-10-01/c'), self.path('2020-10-02/c'))
+
+    def runDiff(self):
+        changes = diff.diff(self.path('2020-10-01'), self.path('2020-10-02'), workers=2)
+        found = []
+        while True:
+            try:
+                kind, size, relpath = next(changes)
+            except StopIteration as e:
+                return sorted(found), e.value
+            found.append((kind, size, os.fsdecode(relpath)))
+
+    def test_diff(self):
+        self.makeSnapshots()
+        changes, totals = self.runDiff()
+        self.assertEqual(changes, [('added', 2, 'new/y/z'), ('modified', 4, 'c'), ('modified', 4, 'dir/b'),
+            ('removed', 1, 'old/x')])
+        self.assertEqual(totals['unchanged'], [1, 3])
+        self.assertEqual(totals['unlinked'], [1, 4])
+        self.assertAlmostEqual(diff.efficiency(totals), 3 / 11)
+
+    def test_efficiency(self):
+        self.assertIsNone(diff.efficiency({ 'unchanged': [0, 0], 'modified': [0, 0] }))
+        self.assertEqual(diff.efficiency({ 'unchanged': [2, 0], 'modified': [0, 0] }), 1.0)
+
+    def test_execute(self):
+        self.makeSnapshots()
+        job = dbackup.Job('test', { 'source': '/home/gud', 'dest': self.tmp.name })
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            self.assertEqual(Diff().execute(job, '2020-10-01', 'latest'), dbackup.resultcodes.SUCCESS)
+            self.assertEqual(Diff().execute(job), dbackup.resultcodes.SUCCESS)
+        lines = out.getvalue().splitlines()
+        self.assertEqual([line.split()[-1] for line in lines[:4]], ['c', 'dir/b', 'new/y/z', 'old/x'])
+        self.assertIn('Hardlink efficiency: 27.3%', lines)
+        self.assertTrue(lines[-1].startswith('2020-10-02:  27.3% linked, 2 modified (1 unlinked)'))
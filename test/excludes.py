@@ -0,0 +1,89 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import dbackup
+from dbackup.commands import Backup
+from dbackup.helpers import Excludes
+from dbackup.tools import excludes
+
+class TestExcludes(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def writeFile(self, relpath, content):
+        path = os.path.join(self.root, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+
+    def makeSource(self):
+        self.writeFile('docs/report.txt', b'report')
+        self.writeFile('docs/big.iso', b'x' * 1000)
+        self.writeFile('thumbs/CACHEDIR.TAG', excludes.cacheDirSignature + b'\n# thumbnails\n')
+        self.writeFile('thumbs/a.png', b'aaaa')
+        self.writeFile('fake/CACHEDIR.TAG', b'not a signature')
+        self.writeFile('fake/keep', b'keep')
+        self.writeFile('src/app/node_modules/lib/index.js', b'12345')
+        self.writeFile('src/app/__pycache__/m.pyc', b'pyc')
+        self.writeFile('src/app/m.pyc', b'pyc!')
+
+    def test_matches(self):
+        self.assertTrue(excludes.matches('node_modules/', 'a/b/node_modules', True))
+        self.assertFalse(excludes.matches('node_modules/', 'a/b/node_modules', False))
+        self.assertTrue(excludes.matches('*.pyc', 'a/m.pyc', False))
+        self.assertTrue(excludes.matches('.mozilla/firefox/*/cache2/', 'home/.mozilla/firefox/x.default/cache2', True))
+        self.assertFalse(excludes.matches('.mozilla/firefox/*/cache2/', 'home/.mozilla/firefox/x/y/cache2', True))
+        self.assertTrue(excludes.matches('/build/', 'build', True))
+        self.assertFalse(excludes.matches('/build/', 'src/build', True))
+
+    def test_scan(self):
+        self.makeSource()
+        cacheDirs, saved = excludes.scan(self.root, caches=True,
+            rules=Excludes.presets['node'] + Excludes.presets['python'], maxSize=100)
+        self.assertEqual(cacheDirs, ['thumbs'])
+        self.assertEqual(saved, {
+            'CACHEDIR.TAG': [2, len(excludes.cacheDirSignature) + 14 + 4],
+            'node_modules/': [1, 5],
+            '__pycache__/': [1, 3],
+            '*.pyc': [1, 4],
+            'max file size': [1, 1000],
+        })
+
+    def test_jobOptions(self):
+        job = dbackup.Job('test', { 'source': '/srv/source', 'dest': '/srv/dest', 'exclude caches': 'yes',
+            'exclude presets': 'node, python', 'max file size': '2G' })
+        self.assertEqual(job.excludes.maxSize, 2 * 1024**3)
+        self.assertIn('--rule=node_modules/', job.excludes.toolArgs())
+        self.assertFalse(job.copyJob('2020-10-01', job.dest, 'copy').excludes)
+        with self.assertRaises(AssertionError):
+            dbackup.Job('test', { 'source': '/srv/source', 'dest': '/srv/dest', 'exclude presets': 'videos' })
+
+        rsync = Backup(None).buildRSync(job, [], '2020-10-01.incomplete', ['thumbs', 'odd[1]'])
+        # The tagged directories are read from stdin
+        self.assertIn('--exclude-from=-', rsync)
+        self.assertEqual(job.excludes.excludeList(['thumbs', 'odd[1]']), b'/thumbs/\n/odd\\[1]/\n')
+        self.assertIsNone(job.excludes.excludeList([]))
+        self.assertNotIn('--exclude-from=-', Backup(None).buildRSync(job, [], '2020-10-01.incomplete'))
+        self.assertIn('--exclude=node_modules/', rsync)
+        self.assertIn(f'--max-size={2 * 1024**3}', rsync)
+
+    def test_scanExcludes(self):
+        self.makeSource()
+        job = dbackup.Job('test', { 'source': self.root, 'dest': '/srv/dest', 'exclude caches': 'yes',
+            'exclude presets': 'node' })
+        backup = Backup(None)
+        cacheDirs, saved = backup.scanExcludes(job)
+        self.assertEqual(cacheDirs, ['thumbs'])
+        self.assertEqual(saved['node_modules/'], [1, 5])
+
+        stats = mock.Mock(totalSize=1000)
+        with self.assertLogs(level='INFO') as logs:
+            backup.reportExcludes(job, saved, stats)
+        self.assertIn('by node_modules/: 1 files, 5 bytes', logs.output[1])
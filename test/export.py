@@ -0,0 +1,78 @@
+import unittest
+import io
+import os
+import tarfile
+import tempfile
+
+import dbackup
+from dbackup.commands import Export
+from dbackup.helpers import ArgumentError
+from dbackup.tools import export
+
+class TestExport(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def writeFile(self, relpath, content):
+        path = os.path.join(self.tmp.name, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+
+    def makeSnapshots(self):
+        """ Two snapshots where a is unchanged, b is modified, c is deleted and d is added """
+        self.writeFile('2020-10-01/dir/a', b'aaa')
+        self.writeFile('2020-10-01/dir/b', b'old')
+        self.writeFile('2020-10-01/c', b'ccc')
+        self.writeFile('2020-10-01/.dbackup/changes', b'')
+        self.writeFile('2020-10-02/dir/b', b'new!')
+        self.writeFile('2020-10-02/d', b'd')
+        os.link(os.path.join(self.tmp.name, '2020-10-01/dir/a'), os.path.join(self.tmp.name, '2020-10-02/dir/a'))
+        os.symlink('dir/a', os.path.join(self.tmp.name, '2020-10-02/link'))
+
+    def readArchive(self, data) -> dict:
+        with tarfile.open(fileobj=io.BytesIO(data), mode='r|') as tar:
+            return { member.name : tar.extractfile(member).read() if member.isfile() else member.type
+                for member in tar }
+
+    def test_full(self):
+        self.makeSnapshots()
+        out = io.BytesIO()
+        stats = export.export(os.path.join(self.tmp.name, '2020-10-02'), out)
+        members = self.readArchive(out.getvalue())
+        self.assertEqual(members, { 'dir': tarfile.DIRTYPE, 'dir/a': b'aaa', 'dir/b': b'new!', 'd': b'd', 'link': tarfile.SYMTYPE })
+        self.assertEqual((stats['files'], stats['dirs'], stats['bytes'], stats['unchanged']), (4, 1, 8, 0))
+
+    def test_delta(self):
+        self.makeSnapshots()
+        out = io.BytesIO()
+        stats = export.export(os.path.join(self.tmp.name, '2020-10-02'), out, os.path.join(self.tmp.name, '2020-10-01'))
+        members = self.readArchive(out.getvalue())
+        # The metadata directory is not reported as deleted
+        self.assertEqual(members, { 'dir': tarfile.DIRTYPE, 'dir/b': b'new!', 'd': b'd', 'link': tarfile.SYMTYPE,
+            '.dbackup-export/deleted': b'c\0' })
+        self.assertEqual((stats['unchanged'], stats['deleted']), (1, 1))
+
+    def test_streamTool(self):
+        self.makeSnapshots()
+        dest = dbackup.location.Factory(self.tmp.name)
+        with tempfile.TemporaryFile() as outFile:
+            stderr = dest.streamTool('export', [os.path.join(self.tmp.name, '2020-10-02')], outFile, pipe='cat')
+            outFile.seek(0)
+            members = self.readArchive(outFile.read())
+        self.assertIn(b'dbackup-export {', stderr)
+        self.assertEqual(members['dir/b'], b'new!')
+
+    def test_resolve(self):
+        self.makeSnapshots()
+        job = dbackup.Job('test', { 'source': '/home/gud', 'dest': self.tmp.name })
+        self.assertEqual(Export(since='previous').resolve(job, 'latest'), ('2020-10-02', '2020-10-01'))
+        self.assertEqual(Export().resolve(job, '2020-10-01'), ('2020-10-01', None))
+        with self.assertRaises(ArgumentError):
+            Export(since='previous').resolve(job, '2020-10-01')
+        with self.assertRaises(ArgumentError):
+            Export(since='2020-10-02').resolve(job, '2020-10-02')
@@ -0,0 +1,69 @@
+""" A stand-in for ssh that runs the command locally
+
+Understands the ssh options that dbackup uses, ignores them and runs the
+remote command with sh on this host. Used by tests by putting an 'ssh'
+wrapper on PATH, see FakeSsh.
+
+Environment:
+    FAKESSH_LATENCY : Seconds to sleep before each command, like a connection setup
+    FAKESSH_LOG : File that each command is appended to
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+# ssh options that take an argument
+argumentOptions = 'BbcDEeFIiJLlmOopQRSWw'
+
+def main(argv):
+    n = 0
+    while n < len(argv) and argv[n].startswith('-'):
+        option = argv[n]
+        n += 1
+        if option[-1] in argumentOptions and len(option) == 2:
+            n += 1
+    host, command = argv[n], ' '.join(argv[n + 1:])
+
+    time.sleep(float(os.environ.get('FAKESSH_LATENCY', '0')))
+    if os.environ.get('FAKESSH_LOG'):
+        with open(os.environ['FAKESSH_LOG'], 'a') as f:
+            f.write(f'{host} {command}\n')
+    return subprocess.call(['sh', '-c', command])
+
+class FakeSsh:
+    """ Puts the stand-in first on PATH while the context is active """
+
+    def __init__(self, latency = 0):
+        self.latency = latency
+
+    def __enter__(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        wrapper = os.path.join(self._tmp.name, 'ssh')
+        with open(wrapper, 'w') as f:
+            f.write(f'#!/bin/sh\nexec {sys.executable} {os.path.abspath(__file__)} "$@"\n')
+        os.chmod(wrapper, 0o755)
+        self.log = os.path.join(self._tmp.name, 'log')
+        self._environ = dict(os.environ)
+        os.environ['PATH'] = self._tmp.name + os.pathsep + os.environ.get('PATH', '')
+        os.environ['FAKESSH_LATENCY'] = str(self.latency)
+        os.environ['FAKESSH_LOG'] = self.log
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        os.environ.clear()
+        os.environ.update(self._environ)
+        self._tmp.cleanup()
+
+    @property
+    def commands(self) -> list:
+        """ The commands that have been run """
+        if not os.path.exists(self.log):
+            return []
+        with open(self.log) as f:
+            return f.read().splitlines()
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
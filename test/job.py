@@ -78,4 +78,23 @@ class TestJob(unittest.TestCase):
         # Test to use sshport argument
         altSpec['sshport'] = 222
         jobd = dbackup.Job('testJob', altSpec)
-        self.assertEqual(jobd.sshArgs.port, 222)
\ No newline at end of file
+        self.assertEqual(jobd.sshArgs.port, 222)
+    def test_extraDests(self):
+        spec = dict(self.jobSpec, dest='/tmp/dest\n backup@site2:/srv/mirror')
+        job = dbackup.Job('test', spec)
+        self.assertEqual(job.dest.path, '/tmp/dest')
+        self.assertEqual([str(dest) for dest in job.extraDests], ['SshLocation:backup@site2:/srv/mirror'])
+        self.assertEqual([str(j) for j in job.destJobs()], ['test', 'test.dest2'])
+
+        # The snapshot in the first destination is the source of the copy
+        replica = job.replicas('2020-10-01')[0]
+        self.assertEqual(replica.source.path, '/tmp/dest/2020-10-01')
+        self.assertIs(replica.dest, job.extraDests[0])
+        self.assertIsNone(replica.relay)
+        self.assertIsNone(replica.execAfter)
+        self.assertEqual(job.source.path, '/tmp/source')
+
+        # A comma doesn't separate destinations
+        job = dbackup.Job('test', dict(self.jobSpec, dest='/tmp/dest/a,b'))
+        self.assertEqual(job.dest.path, '/tmp/dest/a,b')
+        self.assertEqual(job.extraDests, [])
@@ -0,0 +1,102 @@
+import multiprocessing
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from dbackup.helpers import Leases
+
+jobNames = [ f'job{n}' for n in range(20) ]
+
+def runController(path, queue):
+    """ A controller that runs every job it gets the lease of """
+    with Leases(path, '2020-10-01', ttl=5) as leases:
+        for job in jobNames:
+            if leases.acquire(job):
+                queue.put((job, leases.owner))
+                time.sleep(0.01)
+                leases.release(job, 0)
+
+class TestLeases(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_acquire(self):
+        a = Leases(self.tmp.name, '2020-10-01', owner='a')
+        b = Leases(self.tmp.name, '2020-10-01', owner='b')
+        self.assertTrue(a.acquire('job'))
+        self.assertFalse(b.acquire('job'))
+        a.release('job', 0)
+        # Done in this cycle
+        self.assertFalse(b.acquire('job'))
+        self.assertEqual(a.read('job')['state'], 'done')
+
+        nextCycle = Leases(self.tmp.name, '2020-10-02', owner='b')
+        self.assertTrue(nextCycle.acquire('job'))
+        nextCycle.release('job', 0)
+        self.assertTrue(nextCycle.acquire('job', '2020-10-02T10'))
+
+    def test_stale(self):
+        a = Leases(self.tmp.name, '2020-10-01', ttl=0.1, owner='a')
+        b = Leases(self.tmp.name, '2020-10-01', owner='b')
+        self.assertTrue(a.acquire('job'))
+        # a died without renewing
+        time.sleep(0.2)
+        with self.assertLogs(level='WARNING'):
+            self.assertTrue(b.acquire('job'))
+
+        # a can't mark the job done when it comes back
+        with self.assertLogs(level='ERROR'):
+            a.release('job', 0)
+        self.assertEqual(a.read('job')['owner'], 'b')
+        self.assertEqual(a.read('job')['state'], 'running')
+
+    def test_renew(self):
+        b = Leases(self.tmp.name, '2020-10-01', owner='b')
+        with Leases(self.tmp.name, '2020-10-01', ttl=0.3, owner='a') as a:
+            self.assertTrue(a.acquire('job'))
+            time.sleep(0.6)
+            self.assertFalse(b.acquire('job'))
+            a.release('job', 0)
+
+    def test_renewRelease(self):
+        leases = Leases(self.tmp.name, '2020-10-01', owner='a')
+        self.assertTrue(leases.acquire('job'))
+        renewRead = threading.Event()
+        released = threading.Event()
+        read = leases.read
+        def slowRead(job):
+            # The renew thread waits for the release between reading and writing the lease
+            lease = read(job)
+            if threading.current_thread() is renewer:
+                renewRead.set()
+                released.wait(0.5)
+            return lease
+
+        renewer = threading.Thread(target=leases.renew)
+        with mock.patch.object(leases, 'read', side_effect=slowRead):
+            renewer.start()
+            renewRead.wait(5)
+            leases.release('job', 0)
+            released.set()
+            renewer.join()
+        self.assertEqual(leases.read('job')['state'], 'done')
+
+    def test_processes(self):
+        context = multiprocessing.get_context('fork')
+        queue = context.Queue()
+        controllers = [ context.Process(target=runController, args=(self.tmp.name, queue)) for n in range(4) ]
+        for controller in controllers:
+            controller.start()
+        runs = [ queue.get(timeout=30) for job in jobNames ]
+        for controller in controllers:
+            controller.join()
+        self.assertTrue(queue.empty())
+
+        # Each job ran exactly once
+        self.assertEqual(sorted(job for job, owner in runs), sorted(jobNames))
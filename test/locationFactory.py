@@ -27,4 +27,12 @@ class TestLocationFactory(unittest.TestCase):
         sshArgs = SshArgs(self.jobSpec)
         loc = Factory(self.jobSpec['dest'], sshArgs)
 
-        self.assertIsInstance(loc, dbackup.location.LocalLocation)
\ No newline at end of file
+        self.assertIsInstance(loc, dbackup.location.LocalLocation)
+
+    def test_FactoryDaemon(self):
+        sshArgs = SshArgs(self.jobSpec)
+        loc = Factory('rsync://gud@nas:8730/backup/gud', sshArgs, passwordFile='/etc/dbackup/rsync.secret')
+
+        self.assertIsInstance(loc, dbackup.location.RsyncDaemonLocation)
+        self.assertEqual(loc.rsyncPath('2020-10-01'), 'rsync://gud@nas:8730/backup/gud/2020-10-01')
+        self.assertIn('--password-file=/etc/dbackup/rsync.secret', loc.transferOpts())
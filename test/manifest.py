@@ -0,0 +1,65 @@
+import unittest
+import os
+import tempfile
+
+from dbackup.tools import manifest, hashing
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dest = self.tmp.name
+
+        # Two snapshots where the second hard links the files of the first
+        first = os.path.join(self.dest, '2020-10-01')
+        os.makedirs(os.path.join(first, 'photos'))
+        for i in range(10):
+            with open(os.path.join(first, 'photos', f'img{i}.jpg'), 'w') as f:
+                f.write(f'image {i}')
+
+        second = os.path.join(self.dest, '2020-10-02')
+        os.makedirs(os.path.join(second, 'photos'))
+        for i in range(10):
+            os.link(os.path.join(first, 'photos', f'img{i}.jpg'), os.path.join(second, 'photos', f'img{i}.jpg'))
+        with open(os.path.join(second, 'new.txt'), 'w') as f:
+            f.write('new file')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_buildHashesOnlyNewInodes(self):
+        stats = manifest.build(self.dest, '2020-10-01')
+        self.assertEqual(stats['files'], 10)
+        self.assertEqual(stats['hashed'], 10)
+
+        stats = manifest.build(self.dest, '2020-10-02')
+        self.assertEqual(stats['files'], 11)
+        self.assertEqual(stats['hashed'], 1)
+
+        entries = manifest.readManifest(os.path.join(self.dest, '2020-10-02', manifest.metaDir, manifest.manifestName))
+        self.assertIn(b'new.txt', entries)
+        self.assertEqual(entries[b'new.txt'][0], hashing.hashFile(os.path.join(self.dest, '2020-10-02', 'new.txt')))
+
+    def test_verify(self):
+        manifest.build(self.dest, '2020-10-01')
+        manifest.build(self.dest, '2020-10-02')
+
+        results = list(manifest.verify(self.dest, ['2020-10-01', '2020-10-02']))
+        self.assertEqual([r['status'] for r in results], ['ok', 'ok'])
+        # The linked files are only hashed for the first snapshot
+        self.assertEqual(results[1]['hashed'], 1)
+
+        # Damage a file that is shared between the snapshots
+        with open(os.path.join(self.dest, '2020-10-01', 'photos', 'img3.jpg'), 'w') as f:
+            f.write('IMAGE 3')
+        os.remove(os.path.join(self.dest, '2020-10-02', 'new.txt'))
+
+        results = list(manifest.verify(self.dest, ['2020-10-01', '2020-10-02']))
+        self.assertEqual(results[0]['status'], 'failed')
+        self.assertEqual(results[0]['modified'], 1)
+        self.assertEqual(results[1]['modified'], 1)
+        self.assertEqual(results[1]['missing'], 1)
+
+    def test_noManifest(self):
+        results = list(manifest.verify(self.dest, ['2020-10-01']))
+        self.assertEqual(results[0]['status'], 'nomanifest')
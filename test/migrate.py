@@ -0,0 +1,53 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import dbackup
+from dbackup.commands import Backup, Migrate
+
+class TestMigrate(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.old = os.path.join(self.tmp.name, 'old')
+        self.new = os.path.join(self.tmp.name, 'new')
+        for snapshot in ['2020-10-01', '2020-10-02', '2020-10-03']:
+            os.makedirs(os.path.join(self.old, snapshot))
+        self.job = dbackup.Job('test', { 'source': '/srv/source', 'dest': self.old })
+        self.commands = []
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def fakeRSync(self, rsync, **kwargs):
+        """ Stands in for rsync by creating the target directory """
+        self.commands.append(rsync)
+        os.makedirs(rsync[-1], exist_ok=True)
+        return True
+
+    def migrate(self):
+        with mock.patch.object(Backup, 'invokeRSync', side_effect=self.fakeRSync):
+            return Migrate().execute(self.job, self.new)
+
+    def test_oldestFirst(self):
+        self.assertEqual(self.migrate(), dbackup.resultcodes.SUCCESS)
+        self.assertEqual(sorted(os.listdir(self.new)), ['2020-10-01', '2020-10-02', '2020-10-03'])
+
+        sources = [ rsync[-2] for rsync in self.commands ]
+        self.assertEqual(sources, [ os.path.join(self.old, name, '') for name in ['2020-10-01', '2020-10-02', '2020-10-03'] ])
+        self.assertFalse(any(arg.startswith('--link-dest') for arg in self.commands[0]))
+        self.assertIn('--link-dest=' + self.new + '/2020-10-01', self.commands[1])
+        self.assertIn('--link-dest=' + self.new + '/2020-10-02', self.commands[2])
+        self.assertNotIn('-H', self.commands[2])
+
+    def test_resume(self):
+        os.makedirs(os.path.join(self.new, '2020-10-01'))
+        os.makedirs(os.path.join(self.new, '2020-10-02.incomplete'))
+        with mock.patch.object(Backup, 'invokeRSync', return_value=False):
+            self.assertEqual(Migrate().execute(self.job, self.new), dbackup.resultcodes.MIGRATE_FAILED)
+
+        # The interrupted copy is continued, linked to the last complete one
+        self.assertEqual(self.migrate(), dbackup.resultcodes.SUCCESS)
+        self.assertEqual(len(self.commands), 2)
+        self.assertIn('--link-dest=' + self.new + '/2020-10-01', self.commands[0])
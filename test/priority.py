@@ -0,0 +1,75 @@
+import os
+import shlex
+import tempfile
+import unittest
+from pathlib import Path
+
+import dbackup
+from dbackup.commands import Backup
+from dbackup.helpers import Priority, callStats
+
+class TestPriority(unittest.TestCase):
+
+    jobSpec = {
+        'cert': str(Path(__file__).parent / 'data' / 'dummy_key.pub'),
+        'source': 'gud@source.host:/srv/source',
+        'dest': 'backup@dest.host:/srv/mirror/gud',
+        'ssharg': '-p 1234',
+        'nice': '10',
+        'ionice': 'best-effort:7',
+    }
+
+    def setUp(self):
+        callStats.reset()
+
+    def tearDown(self):
+        callStats.reset()
+
+    def test_wrap(self):
+        self.assertFalse(Priority())
+        self.assertEqual(Priority().wrap(['rsync']), ['rsync'])
+
+        priority = Priority(nice=19, ioClass='idle', ioLevel=4)
+        self.assertIsNone(priority.ioLevel)
+        if priority.prefix()[:1] == ['ionice']:
+            self.assertEqual(priority.wrap(['rsync', '-a']), ['ionice', '-c', '3', 'nice', '-n', '19', 'rsync', '-a'])
+        self.assertEqual(priority.wrapRemote('rm -rf "a b"'), 'ionice -c 3 nice -n 19 sh -c ' + shlex.quote('rm -rf "a b"'))
+        self.assertTrue(priority.wrap('echo $HOME').endswith(' sh -c ' + shlex.quote('echo $HOME')))
+
+        cgroup = Priority(ioWeight=10, memoryMax='1G').prefix()
+        if cgroup:
+            self.assertEqual(cgroup[:2], ['systemd-run', '--scope'])
+            self.assertIn('IOWeight=10', cgroup)
+            self.assertIn('MemoryMax=1G', cgroup)
+
+    def test_jobOptions(self):
+        job = dbackup.Job('test', self.jobSpec)
+        self.assertEqual((job.priority.nice, job.priority.ioClass, job.priority.ioLevel), (10, 'best-effort', 7))
+        self.assertIs(job.dest.priority, job.priority)
+        self.assertEqual(str(job.priority), 'nice 10, ionice best-effort:7')
+        with self.assertRaises(AssertionError):
+            dbackup.Job('test', dict(self.jobSpec, ionice='fast'))
+
+    def test_remote(self):
+        job = dbackup.Job('test', self.jobSpec)
+        backup = Backup(None)
+        rsync = backup.buildRSync(job, [], '2020-10-01.incomplete')
+        self.assertIn('--rsync-path=ionice -c 2 -n 7 nice -n 10 rsync', rsync)
+        command = backup.relayCommand(job, rsync)
+        self.assertTrue(command[-1].startswith('ionice -c 2 -n 7 nice -n 10 sh -c '))
+
+        # The job's own rsync-path is kept
+        job = dbackup.Job('test', dict(self.jobSpec, rsyncarg='--rsync-path=/opt/rsync'))
+        self.assertFalse(any(arg.startswith('--rsync-path=ionice') for arg in backup.buildRSync(job, [], 'x')))
+
+    def test_localDelete(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            os.makedirs(os.path.join(tmp, '2020-10-01', 'dir'))
+            job = dbackup.Job('test', { 'source': '/srv/source', 'dest': tmp, 'nice': '5' })
+            with callStats.job(job):
+                self.assertTrue(job.dest.deleteChild('2020-10-01'))
+            self.assertEqual(os.listdir(tmp), [])
+        self.assertEqual(callStats.jobTotals(job)[0], 1)
+        cpu, io = callStats.jobUsage(job)
+        self.assertGreaterEqual(cpu, 0)
+        self.assertGreaterEqual(io, 0)
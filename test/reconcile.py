@@ -0,0 +1,132 @@
+import unittest
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from unittest import mock
+
+import dbackup
+from dbackup.commands import Reconcile
+from dbackup.helpers import StateTracker
+from dbackup.location import LocalLocation
+
+from .fakessh import FakeSsh
+
+class TestReconcile(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.stateTracker = StateTracker(os.path.join(self.tmp.name, 'state'))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def makeJob(self, name, host, snapshots):
+        dest = os.path.join(self.tmp.name, name)
+        os.makedirs(dest)
+        for snapshot in snapshots:
+            os.makedirs(os.path.join(dest, snapshot))
+        return dbackup.Job(name, {
+            'cert': str(Path(__file__).parent / 'data' / 'dummy_key.pub'),
+            'source': '/srv/source',
+            'dest': f'backup@{host}:{dest}',
+            'ssharg': '-p 1234',
+        })
+
+    def test_reconcile(self):
+        self.stateTracker.update('a', '2020-09-01')
+        self.stateTracker.update('b', '2020-10-02')
+        jobs = [
+            self.makeJob('a', 'host1', ['2020-09-01', '2020-10-02', '2020-10-03.incomplete']),
+            self.makeJob('b', 'host1', ['2020-10-02']),
+            self.makeJob('c', 'host2', ['2020-10-01', 'lost+found']),
+            self.makeJob('d', 'host3', []),
+        ]
+        with FakeSsh() as ssh:
+            result = Reconcile(self.stateTracker).execute(jobs)
+            # One call per host
+            self.assertEqual(len(ssh.commands), 3)
+        self.assertEqual(result, dbackup.resultcodes.BAD_JOBS)
+        self.assertEqual(self.stateTracker.getLastGood('a'), '2020-10-02')
+        self.assertEqual(self.stateTracker.getLastGood('b'), '2020-10-02')
+        self.assertEqual(self.stateTracker.getLastGood('c'), '2020-10-01')
+        self.assertIsNone(self.stateTracker.getLastGood('d'))
+
+    def test_simulate(self):
+        jobs = [ self.makeJob('a', 'host1', ['2020-10-02']) ]
+        with FakeSsh():
+            self.assertEqual(Reconcile(self.stateTracker, simulate=True).execute(jobs), dbackup.resultcodes.SUCCESS)
+        self.assertIsNone(self.stateTracker.getLastGood('a'))
+
+    def test_parallelHosts(self):
+        jobs = [ self.makeJob(f'job{n}', f'host{n}', ['2020-10-01']) for n in range(8) ]
+        with FakeSsh(latency=0.5):
+            start = time.monotonic()
+            self.assertEqual(Reconcile(self.stateTracker).execute(jobs), dbackup.resultcodes.SUCCESS)
+            self.assertLess(time.monotonic() - start, 2)
+        self.assertTrue(all(self.stateTracker.getLastGood(job) == '2020-10-01' for job in jobs))
+
+    def test_timeout(self):
+        jobs = [ self.makeJob('a', 'host1', ['2020-10-01']) ]
+        with FakeSsh(latency=2):
+            with self.assertLogs(level='ERROR'):
+                result = Reconcile(self.stateTracker, timeout=0.2).execute(jobs)
+        self.assertEqual(result, dbackup.resultcodes.SSH_ERROR)
+        self.assertIsNone(self.stateTracker.getLastGood('a'))
+
+    def test_localTimeout(self):
+        dest = os.path.join(self.tmp.name, 'local')
+        os.makedirs(os.path.join(dest, '2020-10-01'))
+        jobs = [ dbackup.Job('a', { 'source': '/srv/source', 'dest': dest }) ]
+        # The destination is on a hung mount
+        hung = threading.Event()
+        with mock.patch.object(type(jobs[0].dest), 'listDir', side_effect=lambda: hung.wait(10)):
+            start = time.monotonic()
+            with self.assertLogs(level='ERROR'):
+                result = Reconcile(self.stateTracker, timeout=0.2).execute(jobs)
+            self.assertLess(time.monotonic() - start, 2)
+            hung.set()
+        self.assertEqual(result, dbackup.resultcodes.SSH_ERROR)
+        self.assertIsNone(self.stateTracker.getLastGood('a'))
+
+    def makeLocalJobs(self, count):
+        jobs = []
+        for n in range(count):
+            dest = os.path.join(self.tmp.name, f'disk{n}')
+            os.makedirs(os.path.join(dest, '2020-10-01'))
+            jobs.append(dbackup.Job(f'job{n}', { 'source': '/srv/source', 'dest': dest }))
+        return jobs
+
+    def test_timeoutOnce(self):
+        # Each destination is listed as its own host
+        jobs = self.makeLocalJobs(3)
+        hung = threading.Event()
+        with mock.patch.object(LocalLocation, 'hostKey', property(lambda location: location.path)), \
+                mock.patch.object(LocalLocation, 'listDir', side_effect=lambda: hung.wait(10)):
+            start = time.monotonic()
+            with self.assertLogs(level='ERROR') as logs:
+                result = Reconcile(self.stateTracker, timeout=0.5).execute(jobs)
+            # All hosts hang at the same time, so they take one timeout in total
+            self.assertLess(time.monotonic() - start, 1.2)
+            hung.set()
+        self.assertEqual(len(logs.records), 3)
+        self.assertEqual(result, dbackup.resultcodes.SSH_ERROR)
+
+    def test_timeoutAfterStart(self):
+        jobs = self.makeLocalJobs(2)
+        hung = threading.Event()
+        def listDir(location):
+            if location.path == jobs[0].dest.path:
+                hung.wait(10)
+            return [ '2020-10-01' ]
+        with mock.patch.object(LocalLocation, 'hostKey', property(lambda location: location.path)), \
+                mock.patch.object(LocalLocation, 'listDir', autospec=True, side_effect=listDir):
+            with self.assertLogs(level='ERROR') as logs:
+                result = Reconcile(self.stateTracker, workers=1, timeout=0.5).execute(jobs)
+            hung.set()
+        # The second host waited for the worker of the first, and was listed when that gave up
+        self.assertEqual(len(logs.records), 1)
+        self.assertEqual(result, dbackup.resultcodes.SSH_ERROR)
+        self.assertIsNone(self.stateTracker.getLastGood('job0'))
+        self.assertEqual(self.stateTracker.getLastGood('job1'), '2020-10-01')
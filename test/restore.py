@@ -0,0 +1,85 @@
+import unittest
+import os
+import tempfile
+from pathlib import Path
+from unittest import mock
+
+import dbackup
+from dbackup.commands import Restore, Backup
+from dbackup.tools import restore
+
+class TestRestore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def writeFile(self, relpath, size):
+        path = os.path.join(self.tmp.name, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+
+    def test_plan(self):
+        # One big directory is split, the small ones are kept whole
+        for n in range(4):
+            self.writeFile(f'big/file{n}', 1000)
+        self.writeFile('small/a', 100)
+        self.writeFile('small/b', 100)
+        self.writeFile('top', 10)
+
+        plan = restore.plan(self.tmp.name, 4)
+        self.assertTrue(plan['dir'])
+        self.assertEqual(plan['bytes'], 4210)
+        self.assertEqual(len(plan['streams']), 4)
+        paths = sorted(path for stream in plan['streams'] for path in stream['paths'])
+        self.assertEqual(paths, ['big/file0', 'big/file1', 'big/file2', 'big/file3', 'small', 'top'])
+        self.assertEqual(max(stream['bytes'] for stream in plan['streams']), 1200)
+
+    def test_planFile(self):
+        self.writeFile('file', 10)
+        plan = restore.plan(os.path.join(self.tmp.name, 'file'), 4)
+        self.assertFalse(plan['dir'])
+        self.assertEqual(plan['streams'], [])
+
+    def test_restoreRoot(self):
+        for n in range(4):
+            self.writeFile(f'dest/2020-10-01/dir{n}/file', 1000)
+        self.writeFile('dest/2020-10-01/.dbackup/manifest.gz', 1000)
+        plan = restore.plan(os.path.join(self.tmp.name, 'dest', '2020-10-01'), 4, ['.dbackup'])
+        self.assertEqual(plan['bytes'], 4000)
+        self.assertNotIn('.dbackup', [ path for stream in plan['streams'] for path in stream['paths'] ])
+
+        job = dbackup.Job('test', { 'source': '/srv/source', 'dest': os.path.join(self.tmp.name, 'dest') })
+        target = os.path.join(self.tmp.name, 'target')
+        with mock.patch.object(Backup, 'runRSync', return_value=0) as runRSync:
+            self.assertEqual(Restore(streams=2).execute(job, '2020-10-01', '/', target), dbackup.resultcodes.SUCCESS)
+        commands = [ call[0][0] for call in runRSync.call_args_list ]
+        self.assertEqual(len(commands), 3)
+        self.assertTrue(all('--exclude=/.dbackup' in rsync for rsync in commands))
+
+        # Only the metadata in the snapshot root is left out
+        with mock.patch.object(Backup, 'runRSync', return_value=0) as runRSync:
+            self.assertEqual(Restore(streams=2).execute(job, '2020-10-01', 'dir0', target), dbackup.resultcodes.SUCCESS)
+        self.assertFalse(any('--exclude=/.dbackup' in call[0][0] for call in runRSync.call_args_list))
+
+    def test_rsyncCommand(self):
+        spec = {
+            'cert': str(Path(__file__).parent / 'data' / 'dummy_key.pub'),
+            'source': '/home/gud',
+            'dest': 'backup@dest.host:/srv/mirror/gud',
+            'ssharg': '-p 1234',
+        }
+        job = dbackup.Job('test', spec)
+        cmdRestore = Restore(streams=2)
+        self.assertEqual(cmdRestore.snapshotPath(job, '2020-10-01', '/home/gud/photos/2005'), '2020-10-01/photos/2005')
+        self.assertEqual(cmdRestore.snapshotPath(job, '2020-10-01', 'photos'), '2020-10-01/photos')
+
+        target = dbackup.location.Factory('/tmp/restored')
+        rsync = cmdRestore.buildRSync(job, target, '2020-10-01/photos/', '/tmp/stream0')
+        self.assertIn('--files-from=/tmp/stream0', rsync)
+        self.assertNotIn('--delete', rsync)
+        self.assertEqual(rsync[-2:], ['dest.host:/srv/mirror/gud/2020-10-01/photos/', '/tmp/restored/'])
+        self.assertTrue(any(arg.startswith('--rsh=ssh ') and '-l backup' in arg for arg in rsync))
@@ -0,0 +1,138 @@
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+import dbackup
+from dbackup.commands import Backup
+from dbackup.helpers import DaemonError, ScriptError
+
+from .fakessh import FakeSsh
+
+class TestRsyncDaemon(unittest.TestCase):
+    """ Runs an rsync daemon with a module in a temporary directory on a loopback port """
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.module = os.path.join(self.tmp.name, 'module')
+        self.source = os.path.join(self.tmp.name, 'source')
+        os.makedirs(self.module)
+        os.makedirs(os.path.join(self.source, 'dir'))
+        with open(os.path.join(self.source, 'dir', 'file'), 'w') as f:
+            f.write('content')
+        self.passwordFile = self.writeSecret('password', 'secret\n')
+        self.daemon = None
+
+    def tearDown(self):
+        if self.daemon is not None:
+            self.daemon.terminate()
+            self.daemon.wait()
+        self.tmp.cleanup()
+
+    def writeSecret(self, name, content):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        # rsync refuses secrets that others can read
+        os.chmod(path, 0o600)
+        return path
+
+    def startDaemon(self) -> int:
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        config = os.path.join(self.tmp.name, 'rsyncd.conf')
+        with open(config, 'w') as f:
+            f.write(f'use chroot = no\npid file = {self.tmp.name}/rsyncd.pid\nlog file = {self.tmp.name}/rsyncd.log\n')
+            if os.getuid() == 0:
+                # Instead of nobody
+                f.write('uid = 0\ngid = 0\n')
+            f.write(f'[backup]\npath = {self.module}\nread only = no\nauth users = gud\n'
+                f'secrets file = {self.writeSecret("secrets", "gud:secret")}\n')
+        self.daemon = subprocess.Popen(['rsync', '--daemon', '--no-detach', '--address=127.0.0.1',
+            f'--port={port}', f'--config={config}'])
+        for n in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                return port
+            except OSError:
+                time.sleep(0.05)
+        self.fail('The rsync daemon did not start')
+
+    def makeJob(self, dest, **options) -> dbackup.Job:
+        return dbackup.Job('test', dict({ 'source': self.source, 'dest': dest, 'password file': self.passwordFile,
+            'cert': str(Path(__file__).parent / 'data' / 'dummy_key.pub'), 'ssharg': '-p 1234' }, **options))
+
+    def test_spec(self):
+        job = self.makeJob('rsync://gud@nas/backup/gud/', **{ 'daemon ssh': 'admin@nas:/volume1/backup' })
+        self.assertTrue(job.dest.isDaemon)
+        self.assertEqual(job.dest.path, '/volume1/backup/gud')
+        self.assertEqual(job.dest.hostKey, 'rsync://nas:873')
+
+        rsync = Backup(None).buildRSync(job, Backup(None).getLinkTargetOpts(job.dest, '2020-10-01'), '2020-10-02.incomplete')
+        self.assertEqual(rsync[-2:], [os.path.join(self.source, ''), 'rsync://gud@nas:873/backup/gud/2020-10-02.incomplete'])
+        self.assertIn('--link-dest=../2020-10-01', rsync)
+        self.assertIn('--password-file=' + self.passwordFile, rsync)
+        self.assertFalse(any(arg.startswith('--rsh') for arg in rsync))
+
+        with self.assertRaises(AssertionError):
+            self.makeJob('rsync://gud@nas/backup/gud')
+        with self.assertRaises(AssertionError):
+            dbackup.Job('test', { 'source': 'gud@host:/srv', 'dest': 'rsync://nas/backup', 'daemon ssh': 'admin@nas:/b',
+                'cert': str(Path(__file__).parent / 'data' / 'dummy_key.pub'), 'ssharg': '-p 1234' })
+
+    def test_sshManagement(self):
+        job = self.makeJob('rsync://gud@nas/backup/gud', **{ 'daemon ssh': 'admin@nas:' + self.module })
+        os.makedirs(os.path.join(self.module, 'gud', '2020-10-01.incomplete'))
+        with FakeSsh() as ssh:
+            job.dest.renameChild('2020-10-01.incomplete', '2020-10-01')
+            self.assertTrue(os.path.isdir(os.path.join(self.module, 'gud', '2020-10-01')))
+            self.assertTrue(job.dest.deleteChild('2020-10-01'))
+            self.assertEqual(os.listdir(os.path.join(self.module, 'gud')), [])
+            self.assertIsNotNone(job.dest.freeSpace())
+            self.assertEqual(len(ssh.commands), 3)
+
+        source = dbackup.Job('test', { 'source': 'rsync://nas/backup', 'dest': self.module }).source
+        with self.assertRaises(DaemonError):
+            source.renameChild('a', 'b')
+        with self.assertRaises(ScriptError):
+            source.runTool('manifest', ['build', source.path, 'x'])
+        self.assertIsNone(source.freeSpace())
+
+    @unittest.skipUnless(shutil.which('rsync'), 'rsync is not installed')
+    def test_daemon(self):
+        port = self.startDaemon()
+        url = f'rsync://gud@127.0.0.1:{port}/backup/jobs/gud'
+        location = dbackup.location.Factory(url, passwordFile=self.passwordFile)
+
+        self.assertFalse(location.validate())
+        self.assertTrue(location.create())
+        self.assertTrue(location.validate())
+        self.assertIsNone(location.listDir())
+
+        job = self.makeJob(url, **{ 'daemon ssh': 'admin@127.0.0.1:' + self.module })
+        rsync = Backup(None).buildRSync(job, [], '2020-10-01')
+        self.assertEqual(subprocess.run(rsync, stdin=subprocess.DEVNULL).returncode, 0)
+        with open(os.path.join(self.module, 'jobs', 'gud', '2020-10-01', 'dir', 'file')) as f:
+            self.assertEqual(f.read(), 'content')
+        self.assertEqual(location.listDir(), ['2020-10-01'])
+
+        # Unchanged files are linked to the previous snapshot
+        rsync = Backup(None).buildRSync(job, Backup(None).getLinkTargetOpts(location, '2020-10-01'), '2020-10-02')
+        self.assertEqual(subprocess.run(rsync, stdin=subprocess.DEVNULL).returncode, 0)
+        self.assertEqual(os.stat(os.path.join(self.module, 'jobs', 'gud', '2020-10-02', 'dir', 'file')).st_nlink, 2)
+
+        local = os.path.join(self.tmp.name, 'changes')
+        self.assertTrue(location.writeFile('2020-10-02/.dbackup/changes', os.path.join(self.source, 'dir', 'file')))
+        self.assertTrue(location.readFile('2020-10-02/.dbackup/changes', local))
+        self.assertFalse(location.readFile('2020-10-02/.dbackup/missing', local))
+        with open(local) as f:
+            self.assertEqual(f.read(), 'content')
+
+        location.passwordFile = self.writeSecret('wrong', 'wrong\n')
+        with self.assertRaises(DaemonError):
+            location.listDir()
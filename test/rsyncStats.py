@@ -0,0 +1,40 @@
+import unittest
+
+from dbackup.helpers.rsyncStats import RSyncStats
+
+class TestRSyncStats(unittest.TestCase):
+
+    output = '''
+Number of files: 1,234 (reg: 1,000, dir: 234)
+Number of created files: 10 (reg: 10)
+Number of deleted files: 0
+Number of regular files transferred: 12
+Total file size: 1.50G bytes
+Total transferred file size: 123,456 bytes
+Literal data: 100,000 bytes
+Matched data: 23,456 bytes
+File list size: 0
+Total bytes sent: 101,234
+Total bytes received: 456
+
+sent 101,234 bytes  received 456 bytes  67,793.33 bytes/sec
+total size is 1.50G  speedup is 14,751.75
+'''
+
+    def test_parse(self):
+        stats = RSyncStats().parse(self.output)
+        self.assertEqual(stats.files, 1234)
+        self.assertEqual(stats.transferredFiles, 12)
+        self.assertEqual(stats.totalSize, 1500000000)
+        self.assertEqual(stats.transferredSize, 123456)
+        self.assertEqual(stats.literalData, 100000)
+        self.assertEqual(stats.bytesSent, 101234)
+        self.assertEqual(stats.bytesReceived, 456)
+
+    def test_feed(self):
+        stats = RSyncStats()
+        self.assertFalse(stats.feed('>f+++++++++ 10 notes.txt'))
+        self.assertFalse(stats.feed('sending incremental file list'))
+        self.assertTrue(stats.feed('Total transferred file size: 10 bytes'))
+        self.assertEqual(stats.transferredSize, 10)
+        self.assertIsNone(stats.totalSize)
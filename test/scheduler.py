@@ -0,0 +1,64 @@
+import unittest
+import os
+import tempfile
+from datetime import datetime, time
+
+from dbackup.helpers.stateTracker import StateTracker
+from dbackup.helpers.scheduler import Scheduler
+
+class FakeJob:
+    def __init__(self, name, deadline = None):
+        self.name = name
+        self.deadline = deadline
+
+    def __str__(self):
+        return self.name
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.stateTracker = StateTracker(os.path.join(self.tmp.name, 'backup.state'))
+        self.now = datetime(2020, 10, 1, 22, 0)
+
+        self.small = FakeJob('small')
+        self.giant = FakeJob('giant')
+        self.urgent = FakeJob('urgent', time(1, 0))
+        self.new = FakeJob('new')
+        self.stateTracker.recordRun('small', transferred=1000, duration=600)
+        self.stateTracker.recordRun('giant', transferred=100000, duration=5 * 3600)
+        self.stateTracker.recordRun('urgent', transferred=1000, duration=1800)
+        # Only the size is known, which is predicted with the throughput
+        self.stateTracker.state['Transferred']['new'] = '50000'
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_prediction(self):
+        scheduler = Scheduler(self.stateTracker)
+        throughput = scheduler.throughput([ self.small, self.giant, self.urgent, self.new ])
+        self.assertEqual(scheduler.predictDuration(self.small, throughput), 600)
+        self.assertAlmostEqual(scheduler.predictDuration(self.new, throughput), 50000 / throughput)
+        self.assertIsNone(scheduler.predictDuration(FakeJob('unknown'), throughput))
+
+    def test_longestFirstInParallel(self):
+        scheduler = Scheduler(self.stateTracker, workers=2)
+        unknown = FakeJob('unknown')
+        jobs = scheduler.order([ self.small, self.urgent, unknown, self.giant ], self.now)
+        self.assertEqual([ job.name for job in jobs ], ['unknown', 'giant', 'urgent', 'small'])
+
+    def test_deadlineFirstInSequence(self):
+        scheduler = Scheduler(self.stateTracker)
+        jobs = scheduler.order([ self.small, self.giant, self.urgent ], self.now)
+        self.assertEqual([ job.name for job in jobs ], ['urgent', 'small', 'giant'])
+
+    def test_window(self):
+        scheduler = Scheduler(self.stateTracker)
+        with self.assertLogs(level='WARNING'):
+            late = scheduler.checkWindow([ self.giant, self.urgent ], self.now)
+        self.assertEqual(late, [ self.urgent ])
+        self.assertEqual(scheduler.checkWindow([ self.urgent, self.giant ], self.now), [])
+
+        # In parallel, both start at once
+        plan = Scheduler(self.stateTracker, workers=2).plan([ self.giant, self.urgent ], self.now)
+        self.assertEqual([ start for job, start, finish in plan ], [ self.now, self.now ])
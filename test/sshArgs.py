@@ -34,3 +34,23 @@ class TestSshArgs(unittest.TestCase):
         sshArgs = SshArgs(jobSpec)
         self.assertIsNone(sshArgs.hostKeyFile)
         self.assertEqual(sshArgs.port, 1234)
+
+    def test_tunedCipher(self):
+        jobSpec = self.jobSpec.copy()
+        jobSpec['ssharg'] = '-p 1234'
+        job = dbackup.Job('test', jobSpec)
+        SshArgs.tunedCiphers['localhost'] = ('aes128-ctr', 'umac-64-etm@openssh.com')
+        try:
+            args = list(job.source.sshArgs)
+            self.assertEqual(args[args.index('-c') + 1], 'aes128-ctr')
+            self.assertEqual(args[args.index('-m') + 1], 'umac-64-etm@openssh.com')
+            self.assertIn('-c', job.source.relaySshArgs())
+            # Only the location knows the host
+            self.assertNotIn('-c', list(job.sshArgs))
+
+            # A cipher in ssharg wins
+            jobSpec['ssharg'] = '-p 1234 -c aes256-ctr'
+            job = dbackup.Job('test', jobSpec)
+            self.assertEqual(list(job.source.sshArgs).count('-c'), 1)
+        finally:
+            SshArgs.tunedCiphers.clear()
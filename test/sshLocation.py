@@ -1,4 +1,6 @@
+import subprocess
 import unittest
+import unittest.mock
 from pathlib import Path
 
 import dbackup
@@ -30,3 +32,19 @@ class TestSshLocation(unittest.TestCase):
         ]
 
         self.assertEqual(src._buildSshCmd('test'), expectedSshCommand)
+
+    def test_batchCalls(self):
+        sshArgs = SshArgs(self.jobSpec)
+        a = SshLocation('gud@localhost:/backup/a', sshArgs, simulate=False)
+        b = SshLocation('gud@localhost:/backup/b', sshArgs, simulate=False)
+
+        listing = b'//0\n2020-10-01\n2020-10-02\n//1\n'
+        with unittest.mock.patch('subprocess.check_output', return_value=listing) as run:
+            self.assertEqual(SshLocation.listDirs([a, b]), [['2020-10-01', '2020-10-02'], None])
+            self.assertEqual(run.call_count, 1)
+
+        result = subprocess.CompletedProcess([], 0, stdout=b'//FAILED 0\n//OK 1\n', stderr=b'')
+        with unittest.mock.patch('subprocess.run', return_value=result) as run:
+            self.assertEqual(SshLocation.deleteChildren([(a, ['2020-09-01']), (b, ['2020-09-01'])]), [False, True])
+            self.assertEqual(run.call_count, 1)
+            self.assertIn("rm -rf /backup/b/2020-09-01", run.call_args[0][0][-1])
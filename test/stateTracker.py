@@ -0,0 +1,39 @@
+import unittest
+import os
+import tempfile
+
+from dbackup.helpers.stateTracker import StateTracker
+
+class TestStateTracker(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.filePath = os.path.join(self.tmp.name, 'backup.state')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_history(self):
+        with StateTracker(self.filePath) as stateTracker:
+            self.assertEqual(stateTracker.getHistory('job1', 'Transferred'), [])
+            for n in range(StateTracker.historyLength + 2):
+                stateTracker.recordRun('job1', transferred=n * 1000, duration=n + 0.5)
+
+        # The history is persisted and limited in length
+        stateTracker = StateTracker(self.filePath)
+        transferred = stateTracker.getHistory('job1', 'Transferred')
+        self.assertEqual(len(transferred), StateTracker.historyLength)
+        self.assertEqual(transferred[-1], (StateTracker.historyLength + 1) * 1000)
+        self.assertEqual(stateTracker.getHistory('job1', 'Duration')[-1], StateTracker.historyLength + 1)
+        self.assertEqual(stateTracker.getHistory('job2', 'Duration'), [])
+
+    def test_sshCiphers(self):
+        with StateTracker(self.filePath) as stateTracker:
+            self.assertEqual(stateTracker.getSshCiphers(), {})
+            stateTracker.setSshCipher('nas.example.com', 'aes128-gcm@openssh.com')
+            stateTracker.setSshCipher('old.example.com', 'aes128-ctr', 'umac-64-etm@openssh.com')
+
+        stateTracker = StateTracker(self.filePath)
+        self.assertEqual(stateTracker.getSshCiphers(), {
+            'nas.example.com': ('aes128-gcm@openssh.com', None),
+            'old.example.com': ('aes128-ctr', 'umac-64-etm@openssh.com') })
@@ -0,0 +1,120 @@
+import os
+import subprocess
+import time
+import unittest
+from pathlib import Path
+
+import dbackup
+from dbackup.commands import Backup
+from dbackup.helpers import Throttle
+
+from .fakessh import FakeSsh
+
+class TestThrottle(unittest.TestCase):
+
+    def setUp(self):
+        self.proc = subprocess.Popen(['sleep', '30'])
+
+    def tearDown(self):
+        self.proc.kill()
+        self.proc.wait()
+
+    def stopped(self, expected) -> bool:
+        """ Waits a moment for the signal to arrive, and returns if sleep is stopped """
+        deadline = time.monotonic() + 2
+        while True:
+            with open(f'/proc/{self.proc.pid}/stat') as f:
+                stopped = f.read().rsplit(')', 1)[1].split()[0] == 'T'
+            if stopped == expected or time.monotonic() > deadline:
+                return stopped
+            time.sleep(0.01)
+
+    def test_parseSample(self):
+        lines = ['0.52 0.58 0.59 1/1130 31337', 'some avg10=12.50 avg60=3.00 avg300=1.00 total=1',
+            'full avg10=9.00 avg60=2.00 avg300=1.00 total=1']
+        self.assertEqual(Throttle.parseSample(lines), (0.52, 12.5))
+        self.assertEqual(Throttle.parseSample(lines[:1]), (0.52, None))
+        self.assertEqual(Throttle.parseSample([]), (None, None))
+
+    def test_pauseAndResume(self):
+        paused = []
+        throttle = Throttle(maxLoad=4, maxIoPressure=20, onPause=lambda: paused.append(True))
+        throttle._proc = self.proc
+
+        throttle.check({ 'localhost': (1.0, 25.0) })
+        self.assertTrue(throttle.isPaused)
+        self.assertTrue(self.stopped(True))
+        self.assertEqual(paused, [True])
+
+        # Stays paused until the load is well below the thresholds
+        throttle.check({ 'localhost': (1.0, 18.0) })
+        self.assertTrue(throttle.isPaused)
+        throttle.check({ 'localhost': (3.0, None), 'remote': (1.0, 10.0) })
+        self.assertFalse(throttle.isPaused)
+        self.assertFalse(self.stopped(False))
+        self.assertEqual(throttle.pauses, 1)
+
+    def test_maxPause(self):
+        throttle = Throttle(maxLoad=4, maxPause=0.05)
+        throttle._proc = self.proc
+        throttle.check({ 'localhost': (5.0, None) })
+        time.sleep(0.1)
+        throttle.check({ 'localhost': (5.0, None) })
+        self.assertFalse(throttle.isPaused)
+        # The pause budget is used up
+        throttle.check({ 'localhost': (5.0, None) })
+        self.assertFalse(throttle.isPaused)
+        self.assertGreaterEqual(throttle.pausedTime, 0.05)
+
+    def test_remoteSample(self):
+        job = dbackup.Job('test', {
+            'cert': str(Path(__file__).parent / 'data' / 'dummy_key.pub'),
+            'source': '/srv/source',
+            'dest': 'backup@backup.host:/srv/mirror',
+            'ssharg': '-p 1234',
+            'max load': '1000',
+        })
+        # The thread doesn't sample during the test
+        throttle = Throttle([job.dest], maxLoad=job.maxLoad, interval=60)
+        with FakeSsh() as ssh:
+            throttle.attach(self.proc)
+            try:
+                samples = throttle.sample()
+                samples = throttle.sample()
+            finally:
+                throttle.detach()
+            self.assertEqual(len(ssh.commands), 1)
+        self.assertEqual(set(samples), { 'localhost', 'backup.host' })
+        self.assertIsNotNone(samples['backup.host'][0])
+        self.assertFalse(throttle.isPaused)
+
+    def test_sharedConnection(self):
+        job = dbackup.Job('test', {
+            'cert': str(Path(__file__).parent / 'data' / 'dummy_key.pub'),
+            'source': '/srv/source',
+            'dest': 'backup@backup.host:/srv/mirror',
+            'ssharg': '-p 1234',
+            'max load': '1000',
+        })
+        backup = Backup(None)
+        throttle = backup.buildThrottle(job)
+        sshOpts = throttle.sshOpts(job.dest)
+        self.assertEqual(sshOpts[0], '-o')
+        self.assertTrue(sshOpts[1].startswith('ControlPath='))
+        self.assertEqual(throttle.sshOpts(job.source), [])
+
+        # rsync connects through the master connection of the throttle
+        rsync = backup.buildRSync(job, [], '2020-10-01.incomplete', sshOpts=sshOpts)
+        rsh = [ arg for arg in rsync if arg.startswith('--rsh=ssh ') ][0]
+        self.assertIn(' -o ' + sshOpts[1], rsh)
+
+        throttle.interval = 60
+        with FakeSsh() as ssh:
+            throttle.connect()
+            throttle.attach(self.proc)
+            try:
+                self.assertIn('backup.host', throttle.sample())
+            finally:
+                throttle.detach()
+            # The master, the sampling session in it, and closing the master
+            self.assertEqual(len(ssh.commands), 3)